@@ -0,0 +1,74 @@
+"""Batch processing of many fields: each scene is opened once for all the fields it covers."""
+import asyncio
+import os
+import geojson
+from fastapi import HTTPException
+from loguru import logger
+from getsatdata import get_data
+from jobs import set_stage
+from registry import is_field_name
+from settings import PATH_FIELDS, PROCESS_POOL_SIZE
+from unpacksatdata import get_product_of_field, make_data_fields
+
+
+async def make_fields_from_geojson(batch_name: str, content: bytes) -> list[str]:
+    """Creates a field for every feature of the geojson. The field name is the feature
+    property 'name' or '<batch_name>_<number>'."""
+    try:
+        features = geojson.loads(content).get('features') or []
+    except ValueError as ex:
+        logger.info(f'{ex}')
+        raise HTTPException(status_code=400, detail='The file is not a geojson FeatureCollection.')
+    fields = {}
+    for number, feature in enumerate(features, start=1):
+        field_name = str(feature.get('properties', {}).get('name') or f'{batch_name}_{number}')
+        fields[field_name] = geojson.FeatureCollection([feature])
+    invalid_names = [field_name for field_name in fields if not is_field_name(field_name)]
+    if invalid_names:
+        raise HTTPException(status_code=400, detail=f'These names {invalid_names} are not valid field names. Give the fields names without / and \\.')
+    existing_fields = [field_name for field_name in fields if os.path.exists(f'{PATH_FIELDS}{field_name}')]
+    if existing_fields:
+        raise HTTPException(status_code=404, detail=f'These names {existing_fields} already exist. Give the fields different names.')
+    for field_name, collection in fields.items():
+        os.mkdir(f'{PATH_FIELDS}{field_name}')
+        with open(f'{PATH_FIELDS}{field_name}/{field_name}.geojson', 'w') as f:
+            geojson.dump(collection, f)
+    logger.info(f'Batch {batch_name}: fields {list(fields)} created')
+    return list(fields)
+
+
+async def run_batch(field_names: list[str], username: str = '', password: str = '', job_id: str = None) -> dict:
+    """Downloads missing scenes, groups the fields by scene and processes every scene once.
+    Returns NDVI and image paths, or the error, of every field."""
+    results = {}
+    scenes = {}
+    for field_name in field_names:
+        if not os.path.exists(f'{PATH_FIELDS}{field_name}/sat_field_{field_name}.geojson'):
+            if not username:
+                results[field_name] = {'error': 'There is no satellite data. Send username and password to download it.'}
+                continue
+            try:
+                await get_data(field_name, username, password, job_id)
+            except HTTPException as ex:
+                results[field_name] = {'error': ex.detail}
+                continue
+        id_product, _ = await get_product_of_field(field_name)
+        scenes.setdefault(id_product, []).append(field_name)
+
+    set_stage(job_id, 'processing')
+    logger.info(f'Batch: {len(field_names)} fields, {len(scenes)} scenes')
+    # at most PROCESS_POOL_SIZE scenes in the pool, so a large batch does not overflow the pool queue
+    pool_slots = asyncio.Semaphore(PROCESS_POOL_SIZE)
+
+    async def make_scene_fields(names: list[str]) -> dict[str, dict]:
+        async with pool_slots:
+            return await make_data_fields(names)
+
+    scenes_results = await asyncio.gather(*(make_scene_fields(names) for names in scenes.values()), return_exceptions=True)
+    for names, scene_results in zip(scenes.values(), scenes_results):
+        if isinstance(scene_results, Exception):
+            error = str(getattr(scene_results, 'detail', scene_results))
+            results.update({field_name: {'error': error} for field_name in names})
+        else:
+            results.update(scene_results)
+    return {'fields': results}
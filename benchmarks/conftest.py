@@ -0,0 +1,31 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic import UUID, make_field, make_safe_zip  # noqa: E402
+
+TILE_SIZE = 1000
+FIELD_SIZES = {'small': 50, 'medium': 200, 'large': 600}
+CONCURRENT_FIELDS = 4
+
+
+@pytest.fixture(scope='session')
+def synthetic_dir(tmp_path_factory):
+    """Working directory with ./fields/: the synthetic scene in the scene cache, one field per
+    FIELD_SIZES entry and CONCURRENT_FIELDS medium fields for the concurrency benchmarks."""
+    path = tmp_path_factory.mktemp('synthetic')
+    make_safe_zip(f'{path}/fields/buffer/scenes/{UUID}', size=TILE_SIZE)
+    for name, size in FIELD_SIZES.items():
+        make_field(f'{path}/fields/', f'field_{name}', 100, 100, size, size, size=TILE_SIZE)
+    for number in range(CONCURRENT_FIELDS):
+        make_field(f'{path}/fields/', f'concurrent_{number}', 50 + 220 * number, 700, 200, 200, size=TILE_SIZE)
+    return path
+
+
+@pytest.fixture
+def synthetic_workdir(synthetic_dir, monkeypatch):
+    """Runs the test in the synthetic working directory: the settings paths are relative."""
+    monkeypatch.chdir(synthetic_dir)
+    return synthetic_dir
@@ -0,0 +1,99 @@
+"""Synthetic Sentinel-2 Level-2A product for tests and benchmarks.
+The zip has the SAFE layout of a real product: GRANULE/*/IMG_DATA/R10m and R20m band files,
+a manifest, and the field gets a product geojson like the one from the catalogue."""
+import os
+import shutil
+import tempfile
+import numpy as np
+import geojson
+import rasterio as rio
+from pyproj import Transformer
+from rasterio.transform import from_origin
+
+
+TILE = 'T37UDB'
+SENSING_TIME = '20220608T084559'
+TITLE = f'S2B_MSIL2A_{SENSING_TIME}_N0400_R107_{TILE}_20220608T105925'
+UUID = '2a3bc7b9-defd-4d9d-ae5f-2d17272e7256'
+CRS = 'EPSG:32637'
+ORIGIN = (400000, 6200000)
+
+BANDS_10M = ('TCI', 'B02', 'B03', 'B04', 'B08')
+BANDS_20M = ('B05', 'SCL')
+
+
+def _make_bands(size: int, seed: int) -> dict[str, np.ndarray]:
+    """Reflectance with smooth field-like patches and noise, so the bands compress like real ones."""
+    rng = np.random.default_rng(seed)
+    rows, cols = np.mgrid[0:size, 0:size]
+    vegetation = 0.5 + 0.4 * np.sin(rows / 37) * np.cos(cols / 53)
+    noise = rng.normal(0, 0.03, (size, size))
+    red = np.clip(1500 - 1100 * vegetation + 300 * noise, 1, 10000).astype(np.uint16)
+    nir = np.clip(1500 + 2500 * vegetation + 300 * noise, 1, 10000).astype(np.uint16)
+    green = np.clip(1000 + 300 * vegetation + 300 * noise, 1, 10000).astype(np.uint16)
+    blue = np.clip(800 + 200 * noise, 1, 10000).astype(np.uint16)
+    tci = np.stack([np.clip(band / 12, 0, 255) for band in (red, green, blue)]).astype(np.uint8)
+    small = size // 2
+    scl = np.full((small, small), 4, dtype=np.uint8)
+    scl[:small // 5, :small // 5] = 9
+    scl[small // 5:small // 4, :small // 5] = 3
+    return {
+        'TCI': tci, 'B02': blue, 'B03': green, 'B04': red, 'B08': nir,
+        'B05': nir[::2, ::2], 'SCL': scl,
+        }
+
+
+def _write_band(path: str, array: np.ndarray, resolution: int) -> None:
+    array = array if array.ndim == 3 else array[np.newaxis]
+    with rio.open(path, 'w', driver='JP2OpenJPEG', width=array.shape[2], height=array.shape[1], count=array.shape[0],
+                  dtype=array.dtype, crs=CRS, transform=from_origin(*ORIGIN, resolution, resolution)) as band:
+        band.write(array)
+
+
+def make_safe_zip(path_to_dir: str, size: int = 1000, seed: int = 0, bands: tuple[str, ...] = BANDS_10M + BANDS_20M) -> str:
+    """Writes {TITLE}.zip with size x size 10 m JPEG 2000 bands to the directory. Returns the zip path.
+    Leaving 'SCL' out of `bands` gives a product without the scene classification."""
+    os.makedirs(path_to_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory() as path_to_tmp:
+        path_to_safe = f'{path_to_tmp}/{TITLE}.SAFE'
+        path_to_img_data = f'{path_to_safe}/GRANULE/L2A_{TILE}_A027337_{SENSING_TIME}/IMG_DATA'
+        for resolution in ('R10m', 'R20m', 'R60m'):
+            os.makedirs(f'{path_to_img_data}/{resolution}')
+        with open(f'{path_to_safe}/manifest.safe', 'w') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?><xfdu:XFDU xmlns:xfdu="urn:ccsds:schema:xfdu:1"/>')
+        with open(f'{path_to_safe}/MTD_MSIL2A.xml', 'w') as f:
+            f.write(f'<?xml version="1.0" encoding="UTF-8"?><PRODUCT_URI>{TITLE}.SAFE</PRODUCT_URI>')
+        for name, array in _make_bands(size, seed).items():
+            if name not in bands:
+                continue
+            resolution = 10 if name in BANDS_10M else 20
+            _write_band(f'{path_to_img_data}/R{resolution}m/{TILE}_{SENSING_TIME}_{name}_{resolution}m.jp2',
+                        array, resolution)
+        return shutil.make_archive(f'{path_to_dir}/{TITLE}', 'zip', path_to_tmp)
+
+
+def _to_lonlat(points: list[tuple[float, float]]) -> list[tuple[float, float]]:
+    transformer = Transformer.from_crs(CRS, 'EPSG:4326', always_xy=True)
+    return [transformer.transform(x, y) for x, y in points]
+
+
+def _box(col: int, row: int, width: int, height: int) -> list[tuple[float, float]]:
+    x0, y0 = ORIGIN[0] + col * 10, ORIGIN[1] - (row + height) * 10
+    x1, y1 = x0 + width * 10, y0 + height * 10
+    return _to_lonlat([(x0, y0), (x1, y0), (x1, y1), (x0, y1), (x0, y0)])
+
+
+def make_field(path_to_fields: str, field_name: str, col: int, row: int, width: int, height: int,
+               size: int = 1000) -> None:
+    """Creates the field directory with the field geojson (a width x height pixel box at col, row)
+    and the product geojson of the synthetic scene, as after /make-field and /download-sat-field-data."""
+    path_to_field = f'{path_to_fields}{field_name}'
+    os.makedirs(path_to_field, exist_ok=True)
+    field = geojson.Feature(geometry=geojson.Polygon([_box(col, row, width, height)]), properties={})
+    with open(f'{path_to_field}/{field_name}.geojson', 'w') as f:
+        geojson.dump(geojson.FeatureCollection([field]), f)
+    product = geojson.Feature(geometry=geojson.Polygon([_box(0, 0, size, size)]),
+                              properties={'title': TITLE, 'uuid': UUID, 'beginposition': '2022-06-08T08:45:59',
+                                          'cloudcoverpercentage': 3.5, 'processinglevel': 'Level-2A'})
+    with open(f'{path_to_field}/sat_field_{field_name}.geojson', 'w') as f:
+        geojson.dump(geojson.FeatureCollection([product]), f)
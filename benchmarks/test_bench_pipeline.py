@@ -0,0 +1,92 @@
+"""Raster pipeline and endpoints on the synthetic scene, for field sizes and concurrent requests.
+Save a baseline:    python -m pytest benchmarks --benchmark-storage=benchmarks/baselines --benchmark-save=baseline
+Catch regressions:  python -m pytest benchmarks --benchmark-storage=benchmarks/baselines --benchmark-compare
+                    --benchmark-compare-fail=mean:25%"""
+import asyncio
+import glob
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytest
+from conftest import CONCURRENT_FIELDS, FIELD_SIZES
+import unpacksatdata
+from converting import convert_ndvi_array_to_jpeg
+from makeimages import make_images_tiff, make_fields_images_tiff
+from synthetic import UUID
+
+pytest.importorskip('pytest_benchmark')
+
+
+@pytest.mark.parametrize('read_from_zip', [True, False])
+def test_bench_unzip_file(benchmark, synthetic_workdir, monkeypatch, read_from_zip):
+    monkeypatch.setattr(unpacksatdata, 'READ_BANDS_FROM_ZIP', read_from_zip)
+
+    def remove_unpacked_bands():
+        for path in glob.glob(f'fields/buffer/scenes/{UUID}/*.SAFE'):
+            shutil.rmtree(path)
+
+    name_unzip_file = benchmark.pedantic(lambda: asyncio.run(unpacksatdata.unzip_file('field_small')),
+                                         setup=remove_unpacked_bands, rounds=5)
+    assert name_unzip_file.endswith('.zip' if read_from_zip else '.SAFE')
+
+
+@pytest.mark.parametrize('field_size', FIELD_SIZES)
+def test_bench_make_images_tiff(benchmark, synthetic_workdir, field_size):
+    field_name = f'field_{field_size}'
+    name_unzip_file = asyncio.run(unpacksatdata.unzip_file(field_name))
+    message = benchmark.pedantic(lambda: asyncio.run(make_images_tiff(name_unzip_file, field_name)), rounds=3)
+    assert 'NDVI calculated' in message
+
+
+def test_bench_make_fields_images_tiff_batch(benchmark, synthetic_workdir):
+    field_names = [f'concurrent_{number}' for number in range(CONCURRENT_FIELDS)]
+    name_unzip_file = asyncio.run(unpacksatdata.unzip_file(field_names[0]))
+    results = benchmark.pedantic(lambda: asyncio.run(make_fields_images_tiff(name_unzip_file, field_names)), rounds=3)
+    assert not any(result['error'] for result in results.values())
+
+
+@pytest.mark.parametrize('field_size', FIELD_SIZES)
+def test_bench_convert_ndvi_array_to_jpeg(benchmark, tmp_path, field_size):
+    size = FIELD_SIZES[field_size]
+    rng = np.random.default_rng(0)
+    ndvi = np.ma.MaskedArray(rng.uniform(-1, 1, (1, size, size)).astype(np.float32), mask=False)
+    stats = benchmark(convert_ndvi_array_to_jpeg, f'{tmp_path}/', 'bench', ndvi)
+    assert stats['valid_pixels'] == size * size
+
+
+@pytest.fixture
+def client(synthetic_workdir):
+    from fastapi.testclient import TestClient
+    from server_api import app
+    with TestClient(app) as client:
+        yield client
+
+
+def run_field_images(client, field_name: str) -> dict:
+    """Runs /run-make-field-images and polls the job to the end, as a client does."""
+    status_url = client.post('/run-make-field-images', data={'field_name': field_name}).json()['status_url']
+    while True:
+        job = client.get(status_url).json()
+        if job['state'] in ('done', 'failed'):
+            return job
+        time.sleep(0.02)
+
+
+@pytest.mark.parametrize('field_size', FIELD_SIZES)
+def test_bench_endpoint_make_field_images(benchmark, client, field_size):
+    job = benchmark.pedantic(run_field_images, args=(client, f'field_{field_size}'), rounds=3)
+    assert job['state'] == 'done'
+    assert client.get('/ndvi-image', params={'field_name': f'field_{field_size}'}).status_code == 200
+
+
+@pytest.mark.parametrize('concurrency', [1, CONCURRENT_FIELDS])
+def test_bench_endpoint_concurrent_fields(benchmark, client, concurrency):
+    field_names = [f'concurrent_{number}' for number in range(concurrency)]
+
+    def run_fields():
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            return list(executor.map(lambda field_name: run_field_images(client, field_name), field_names))
+
+    jobs = benchmark.pedantic(run_fields, rounds=3)
+    assert all(job['state'] == 'done' for job in jobs)
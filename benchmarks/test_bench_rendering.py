@@ -0,0 +1,46 @@
+"""Fast renderer against the matplotlib renderer on the same field arrays.
+Run: python -m pytest benchmarks/test_bench_rendering.py --benchmark-group-by=param:size"""
+import numpy as np
+import pytest
+from rasterio.transform import from_origin
+from converting import make_field_image, make_ndvi_image, save_field_image, save_ndvi_image
+
+pytest.importorskip('pytest_benchmark')
+
+SIZES = [100, 400]
+
+
+def make_arrays(size: int) -> tuple[np.ma.MaskedArray, np.ma.MaskedArray]:
+    rng = np.random.default_rng(0)
+    mask = np.zeros((size, size), dtype=bool)
+    mask[:size // 4, :size // 4] = True
+    rgb = np.ma.MaskedArray(rng.integers(0, 255, (3, size, size), dtype=np.uint8), mask=np.broadcast_to(mask, (3, size, size)))
+    ndvi = np.ma.MaskedArray(rng.uniform(-1, 1, (1, size, size)).astype(np.float32), mask=mask[np.newaxis])
+    return rgb, ndvi
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_bench_fast_renderer(benchmark, tmp_path, size):
+    rgb, ndvi = make_arrays(size)
+    path_to_field_folder = f'{tmp_path}/'
+
+    def render():
+        save_field_image(path_to_field_folder, 'bench', rgb)
+        save_ndvi_image(path_to_field_folder, 'bench', ndvi, 0.5)
+
+    benchmark(render)
+    assert (tmp_path / 'bench_NDVI_10_field.png').exists()
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_bench_matplotlib_renderer(benchmark, tmp_path, size):
+    rgb, ndvi = make_arrays(size)
+    path_to_field_folder = f'{tmp_path}/'
+    transform = from_origin(400000, 6200000, 10, 10)
+
+    def render():
+        make_field_image(path_to_field_folder, 'bench', rgb, transform)
+        make_ndvi_image(path_to_field_folder, 'bench', ndvi, transform, 0.5)
+
+    benchmark.pedantic(render, rounds=3, iterations=1)
+    assert (tmp_path / 'bench_NDVI_10_field.png').exists()
@@ -0,0 +1,28 @@
+"""Start of an API worker: the import of server_api before a uvicorn worker serves its first request.
+The geospatial stack must not be imported: it is loaded by the endpoints that need it and by the pool workers."""
+import os
+import subprocess
+import sys
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+PATH_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ('geopandas', 'rasterio', 'matplotlib', 'sentinelsat', 'shapely', 'pandas', 'pyproj')
+IMPORT_SERVER_API = ('import resource, sys, server_api; '
+                     'print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, '
+                     f'*(m for m in {HEAVY_MODULES} if m in sys.modules))')
+
+
+def import_server_api(path_to_dir) -> list[str]:
+    """Imports server_api in a new interpreter. Returns its peak RSS in KiB and the heavy modules it loaded."""
+    env = {**os.environ, 'PYTHONPATH': PATH_ROOT}
+    result = subprocess.run([sys.executable, '-c', IMPORT_SERVER_API], cwd=path_to_dir, env=env,
+                            capture_output=True, text=True, check=True)
+    return result.stdout.split()
+
+
+def test_bench_import_server_api(benchmark, tmp_path):
+    peak_rss, *loaded_modules = benchmark.pedantic(import_server_api, args=(tmp_path,), rounds=5)
+    benchmark.extra_info['peak_rss_mb'] = round(int(peak_rss) / 1024, 1)
+    assert loaded_modules == []
@@ -0,0 +1,21 @@
+import os
+import shutil
+import tempfile
+import pytest
+
+# server_api adds its log file when it is imported: the logs of the test session go to a temporary
+# directory, not to logger/ of the repository
+_path_logs = tempfile.mkdtemp(prefix='agroapi-logs-')
+os.environ['AGROAPI_LOG_DIR'] = f'{_path_logs}/'
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(_path_logs, ignore_errors=True)
+
+
+@pytest.fixture(autouse=True)
+def storage_dir(tmp_path, monkeypatch):
+    """Runs every test in its own directory. The fields/, the job store and the scene cache of the
+    settings are relative to it, so the tests leave the repository clean."""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
@@ -1,86 +1,117 @@
-"""Convert raster images to JPEG and PNG formats, calculate NDVI."""
+"""Convert masked field arrays to JPEG and PNG images, calculate NDVI."""
+import functools
 import numpy as np
 from PIL import Image
-import rasterio as rio
-from matplotlib import pyplot as plt
-from rasterio.plot import show
+from affine import Affine
 import json
 from loguru import logger
+from metrics import timed
+from ndvistats import get_ndvi_stats, get_valid_values
+from rendering import render_ndvi_image, render_rgb_image, save_image
 
 
 URL = str
 
-def make_ndvi_file(path_to_field_folder: URL, field_name: str, middle_ndvi: float) -> None:
-    """Creates a json file and writes the NDVI data."""
+
+@functools.cache
+def get_pyplot():
+    """matplotlib.pyplot with the non-interactive Agg backend, imported once by the matplotlib renderer."""
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import pyplot
+    return pyplot
+
+
+def make_ndvi_file(path_to_field_folder: URL, field_name: str, ndvi_stats: dict, run_id: str = None,
+                   indices_stats: dict = None) -> None:
+    """Creates a json file and writes the NDVI data, the statistics of the other indices and the id of the processing run."""
     with open(f'{path_to_field_folder}{field_name}_NDVI.json', "w") as write_file:
         data = {
-            "ndvi_data": {
-                          "middle_ndvi": middle_ndvi,
-                            }
+            "ndvi_data": ndvi_stats,
+            "run_id": run_id,
                         }
+        if indices_stats:
+            data["indices"] = indices_stats
         json.dump(data, write_file)
-        logger.info(f'ndvi_file saved: {data}')
+        logger.info(f"ndvi_file saved: middle_ndvi {ndvi_stats['middle_ndvi']}, valid_pixels {ndvi_stats['valid_pixels']}")
 
 
-def convert_rgb_tiff_to_jpeg(path_to_field_folder: URL, field_name: str, path_to_rgb_masked_tiff: URL):
-    """Converts the raster image of the field to JPEG format."""
-    img = Image.open(path_to_rgb_masked_tiff)
-    img = img.convert("RGB")
+@timed('render_jpeg')
+def convert_rgb_array_to_jpeg(path_to_field_folder: URL, field_name: str, rgb: np.ma.MaskedArray):
+    """Converts the masked RGB array of the field to JPEG format."""
+    img = Image.fromarray(np.moveaxis(np.ma.asarray(rgb).filled(0)[:3], 0, -1))
     img.save(f'{path_to_field_folder}{field_name}_RGB_10_TCI_masked.jpeg')
     logger.info('RGB_10_TCI_masked.jpeg saved')
 
 
-def convert_ndvi_tiff_to_jpeg(path_to_field_folder: URL, field_name: str, path_to_ndvi_masked_tiff: URL) -> float:
-    """Converts the raster NDVI image to JPEG format. Calculates the average NDVI of field."""
+@timed('render_jpeg')
+def convert_ndvi_array_to_jpeg(path_to_field_folder: URL, field_name: str, ndvi: np.ma.MaskedArray, run_id: str = None,
+                               cloud_free_fraction: float = None, indices_stats: dict = None) -> dict:
+    """Converts the masked NDVI array of the field to JPEG format. Calculates the NDVI statistics of field."""
     path_to_ndvi_masked_jpeg = f'{path_to_field_folder}{field_name}_NDVI_10_masked.jpeg'
-    image = Image.open(path_to_ndvi_masked_tiff)
-    array_img = np.asarray(image)
-    array_wuthout_null = array_img[array_img != 0]
-    middle_array_img = round(float(np.nanmean(array_wuthout_null)), 2)
-    min_array_img = np.nanmin(array_wuthout_null)
-    max_array_img = np.nanmax(array_wuthout_null)
-    array_img_new = np.uint8(np.interp(array_img, (min_array_img, max_array_img), (0, 255)))
-    middle_array_img_new = np.nanmean(array_img_new)
-    logger.info(f'middle_array_img_new: {middle_array_img_new}')
-    logger.info(f'NDVI: min: {min_array_img}, max: {max_array_img}, middle: {middle_array_img}')
+    ndvi_stats = get_ndvi_stats(ndvi, cloud_free_fraction)
+    values = get_valid_values(ndvi)
+    array_img = np.ma.masked_invalid(ndvi[0] if ndvi.ndim == 3 else ndvi)
+    if values.size:
+        array_img_new = np.interp(array_img.filled(values.min()), (values.min(), values.max()), (0, 255))
+    else:
+        array_img_new = np.zeros(array_img.shape)
+    array_img_new = np.uint8(np.where(np.ma.getmaskarray(array_img), 0, array_img_new))
+    logger.info(f"NDVI: median: {ndvi_stats['median']}, std: {ndvi_stats['std']}, middle: {ndvi_stats['middle_ndvi']}")
     im = Image.fromarray(array_img_new)
     im.save(path_to_ndvi_masked_jpeg)
     logger.info('NDVI_10_masked.jpeg saved')
-    make_ndvi_file(path_to_field_folder, field_name, middle_array_img)   
-    return middle_array_img
-
-
-def make_field_image(path_to_field_folder: URL, field_name: str) -> None:
-    """Makes field image PNG from raster image"""
-    with rio.open(f'{path_to_field_folder}{field_name}_RGB_10_TCI_masked.tiff') as img:
-        plt.figure(figsize=(1.6, 1.2))
-        plt.ticklabel_format(style='plain')
-        show(img.read(), transform=img.transform, title=f'Field: "{field_name}"') 
-        plt.yticks(fontsize=3,)
-        plt.xticks(fontsize=3,)
-        plt.title(f'Field: "{field_name}"', fontdict ={'fontsize': 4}, pad=6)
-        plt.savefig(f'{path_to_field_folder}{field_name}_RGB_10_TCI_field.png' , dpi=300, bbox_inches='tight')
-        logger.info('RGB_10_TCI_field.png saved')
-
-
-def make_ndvi_image(path_to_field_folder: URL, field_name: str, middle_ndvi: float):
-    """Makes NDVI image PNG from raster image"""
-    with rio.open(f'{path_to_field_folder}{field_name}_NDVI_10_masked.tiff') as img:
-
-        plt.figure(figsize=(1.6, 1.2))
-        plt.ticklabel_format(style='plain')
-        im = plt.imshow(img.read(1), cmap='RdYlGn')
-        show(img.read(1), transform=img.transform, cmap='RdYlGn') 
-        # show(img.read(1), transform=img.transform, cmap='RdYlGn', title=f'Field: "{field_name}"') 
-        plt.yticks(fontsize=3,)
-        plt.xticks(fontsize=3,)
-        plt.title(f'Field: "{field_name}", middle NDVI: {middle_ndvi}', fontdict ={'fontsize': 4}, pad=6)
-
-        cb = plt.colorbar(im)
-        for t in cb.ax.get_yticklabels():
-            t.set_fontsize(3)
-
-        cb.set_label('NDVI', fontsize=4)
-        plt.savefig(f'{path_to_field_folder}{field_name}_NDVI_10_field.png' , dpi=300, bbox_inches='tight')
-        logger.info('NDVI_10_field.png saved')
+    make_ndvi_file(path_to_field_folder, field_name, ndvi_stats, run_id, indices_stats)
+    return ndvi_stats
+
+
+@timed('render_png')
+def make_field_image(path_to_field_folder: URL, field_name: str, rgb: np.ma.MaskedArray, transform: Affine) -> None:
+    """Makes field image PNG from the masked array with matplotlib"""
+    plt = get_pyplot()
+    from rasterio.plot import show
+    fig = plt.figure(figsize=(1.6, 1.2))
+    plt.ticklabel_format(style='plain')
+    show(np.ma.asarray(rgb).filled(0), transform=transform, title=f'Field: "{field_name}"') 
+    plt.yticks(fontsize=3,)
+    plt.xticks(fontsize=3,)
+    plt.title(f'Field: "{field_name}"', fontdict ={'fontsize': 4}, pad=6)
+    plt.savefig(f'{path_to_field_folder}{field_name}_RGB_10_TCI_field.png' , dpi=300, bbox_inches='tight')
+    plt.close(fig)
+    logger.info('RGB_10_TCI_field.png saved')
+
+
+@timed('render_png')
+def make_ndvi_image(path_to_field_folder: URL, field_name: str, ndvi: np.ma.MaskedArray, transform: Affine, middle_ndvi: float):
+    """Makes NDVI image PNG from the masked array with matplotlib"""
+    plt = get_pyplot()
+    from rasterio.plot import show
+    fig = plt.figure(figsize=(1.6, 1.2))
+    plt.ticklabel_format(style='plain')
+    ax = show(np.ma.asarray(ndvi)[0].filled(np.nan), transform=transform, cmap='RdYlGn') 
+    plt.yticks(fontsize=3,)
+    plt.xticks(fontsize=3,)
+    plt.title(f'Field: "{field_name}", middle NDVI: {middle_ndvi}', fontdict ={'fontsize': 4}, pad=6)
+
+    cb = plt.colorbar(ax.get_images()[0])
+    for t in cb.ax.get_yticklabels():
+        t.set_fontsize(3)
+
+    cb.set_label('NDVI', fontsize=4)
+    plt.savefig(f'{path_to_field_folder}{field_name}_NDVI_10_field.png' , dpi=300, bbox_inches='tight')
+    plt.close(fig)
+    logger.info('NDVI_10_field.png saved')
+
+
+@timed('render_png')
+def save_field_image(path_to_field_folder: URL, field_name: str, rgb: np.ma.MaskedArray) -> None:
+    """Makes field image PNG from the masked array with the fast renderer."""
+    image = render_rgb_image(rgb, f'Field: "{field_name}"')
+    save_image(image, f'{path_to_field_folder}{field_name}_RGB_10_TCI_field.png')
+
 
+@timed('render_png')
+def save_ndvi_image(path_to_field_folder: URL, field_name: str, ndvi: np.ma.MaskedArray, middle_ndvi: float) -> None:
+    """Makes NDVI image PNG with a colorbar strip from the masked array with the fast renderer."""
+    image = render_ndvi_image(ndvi, f'Field: "{field_name}", middle NDVI: {middle_ndvi}')
+    save_image(image, f'{path_to_field_folder}{field_name}_NDVI_10_field.png')
@@ -0,0 +1,144 @@
+"""Download manager: authenticated sessions reused per user, parallel resumable downloads with checksums."""
+import asyncio
+import functools
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+import requests
+from loguru import logger
+from settings import (DOWNLOAD_WORKERS, DOWNLOAD_PER_HOST_LIMIT, DOWNLOAD_CHUNK_SIZE, DOWNLOAD_RETRIES,
+                      DOWNLOAD_TIMEOUT, DOWNLOAD_SESSION_TTL)
+
+
+URL = str
+
+_executor = None
+_host_semaphores: dict[str, threading.BoundedSemaphore] = {}
+_sessions: dict[tuple[str, str], tuple[object, float]] = {}
+_lock = threading.Lock()
+
+
+class ChecksumError(Exception):
+    """The downloaded file does not match the checksum of the server."""
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """Creates the download thread pool on first use."""
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix='download')
+            logger.info(f'Download pool started: {DOWNLOAD_WORKERS} workers')
+    return _executor
+
+
+def shutdown_downloads() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+    with _lock:
+        for session, _ in _sessions.values():
+            _close_session(session)
+        _sessions.clear()
+
+
+async def run_in_download_pool(func, *args, **kwargs):
+    """Runs a blocking network call in the download pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), functools.partial(func, *args, **kwargs))
+
+
+def _close_session(session) -> None:
+    getattr(session, 'session', session).close()
+
+
+def get_session(username: str, password: str, make_session):
+    """Returns the authenticated session of the user, made by make_session() at most once per
+    DOWNLOAD_SESSION_TTL seconds. The password is kept only as a hash in the key."""
+    key = (username, hashlib.sha256(password.encode()).hexdigest())
+    now = time.monotonic()
+    with _lock:
+        for cached_key, (session, created) in list(_sessions.items()):
+            if now - created > DOWNLOAD_SESSION_TTL:
+                _close_session(session)
+                del _sessions[cached_key]
+        if key in _sessions:
+            return _sessions[key][0]
+    session = make_session()
+    with _lock:
+        _sessions.setdefault(key, (session, now))
+        return _sessions[key][0]
+
+
+def _get_host_semaphore(url: URL) -> threading.BoundedSemaphore:
+    host = urlparse(url).netloc
+    with _lock:
+        if host not in _host_semaphores:
+            _host_semaphores[host] = threading.BoundedSemaphore(DOWNLOAD_PER_HOST_LIMIT)
+        return _host_semaphores[host]
+
+
+def get_file_checksum(path: URL, algorithm: str = 'md5') -> str:
+    hash_file = hashlib.new(algorithm.replace('-', '_'))
+    with open(path, 'rb') as f:
+        while chunk := f.read(DOWNLOAD_CHUNK_SIZE):
+            hash_file.update(chunk)
+    return hash_file.hexdigest()
+
+
+def _download_part(session: requests.Session, url: URL, path_part: URL) -> None:
+    """Downloads the rest of the file, starting from the end of the partial file."""
+    offset = os.path.getsize(path_part) if os.path.exists(path_part) else 0
+    headers = {'Range': f'bytes={offset}-'} if offset else {}
+    with session.get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+        if response.status_code == 416 and offset:
+            return
+        response.raise_for_status()
+        mode = 'ab' if response.status_code == 206 else 'wb'
+        if offset:
+            logger.info(f'{os.path.basename(path_part)}: ' +
+                        (f'resumed at {offset} bytes' if mode == 'ab' else 'the server does not resume, restarted'))
+        with open(path_part, mode) as f:
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+
+
+def download_file(session: requests.Session, url: URL, path: URL, checksum: str = None,
+                  algorithm: str = 'md5', size: int = None) -> URL:
+    """Downloads the file to path. The data is written to path.incomplete first, so a download
+    interrupted by a crash or a network error continues from where it stopped. The checksum
+    and size are checked before the file is renamed to path."""
+    if os.path.exists(path):
+        return path
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    path_part = f'{path}.incomplete'
+    with _get_host_semaphore(url):
+        for attempt in range(1, DOWNLOAD_RETRIES + 1):
+            try:
+                _download_part(session, url, path_part)
+                break
+            except requests.RequestException as ex:
+                logger.info(f'{os.path.basename(path)}: attempt {attempt} failed: {ex}')
+                if attempt == DOWNLOAD_RETRIES:
+                    raise
+                time.sleep(attempt)
+    downloaded_size = os.path.getsize(path_part)
+    if size is not None and downloaded_size != size:
+        os.remove(path_part)
+        raise ChecksumError(f'{os.path.basename(path)}: {downloaded_size} bytes instead of {size}')
+    if checksum is not None and get_file_checksum(path_part, algorithm) != checksum.lower():
+        os.remove(path_part)
+        raise ChecksumError(f'{os.path.basename(path)}: {algorithm} checksum does not match')
+    os.replace(path_part, path)
+    logger.info(f'{os.path.basename(path)} downloaded')
+    return path
+
+
+async def download_files(session: requests.Session, downloads: list[dict]) -> list[URL]:
+    """Downloads the files in parallel. Every item has the download_file arguments: url, path,
+    and optionally checksum, algorithm and size."""
+    return await asyncio.gather(*(run_in_download_pool(download_file, session, **download) for download in downloads))
@@ -0,0 +1,90 @@
+"""Cache of the field geometries: the geojson is parsed once, reprojected once per raster CRS,
+and the pixel window is computed once per band grid. Entries are keyed by the geojson version, so a re-uploaded
+field replaces its cached data and a deleted field is only dropped when it is the least recently used."""
+import math
+import os
+import threading
+from collections import OrderedDict
+import geopandas as gpd
+import rasterio as rio
+from rasterio.windows import Window, from_bounds
+from settings import PATH_FIELDS, WINDOW_MARGIN, FIELD_GEOMETRY_CACHE_SIZE
+
+
+URL = str
+
+_lock = threading.Lock()
+_sources: OrderedDict[str, tuple[tuple, gpd.GeoDataFrame]] = OrderedDict()
+_geometries: OrderedDict[tuple[str, str], tuple[tuple, gpd.GeoDataFrame]] = OrderedDict()
+_windows: OrderedDict[tuple, tuple[tuple, Window]] = OrderedDict()
+
+
+def _get_cached(cache: OrderedDict, key, version: tuple):
+    """The cached value of the geojson version, or None."""
+    with _lock:
+        cached = cache.get(key)
+        if cached is None or cached[0] != version:
+            return None
+        cache.move_to_end(key)
+        return cached[1]
+
+
+def _put_cached(cache: OrderedDict, key, version: tuple, value) -> None:
+    """Stores the value, the least recently used entries over FIELD_GEOMETRY_CACHE_SIZE are dropped."""
+    with _lock:
+        cache[key] = (version, value)
+        cache.move_to_end(key)
+        while len(cache) > FIELD_GEOMETRY_CACHE_SIZE:
+            cache.popitem(last=False)
+
+
+def _get_path(field_name: str) -> URL:
+    return f'{PATH_FIELDS}{field_name}/{field_name}.geojson'
+
+
+def _get_version(field_name: str) -> tuple[int, int]:
+    """Modification time and size of the field geojson: they change when the field is uploaded again."""
+    stat_result = os.stat(_get_path(field_name))
+    return stat_result.st_mtime_ns, stat_result.st_size
+
+
+def get_field_geometry(field_name: str, crs: rio.crs.CRS) -> gpd.GeoDataFrame:
+    """The field geometry in the CRS of the raster."""
+    version = _get_version(field_name)
+    key = (field_name, crs.to_string())
+    field_data = _get_cached(_geometries, key, version)
+    if field_data is not None:
+        return field_data
+    source = _get_cached(_sources, field_name, version)
+    if source is None:
+        source = gpd.read_file(_get_path(field_name))
+        _put_cached(_sources, field_name, version, source)
+    field_data = source.to_crs(crs.to_wkt())
+    _put_cached(_geometries, key, version, field_data)
+    return field_data
+
+
+def get_field_window(band: rio.DatasetReader, field_data: gpd.geodataframe.GeoDataFrame) -> Window:
+    """Pixel window of the band covering the field bounds plus WINDOW_MARGIN pixels."""
+    left, bottom, right, top = field_data.total_bounds
+    window = from_bounds(left, bottom, right, top, transform=band.transform)
+    col_off = max(math.floor(window.col_off) - WINDOW_MARGIN, 0)
+    row_off = max(math.floor(window.row_off) - WINDOW_MARGIN, 0)
+    col_end = min(math.ceil(window.col_off + window.width) + WINDOW_MARGIN, band.width)
+    row_end = min(math.ceil(window.row_off + window.height) + WINDOW_MARGIN, band.height)
+    if col_end <= col_off or row_end <= row_off:
+        raise ValueError('Input shapes do not overlap raster.')
+    return Window(col_off, row_off, col_end - col_off, row_end - row_off)
+
+
+def get_field_pixel_window(field_name: str, band: rio.DatasetReader) -> Window:
+    """Window of the field on the band grid (CRS, transform and size), computed once per grid."""
+    version = _get_version(field_name)
+    key = (field_name, band.crs.to_string(), tuple(band.transform), band.width, band.height)
+    window = _get_cached(_windows, key, version)
+    if window is not None:
+        return window
+    window = get_field_window(band, get_field_geometry(field_name, band.crs))
+    _put_cached(_windows, key, version, window)
+    return window
+
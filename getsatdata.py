@@ -3,16 +3,47 @@ from fastapi import HTTPException
 from sentinelsat import SentinelAPI, read_geojson, geojson_to_wkt, exceptions
 from loguru import logger
 import geojson
-from settings import PATH_API, PATH_FIELDS, PATH_BUFFER
-
-
-
-async def _download_sat_jpeg(api: SentinelAPI, id_product: str, field_name: str) -> None:
-    api.download_quicklook(id_product, f'{PATH_FIELDS}{field_name}/')
-
-
-async def _download_data_from_sat(api: SentinelAPI, field_name: str, products_from_sat: dict[str, dict]) -> None:
-    api.download_all(products_from_sat, directory_path=f'{PATH_BUFFER}sat_field_{field_name}')
+from jobs import set_stage
+from metrics import timed
+from downloads import download_file, download_files, get_session, run_in_download_pool
+from scenecache import get_scene_dir, is_scene_cached, register_scene, use_scene
+from querycache import make_query_key, get_cached_products, cache_products
+from settings import (PATH_API, PATH_FIELDS, QUERY_DATE, QUERY_PLATFORM, QUERY_PROCESSING_LEVEL, QUERY_CLOUD_COVER,
+                      QUERY_LIMIT)
+
+
+
+async def _get_product_info(api: SentinelAPI, id_product: str) -> dict:
+    product_info = await run_in_download_pool(api.get_product_odata, id_product)
+    if not product_info['Online']:
+        await run_in_download_pool(api.trigger_offline_retrieval, id_product)
+        raise HTTPException(status_code=503, detail=f"The product {product_info['title']} is in the long term archive. It is requested, try again later.")
+    return product_info
+
+
+async def _download_sat_jpeg(api: SentinelAPI, product_info: dict, field_name: str) -> None:
+    await run_in_download_pool(download_file, api.session, product_info['quicklook_url'],
+                               f"{PATH_FIELDS}{field_name}/{product_info['title']}.jpeg")
+
+
+async def _download_data_from_sat(api: SentinelAPI, products_from_sat: dict[str, dict]) -> dict[str, dict]:
+    """Downloads the products in parallel in the download pool, each into its scene directory.
+    Returns the product info of every product."""
+    downloads = []
+    products_info = {}
+    for product_id in products_from_sat:
+        product_info = await _get_product_info(api, product_id)
+        products_info[product_id] = product_info
+        algorithm = 'sha3-256' if 'sha3-256' in product_info else 'md5'
+        downloads.append({
+            'url': product_info['url'],
+            'path': f"{get_scene_dir(product_id)}{product_info['title']}.zip",
+            'checksum': product_info.get(algorithm),
+            'algorithm': algorithm,
+            'size': product_info['size'],
+            })
+    await download_files(api.session, downloads)
+    return products_info
 
 
 async def _get_id_product(product_geojson: geojson) -> str:
@@ -32,32 +63,44 @@ async def _get_product_geojson(api: SentinelAPI, products_from_sat: dict[str, di
     return product_geojson
 
 
-async def _get_products_from_sat(api: SentinelAPI, path_file_geojson: str) -> dict[str, dict]:
+@timed('search')
+async def _get_products_from_sat(api: SentinelAPI, path_file_geojson: str, **query_params) -> dict[str, dict]:
     footprint = geojson_to_wkt(read_geojson(path_file_geojson))
-    try:
-        products_from_sat = api.query(footprint,
-                            date=('20220415','20220615'), platformname='Sentinel-2',
-                            order_by='cloudcoverpercentage',
-                            processinglevel='Level-2A',
-                            cloudcoverpercentage=(0, 10),
-                            limit=1)
-
+    query = dict(date=QUERY_DATE, platformname=QUERY_PLATFORM,
+                 order_by='cloudcoverpercentage',
+                 processinglevel=QUERY_PROCESSING_LEVEL,
+                 cloudcoverpercentage=QUERY_CLOUD_COVER,
+                 limit=QUERY_LIMIT)
+    query.update(query_params)
+    query_key = make_query_key(footprint, **query)
+    products_from_sat = get_cached_products(query_key)
+    if products_from_sat is not None:
+        logger.info(f'Search result found in cache: {len(products_from_sat)} products')
         return products_from_sat
-   
+    try:
+        products_from_sat = await run_in_download_pool(api.query, footprint, **query)
     except exceptions.UnauthorizedError as ex:
         logger.info(f'{ex}')
         raise HTTPException(status_code=500, detail='Incorrect user name or password. Try again.')
+    cache_products(query_key, products_from_sat)
+    return products_from_sat
 
 
-def _get_api(username: str, password: str) -> SentinelAPI:
+def _make_api(username: str, password: str) -> SentinelAPI:
     api = SentinelAPI(username, password, PATH_API)
     logger.info('API connected')
     return api
 
 
-async def get_data(field_name: str, username:str, password: str) -> str:
+def _get_api(username: str, password: str) -> SentinelAPI:
+    return get_session(username, password, lambda: _make_api(username, password))
+
+
+@timed('sat_data')
+async def get_data(field_name: str, username:str, password: str, job_id: str = None) -> str:
     """Connects to SentinelAPI and receives data from the satellite."""
     path_file_geojson=f'{PATH_FIELDS}{field_name}/{field_name}.geojson'
+    set_stage(job_id, 'search')
     api = _get_api(username, password)
     products_from_sat = await _get_products_from_sat(api, path_file_geojson)
 
@@ -67,10 +110,40 @@ async def get_data(field_name: str, username:str, password: str) -> str:
     id_product = await _get_id_product(product_geojson)
     logger.info(f'id_product:{id_product}')
     
-    await _download_data_from_sat(api, field_name, products_from_sat)
-    await _download_sat_jpeg(api, id_product, field_name)
+    product_info = await download_scene(api, id_product, products_from_sat, job_id)
+    set_stage(job_id, 'quicklook')
+    if product_info is None:
+        product_info = await run_in_download_pool(api.get_product_odata, id_product)
+    await _download_sat_jpeg(api, product_info, field_name)
     logger.info('The data from the satellite is downloaded')
     return "The data from the satellite is downloaded."
     
 
-       
\ No newline at end of file
+       
+
+@timed('download')
+async def download_scene(api: SentinelAPI, id_product: str, products_from_sat: dict[str, dict],
+                         job_id: str = None) -> dict | None:
+    """Downloads the scene into the scene cache, unless it is cached already.
+    Returns the product info fetched for the download, None for a cached scene."""
+    title_product = products_from_sat[id_product]['title']
+    with use_scene(id_product):
+        if is_scene_cached(id_product, title_product):
+            logger.info(f'Scene {id_product} found in cache')
+        else:
+            set_stage(job_id, 'download')
+            products_info = await _download_data_from_sat(api, {id_product: products_from_sat[id_product]})
+            register_scene(id_product, title_product)
+            return products_info[id_product]
+    return None
+
+
+async def get_series_products(field_name: str, username: str, password: str, date_from: str, date_to: str,
+                              max_cloud: float) -> tuple[SentinelAPI, dict[str, dict]]:
+    """Searches all the products over the field in the date range with cloud cover up to max_cloud."""
+    api = _get_api(username, password)
+    products_from_sat = await _get_products_from_sat(api, f'{PATH_FIELDS}{field_name}/{field_name}.geojson',
+                                                     date=(date_from, date_to), cloudcoverpercentage=(0, max_cloud),
+                                                     order_by='beginposition', limit=None)
+    logger.info(f'{field_name}: {len(products_from_sat)} products from {date_from} to {date_to}')
+    return api, products_from_sat
@@ -0,0 +1,133 @@
+"""Streaming uploads and cacheable file responses with ETag, conditional GET and Range support."""
+import hashlib
+import os
+import anyio
+from email.utils import formatdate, parsedate_to_datetime
+from fastapi import HTTPException, Request, UploadFile
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from loguru import logger
+from settings import MAX_UPLOAD_BYTES, UPLOAD_CHUNK_SIZE
+
+
+URL = str
+
+RANGE_CHUNK_SIZE = 64 * 1024
+
+
+def check_upload_size(request: Request) -> None:
+    """Rejects the upload before reading it if the declared body is too large."""
+    content_length = request.headers.get('content-length')
+    if content_length and content_length.isdigit() and int(content_length) > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f'The file is larger than {MAX_UPLOAD_BYTES} bytes.')
+
+
+async def save_upload(file: UploadFile, path: URL) -> int:
+    """Writes the uploaded file to disk in chunks. Returns its size.
+    The partly written file is deleted if it is larger than MAX_UPLOAD_BYTES."""
+    size = 0
+    with open(path, 'wb') as f:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            if size > MAX_UPLOAD_BYTES:
+                break
+            f.write(chunk)
+    if size > MAX_UPLOAD_BYTES:
+        os.remove(path)
+        raise HTTPException(status_code=413, detail=f'The file is larger than {MAX_UPLOAD_BYTES} bytes.')
+    return size
+
+
+async def read_upload(file: UploadFile) -> bytes:
+    """Reads the uploaded file in chunks, at most MAX_UPLOAD_BYTES."""
+    chunks = []
+    size = 0
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        size += len(chunk)
+        if size > MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail=f'The file is larger than {MAX_UPLOAD_BYTES} bytes.')
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+def make_etag(stat_result: os.stat_result, run_id: str = None) -> str:
+    """Strong ETag of the file version: the processing run that wrote it, its size and mtime."""
+    version = f'{run_id}:{stat_result.st_size}:{stat_result.st_mtime_ns}'
+    return '"' + hashlib.sha1(version.encode()).hexdigest()[:32] + '"'
+
+
+def is_not_modified(request: Request, etag: str, stat_result: os.stat_result) -> bool:
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+        return '*' in tags or etag in tags
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since:
+        try:
+            return int(stat_result.st_mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def _parse_range(range_header: str, size: int) -> tuple[int, int] | None:
+    """First byte and last byte of a single 'bytes=' range, or None if it is not satisfiable."""
+    unit, _, value = range_header.partition('=')
+    if unit.strip() != 'bytes' or ',' in value:
+        return None
+    start, _, end = value.strip().partition('-')
+    try:
+        if start == '':
+            length = int(end)
+            if length <= 0:
+                return None
+            return max(size - length, 0), size - 1
+        first, last = int(start), int(end) if end else size - 1
+    except ValueError:
+        return None
+    if first > last or first >= size:
+        return None
+    return first, min(last, size - 1)
+
+
+async def _read_range(path: URL, first: int, last: int):
+    async with await anyio.open_file(path, mode='rb') as f:
+        await f.seek(first)
+        remaining = last - first + 1
+        while remaining > 0:
+            chunk = await f.read(min(RANGE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def file_response(request: Request, path: URL, cache_control: str, run_id: str = None) -> Response:
+    """Serves the file with ETag, Last-Modified and Cache-Control headers.
+    Answers 304 to conditional requests for the current version and 206 to a single byte range."""
+    try:
+        stat_result = os.stat(path)
+    except (FileNotFoundError, NotADirectoryError, TypeError):
+        raise HTTPException(status_code=404, detail=f"'{os.path.basename(str(path))}' not found")
+    etag = make_etag(stat_result, run_id)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': formatdate(stat_result.st_mtime, usegmt=True),
+        'Cache-Control': cache_control,
+        'Accept-Ranges': 'bytes',
+        }
+    if is_not_modified(request, etag, stat_result):
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get('range')
+    if_range = request.headers.get('if-range')
+    if range_header and (if_range is None or if_range == etag):
+        byte_range = _parse_range(range_header, stat_result.st_size)
+        if byte_range is None:
+            return Response(status_code=416, headers={**headers, 'Content-Range': f'bytes */{stat_result.st_size}'})
+        first, last = byte_range
+        logger.info(f'{path}: bytes {first}-{last}')
+        headers.update({'Content-Range': f'bytes {first}-{last}/{stat_result.st_size}',
+                        'Content-Length': str(last - first + 1)})
+        media_type = FileResponse(path).media_type
+        return StreamingResponse(_read_range(path, first, last), status_code=206, headers=headers, media_type=media_type)
+    return FileResponse(path, headers=headers, stat_result=stat_result, method=request.method)
@@ -0,0 +1,115 @@
+"""LRU cache of encoded images (map tiles, resized variants) in memory and in files on disk.
+Memory is bounded by bytes for the process, disk by bytes for every cache directory, e.g. the tiles/ of a field."""
+import os
+import threading
+from collections import OrderedDict
+from metrics import inc
+
+
+URL = str
+
+
+class ImageCache:
+    """Images are looked up in memory, then in the file, then rendered. `persist` says if a rendered
+    image is worth a file, e.g. not the shared empty tile."""
+
+    def __init__(self, metric: str, max_memory_bytes: int, max_disk_bytes: int, persist=None):
+        self.metric = metric
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.persist = persist or (lambda image: True)
+        self._lock = threading.Lock()
+        self._images: OrderedDict[tuple, bytes] = OrderedDict()
+        self._memory_bytes = 0
+        # files of every cache directory with their sizes, least recently used first, and the total size
+        self._dirs: dict[URL, tuple[OrderedDict[URL, int], list[int]]] = {}
+
+    def _get_memory(self, key: tuple) -> bytes | None:
+        with self._lock:
+            image = self._images.get(key)
+            if image is not None:
+                self._images.move_to_end(key)
+            return image
+
+    def _put_memory(self, key: tuple, image: bytes) -> None:
+        if len(image) > self.max_memory_bytes:
+            return
+        with self._lock:
+            if key in self._images:
+                self._memory_bytes -= len(self._images.pop(key))
+            self._images[key] = image
+            self._memory_bytes += len(image)
+            while self._memory_bytes > self.max_memory_bytes:
+                _, dropped = self._images.popitem(last=False)
+                self._memory_bytes -= len(dropped)
+
+    def _get_dir(self, path_dir: URL) -> tuple[OrderedDict[URL, int], list[int]]:
+        """Index of the files in the directory, read from disk on first use, oldest first."""
+        if path_dir not in self._dirs:
+            files = []
+            for root, _, names in os.walk(path_dir):
+                for name in names:
+                    try:
+                        stat_result = os.stat(os.path.join(root, name))
+                    except FileNotFoundError:
+                        continue
+                    files.append((stat_result.st_mtime_ns, os.path.join(root, name), stat_result.st_size))
+            index = OrderedDict((path, size) for _, path, size in sorted(files))
+            self._dirs[path_dir] = (index, [sum(index.values())])
+        return self._dirs[path_dir]
+
+    def _read_file(self, path_dir: URL, path: URL) -> bytes | None:
+        try:
+            with open(path, 'rb') as f:
+                image = f.read()
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            index, _ = self._get_dir(path_dir)
+            if path in index:
+                index.move_to_end(path)
+        return image
+
+    def _write_file(self, path_dir: URL, path: URL, image: bytes) -> None:
+        if len(image) > self.max_disk_bytes:
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        path_tmp = f'{path}.{threading.get_ident()}.tmp'
+        with open(path_tmp, 'wb') as f:
+            f.write(image)
+        os.replace(path_tmp, path)
+        with self._lock:
+            index, total = self._get_dir(path_dir)
+            total[0] += len(image) - index.pop(path, 0)
+            index[path] = len(image)
+            while total[0] > self.max_disk_bytes:
+                dropped, size = index.popitem(last=False)
+                total[0] -= size
+                try:
+                    os.remove(dropped)
+                except FileNotFoundError:
+                    pass
+
+    def get(self, key: tuple, render, path_dir: URL = None, name: str = None) -> bytes:
+        """The image from memory, from the file `name` in the cache directory or made by `render()`.
+        Without a directory the image is only kept in memory."""
+        image = self._get_memory(key)
+        if image is not None:
+            inc(self.metric, cache='memory')
+            return image
+        path = None if path_dir is None else f'{path_dir}{name}'
+        image = None if path is None else self._read_file(path_dir, path)
+        if image is not None:
+            inc(self.metric, cache='disk')
+        else:
+            image = render()
+            if path is not None and self.persist(image):
+                self._write_file(path_dir, path, image)
+            inc(self.metric, cache='miss')
+        self._put_memory(key, image)
+        return image
+
+    def forget_dir(self, path_dir: URL) -> None:
+        """Drops the index of the directory after it was deleted."""
+        with self._lock:
+            self._dirs.pop(path_dir, None)
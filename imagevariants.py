@@ -0,0 +1,106 @@
+"""Field and NDVI images resized and encoded as PNG, JPEG or WebP for the client. Encoded variants are
+kept in an LRU cache bounded by bytes in memory, the preset variants also on disk. They are made after the processing."""
+import os
+import shutil
+from email.utils import formatdate
+import anyio.to_thread
+from fastapi import HTTPException, Request
+from fastapi.responses import Response
+from PIL import Image
+from loguru import logger
+from httpfiles import make_etag, is_not_modified
+from imagecache import ImageCache
+from metrics import timed
+from rendering import encode_image
+from settings import (PATH_FIELDS, IMAGE_VARIANT_WIDTHS, IMAGE_VARIANT_FORMATS, IMAGE_MAX_WIDTH, IMAGE_QUALITY,
+                      IMAGE_CACHE_MAX_BYTES, IMAGE_DISK_CACHE_MAX_BYTES, CACHE_CONTROL_IMAGES)
+
+
+URL = str
+
+IMAGES = {
+    'field': '_RGB_10_TCI_field.png',
+    'ndvi': '_NDVI_10_field.png',
+    'field_jpeg': '_RGB_10_TCI_masked.jpeg',
+    }
+IMAGE_FORMATS = {
+    'png': 'image/png',
+    'jpeg': 'image/jpeg',
+    'webp': 'image/webp',
+    }
+
+_cache = ImageCache('agroapi_image_variant_total', IMAGE_CACHE_MAX_BYTES, IMAGE_DISK_CACHE_MAX_BYTES)
+
+
+def get_image_path(field_name: str, image: str) -> URL:
+    return f'{PATH_FIELDS}{field_name}/{field_name}{IMAGES[image]}'
+
+
+def get_variants_dir(field_name: str) -> URL:
+    return f'{PATH_FIELDS}{field_name}/variants/'
+
+
+@timed('render_variant')
+def render_variant(path: URL, width: int, image_format: str) -> bytes:
+    """The image scaled down to `width` (never up) with area averaging and encoded in the format."""
+    with Image.open(path) as image:
+        height = max(1, round(image.height * width / image.width))
+        if width < image.width:
+            # JPEG is decoded at the nearest larger 1/2, 1/4 or 1/8 scale
+            image.draft(image.mode, (width, height))
+            image = image.resize((width, height), Image.BOX)
+        else:
+            image.load()
+        return encode_image(image, image_format, IMAGE_QUALITY)
+
+
+def get_variant(field_name: str, image: str, width: int, image_format: str, stat_result: os.stat_result,
+                run_id: str = None) -> bytes:
+    """Encoded variant from the memory cache, the disk cache or made from the image. Only the preset
+    IMAGE_VARIANT_WIDTHS x IMAGE_VARIANT_FORMATS variants are stored on disk, other widths stay in memory.
+    Variants are keyed by the version of the image, so variants of an older processing run are never served."""
+    version = stat_result.st_mtime_ns
+    key = (field_name, image, run_id, version, width, image_format)
+    is_preset = width in IMAGE_VARIANT_WIDTHS and image_format in IMAGE_VARIANT_FORMATS
+    return _cache.get(key, lambda: render_variant(get_image_path(field_name, image), width, image_format),
+                      get_variants_dir(field_name) if is_preset else None, f'{image}/{version}/{width}.{image_format}')
+
+
+def make_image_variants(field_name: str) -> None:
+    """Makes the IMAGE_VARIANT_WIDTHS x IMAGE_VARIANT_FORMATS variants of the new images of the field on disk."""
+    shutil.rmtree(get_variants_dir(field_name), ignore_errors=True)
+    _cache.forget_dir(get_variants_dir(field_name))
+    for image in IMAGES:
+        try:
+            stat_result = os.stat(get_image_path(field_name, image))
+        except FileNotFoundError:
+            continue
+        for width in IMAGE_VARIANT_WIDTHS:
+            for image_format in IMAGE_VARIANT_FORMATS:
+                get_variant(field_name, image, width, image_format, stat_result)
+    logger.info(f'Image variants of {field_name} made')
+
+
+async def variant_response(request: Request, field_name: str, image: str, width: int | None, image_format: str | None,
+                           run_id: str = None) -> Response:
+    """Serves the image resized to `width` in the format, with an ETag of the image version and the parameters."""
+    path = get_image_path(field_name, image)
+    image_format = image_format or ('jpeg' if path.endswith('.jpeg') else 'png')
+    if image_format not in IMAGE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Format '{image_format}' is not supported. Formats: {', '.join(IMAGE_FORMATS)}")
+    if width is not None and not 0 < width <= IMAGE_MAX_WIDTH:
+        raise HTTPException(status_code=400, detail=f'Width must be from 1 to {IMAGE_MAX_WIDTH} pixels.')
+    try:
+        stat_result = os.stat(path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail=f"'{os.path.basename(path)}' not found")
+    width = width or IMAGE_MAX_WIDTH
+    headers = {
+        'ETag': make_etag(stat_result, f'{run_id}:{width}:{image_format}'),
+        'Last-Modified': formatdate(stat_result.st_mtime, usegmt=True),
+        'Cache-Control': CACHE_CONTROL_IMAGES,
+        }
+    if is_not_modified(request, headers['ETag'], stat_result):
+        return Response(status_code=304, headers=headers)
+    variant = await anyio.to_thread.run_sync(get_variant, field_name, image, width, image_format, stat_result, run_id)
+    return Response(content=variant, media_type=IMAGE_FORMATS[image_format], headers=headers)
@@ -0,0 +1,95 @@
+"""Vegetation index engine: registered band-math formulas evaluated in float32 over blocks of rows in threads.
+Every index declares the Sentinel-2 bands it needs, only these bands are read from the product."""
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from settings import INDEX_BLOCK_ROWS, INDEX_THREADS
+
+
+# Band files of the Level-2A product, 20 m bands are resampled to the 10 m grid.
+BAND_FILES = {
+    'B02': 'B02_10m.jp2',
+    'B03': 'B03_10m.jp2',
+    'B04': 'B04_10m.jp2',
+    'B05': 'B05_20m.jp2',
+    'B08': 'B08_10m.jp2',
+    }
+# Level-2A digital numbers to surface reflectance.
+REFLECTANCE_SCALE = np.float32(1 / 10000)
+
+INDICES: dict[str, tuple] = {}
+
+_executor = None
+
+
+def register_index(name: str, *bands: str, value_range: tuple[float, float] = (-1.0, 1.0)):
+    """Registers the formula of the index. It gets the float32 reflectance of the bands in this order.
+    `value_range` is the range of the histogram of the index statistics."""
+    def decorator(formula):
+        INDICES[name] = (bands, formula, value_range)
+        return formula
+    return decorator
+
+
+@register_index('NDVI', 'B04', 'B08')
+def ndvi(red: np.ndarray, nir: np.ndarray) -> np.ndarray:
+    return (nir - red) / (nir + red)
+
+
+@register_index('EVI', 'B02', 'B04', 'B08', value_range=(-1.0, 2.5))
+def evi(blue: np.ndarray, red: np.ndarray, nir: np.ndarray) -> np.ndarray:
+    return 2.5 * (nir - red) / (nir + 6 * red - 7.5 * blue + 1)
+
+
+@register_index('NDWI', 'B03', 'B08')
+def ndwi(green: np.ndarray, nir: np.ndarray) -> np.ndarray:
+    return (green - nir) / (green + nir)
+
+
+@register_index('SAVI', 'B04', 'B08', value_range=(-1.5, 1.5))
+def savi(red: np.ndarray, nir: np.ndarray) -> np.ndarray:
+    return 1.5 * (nir - red) / (nir + red + 0.5)
+
+
+@register_index('NDRE', 'B05', 'B08')
+def ndre(red_edge: np.ndarray, nir: np.ndarray) -> np.ndarray:
+    return (nir - red_edge) / (nir + red_edge)
+
+
+def get_index_bands(names: tuple[str, ...]) -> tuple[str, ...]:
+    """Bands needed by the indices, each once."""
+    return tuple(dict.fromkeys(band for name in names for band in INDICES[name][0]))
+
+
+def get_index_range(name: str) -> tuple[float, float]:
+    return INDICES[name][2]
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """Threads of the engine. NumPy releases the GIL in the band math, the blocks run on several cores."""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=INDEX_THREADS, thread_name_prefix='index')
+    return _executor
+
+
+def evaluate_index(name: str, bands: dict[str, np.ndarray], out: np.ndarray = None) -> np.ndarray:
+    """The index of the band arrays (digital numbers) as float32, written to `out` if it is given.
+    Blocks of INDEX_BLOCK_ROWS rows are converted to reflectance and evaluated in parallel, so only
+    the blocks are held as float32 besides the result. Zero reflectance gives NaN or inf."""
+    band_names, formula, _ = INDICES[name]
+    arrays = [bands[band] for band in band_names]
+    if out is None:
+        out = np.empty(arrays[0].shape, dtype=np.float32)
+
+    def evaluate_block(row: int) -> None:
+        rows = slice(row, row + INDEX_BLOCK_ROWS)
+        block = [array[..., rows, :].astype(np.float32) * REFLECTANCE_SCALE for array in arrays]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            out[..., rows, :] = formula(*block)
+
+    rows = range(0, out.shape[-2], INDEX_BLOCK_ROWS)
+    if len(rows) == 1:
+        evaluate_block(0)
+    else:
+        list(get_executor().map(evaluate_block, rows))
+    return out
@@ -0,0 +1,267 @@
+"""Persistent job store and runner for the long download and processing tasks."""
+import asyncio
+import json
+import os
+import socket
+import sqlite3
+import time
+import uuid
+from loguru import logger
+from settings import (PATH_JOBS_DB, JOB_EXECUTION, QUEUE_JOB_KINDS, JOB_LEASE, JOB_HEARTBEAT, JOB_MAX_ATTEMPTS)
+
+
+ACTIVE_STATES = ('queued', 'running')
+
+_tasks = set()
+
+
+def _connect() -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(PATH_JOBS_DB), exist_ok=True)
+    connection = sqlite3.connect(PATH_JOBS_DB, timeout=30)
+    connection.row_factory = sqlite3.Row
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                            id TEXT PRIMARY KEY,
+                            kind TEXT NOT NULL,
+                            field_name TEXT NOT NULL,
+                            state TEXT NOT NULL,
+                            stage TEXT,
+                            message TEXT,
+                            result TEXT,
+                            error TEXT,
+                            created_at REAL NOT NULL,
+                            started_at REAL,
+                            finished_at REAL,
+                            args TEXT,
+                            worker TEXT,
+                            lease_until REAL,
+                            attempts INTEGER NOT NULL DEFAULT 0)""")
+    # stores made by older versions
+    columns = [row['name'] for row in connection.execute('PRAGMA table_info(jobs)')]
+    for column, definition in (('result', 'TEXT'), ('args', 'TEXT'), ('worker', 'TEXT'), ('lease_until', 'REAL'),
+                               ('attempts', 'INTEGER NOT NULL DEFAULT 0')):
+        if column not in columns:
+            try:
+                connection.execute(f'ALTER TABLE jobs ADD COLUMN {column} {definition}')
+            except sqlite3.OperationalError:
+                pass  # added by another process at the same time
+    return connection
+
+
+def _to_dict(row: sqlite3.Row) -> dict:
+    job = dict(row)
+    for column in ('result', 'args'):
+        if job[column] is not None:
+            job[column] = json.loads(job[column])
+    if job['started_at'] is not None:
+        end = job['finished_at'] or time.time()
+        job['duration'] = round(end - job['started_at'], 3)
+    return job
+
+
+def _update(job_id: str, **values) -> None:
+    columns = ', '.join(f'{name} = ?' for name in values)
+    with _connect() as connection:
+        connection.execute(f'UPDATE jobs SET {columns} WHERE id = ?', (*values.values(), job_id))
+
+
+def get_node_id() -> str:
+    """Id of this API or worker node process, the owner of the leases of the jobs it runs."""
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def get_job(job_id: str) -> dict | None:
+    """Returns the job with the given id or None."""
+    with _connect() as connection:
+        row = connection.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    return _to_dict(row) if row else None
+
+
+def find_active_job(kind: str, field_name: str) -> dict | None:
+    """Returns the queued or running job of this kind for the field."""
+    with _connect() as connection:
+        row = connection.execute('SELECT * FROM jobs WHERE kind = ? AND field_name = ? AND state IN (?, ?) '
+                                 'ORDER BY created_at LIMIT 1', (kind, field_name, *ACTIVE_STATES)).fetchone()
+    return _to_dict(row) if row else None
+
+
+def create_job(kind: str, field_name: str, args: tuple = None) -> tuple[dict, bool]:
+    """Creates a queued job. A duplicate of an active job returns that job and False.
+    A job with args is in the queue of the worker nodes, they call the job function with these args.
+    The check and the insert are one transaction, so API nodes sharing the store never create two active jobs."""
+    job_id = uuid.uuid4().hex
+    connection = _connect()
+    try:
+        connection.execute('BEGIN IMMEDIATE')
+        row = connection.execute('SELECT id FROM jobs WHERE kind = ? AND field_name = ? AND state IN (?, ?) '
+                                 'ORDER BY created_at LIMIT 1', (kind, field_name, *ACTIVE_STATES)).fetchone()
+        if row is None:
+            connection.execute('INSERT INTO jobs (id, kind, field_name, state, stage, args, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               (job_id, kind, field_name, 'queued', 'queued', None if args is None else json.dumps(args),
+                                time.time()))
+        connection.commit()
+    finally:
+        connection.close()
+    if row is not None:
+        return get_job(row['id']), False
+    return get_job(job_id), True
+
+
+def claim_job(kinds: list[str]) -> dict | None:
+    """Takes the oldest queued job of the kinds from the worker queue with a lease for this node, or None."""
+    if not kinds:
+        return None
+    now = time.time()
+    connection = _connect()
+    try:
+        connection.execute('BEGIN IMMEDIATE')
+        row = connection.execute(f'SELECT id FROM jobs WHERE state = ? AND args IS NOT NULL AND kind IN ({", ".join("?" * len(kinds))}) '
+                                 'ORDER BY created_at LIMIT 1', ('queued', *kinds)).fetchone()
+        if row is not None:
+            connection.execute('UPDATE jobs SET state = ?, worker = ?, lease_until = ?, started_at = ?, error = NULL, '
+                               'attempts = attempts + 1 WHERE id = ?',
+                               ('running', get_node_id(), now + JOB_LEASE, now, row['id']))
+        connection.commit()
+    finally:
+        connection.close()
+    if row is None:
+        return None
+    logger.info(f'job {row["id"]} claimed by {get_node_id()}')
+    return get_job(row['id'])
+
+
+def renew_lease(job_id: str) -> bool:
+    """Extends the lease of the running job of this node. False if the node lost the job."""
+    with _connect() as connection:
+        cursor = connection.execute('UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? AND state = ?',
+                                    (time.time() + JOB_LEASE, job_id, get_node_id(), 'running'))
+    return cursor.rowcount == 1
+
+
+def requeue_expired_jobs() -> None:
+    """Queues again the running jobs whose node stopped renewing the lease. Jobs of the worker queue are
+    retried up to JOB_MAX_ATTEMPTS times, the others (e.g. downloads with credentials) fail."""
+    with _connect() as connection:
+        rows = connection.execute('SELECT * FROM jobs WHERE state = ? AND lease_until < ?', ('running', time.time())).fetchall()
+    for row in rows:
+        if row['args'] is not None and row['attempts'] < JOB_MAX_ATTEMPTS:
+            with _connect() as connection:
+                cursor = connection.execute('UPDATE jobs SET state = ?, stage = ?, worker = NULL, lease_until = NULL '
+                                            'WHERE id = ? AND worker = ? AND state = ?',
+                                            ('queued', 'queued', row['id'], row['worker'], 'running'))
+            if cursor.rowcount:
+                logger.info(f"job {row['id']} of {row['worker']} queued again: the lease expired")
+        elif row['args'] is not None:
+            mark_failed(row['id'], f"The job failed {row['attempts']} times: the worker stopped.")
+        else:
+            mark_failed(row['id'], f"The node {row['worker']} running the job stopped. Submit the job again.")
+
+
+def unfinished_jobs() -> list[dict]:
+    """Jobs left queued or running, e.g. by a server restart."""
+    with _connect() as connection:
+        rows = connection.execute('SELECT * FROM jobs WHERE state IN (?, ?) ORDER BY created_at', ACTIVE_STATES).fetchall()
+    return [_to_dict(row) for row in rows]
+
+
+def set_stage(job_id: str | None, stage: str) -> None:
+    """Records the progress stage of the job. Does nothing outside a job."""
+    if job_id is not None:
+        _update(job_id, stage=stage)
+
+
+def mark_failed(job_id: str, error: str) -> None:
+    _update(job_id, state='failed', error=error, finished_at=time.time())
+    logger.info(f'job {job_id} failed: {error}')
+
+
+def _finish(job_id: str, **values) -> bool:
+    """Stores the end of the job if this node still holds it. False if the lease was lost to another node."""
+    columns = ', '.join(f'{name} = ?' for name in values)
+    with _connect() as connection:
+        cursor = connection.execute(f'UPDATE jobs SET {columns}, finished_at = ?, lease_until = NULL WHERE id = ? AND worker = ?',
+                                    (*values.values(), time.time(), job_id, get_node_id()))
+    if cursor.rowcount == 0:
+        logger.info(f'job {job_id}: the lease was lost, the result of {get_node_id()} is dropped')
+    return cursor.rowcount == 1
+
+
+async def _heartbeat(job_id: str) -> None:
+    while True:
+        await asyncio.sleep(JOB_HEARTBEAT)
+        if not renew_lease(job_id):
+            logger.info(f'job {job_id}: the lease was lost')
+            return
+
+
+async def execute_job(job_id: str, run, *args) -> None:
+    """Runs the job held by this node. A heartbeat renews the lease while `run` works."""
+    heartbeat = asyncio.create_task(_heartbeat(job_id))
+    try:
+        output = await run(*args, job_id=job_id)
+    except Exception as ex:
+        error = str(getattr(ex, 'detail', ex))
+        if _finish(job_id, state='failed', error=error):
+            logger.info(f'job {job_id} failed: {error}')
+        return
+    finally:
+        heartbeat.cancel()
+    if isinstance(output, str):
+        finished = _finish(job_id, state='done', stage='done', message=output)
+    else:
+        finished = _finish(job_id, state='done', stage='done', result=json.dumps(output))
+    if finished:
+        logger.info(f'job {job_id} done')
+
+
+async def _run_job(job_id: str, run, *args) -> None:
+    """Takes the queued job with a lease for this node and runs it. Another process recovering
+    expired jobs may have claimed it first, then it is left to that process."""
+    now = time.time()
+    with _connect() as connection:
+        cursor = connection.execute('UPDATE jobs SET state = ?, worker = ?, lease_until = ?, started_at = ?, error = NULL, '
+                                    'attempts = attempts + 1 WHERE id = ? AND state = ?',
+                                    ('running', get_node_id(), now + JOB_LEASE, now, job_id, 'queued'))
+    if cursor.rowcount == 0:
+        logger.info(f'job {job_id} was claimed by another process')
+        return
+    await execute_job(job_id, run, *args)
+
+
+def _spawn(coroutine) -> None:
+    task = asyncio.create_task(coroutine)
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+def start_job(job_id: str, run, *args) -> None:
+    """Runs the coroutine function `run(*args, job_id=job_id)` in the background.
+    A string returned by `run` is stored as the job message, any other value as the JSON result."""
+    _spawn(_run_job(job_id, run, *args))
+
+
+def resume_expired_jobs(runners: dict) -> None:
+    """Recovers the jobs of processes that stopped renewing their lease, in the 'local' execution mode.
+    The expired jobs are queued again like for the worker nodes, then this process claims and runs
+    the queued jobs of the `runners` kinds. Jobs of running processes keep their lease."""
+    requeue_expired_jobs()
+    while (job := claim_job(list(runners))) is not None:
+        logger.info(f"job {job['id']} resumed")
+        _spawn(execute_job(job['id'], runners[job['kind']], *job['args']))
+
+
+def is_queued_kind(kind: str) -> bool:
+    """Jobs of this kind are run by the worker nodes, not by the API process."""
+    return JOB_EXECUTION == 'queue' and kind in QUEUE_JOB_KINDS
+
+
+async def submit_job(kind: str, field_name: str, run, *args) -> dict:
+    """Enqueues a job, or returns the active job for the same field and kind. The args of QUEUE_JOB_KINDS jobs
+    are stored to run them again after their node stopped. In the 'queue' execution mode these jobs are left
+    to the worker nodes, `run` is only called by the API for the others."""
+    job, created = create_job(kind, field_name, args if kind in QUEUE_JOB_KINDS else None)
+    if created and not is_queued_kind(kind):
+        start_job(job['id'], run, *args)
+    if created:
+        logger.info(f'job {job["id"]} {kind} queued for {field_name}')
+    return job
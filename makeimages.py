@@ -1,164 +1,366 @@
 """Creation of field and NDVI field image files."""
 from fastapi import HTTPException
 import geopandas as gpd
-from rasterio.mask import mask
-from settings import PATH_FIELDS, PATH_BUFFER
+from rasterio.features import geometry_mask
+from rasterio.windows import Window, from_bounds, union
+from affine import Affine
+import numpy as np
+from settings import (PATH_FIELDS, KEEP_MASKED_GEOTIFF, RENDERER, WINDOWED_READS, WINDOW_MERGE_MAX_RATIO, CLOUD_MASK,
+                      SCL_MASKED_CLASSES, TILE_SIZE, FIELD_INDICES)
+from tiles import remove_field_tiles
+from imagevariants import make_image_variants
+from indices import BAND_FILES, evaluate_index, get_index_bands, get_index_range
+from fieldgeometry import get_field_geometry, get_field_pixel_window
+import fnmatch
 import glob
+import math
+import zipfile
 import rasterio as rio
-from converting import convert_ndvi_tiff_to_jpeg, convert_rgb_tiff_to_jpeg, make_field_image, make_ndvi_image
+from converting import (convert_ndvi_array_to_jpeg, convert_rgb_array_to_jpeg, make_field_image, make_ndvi_image,
+                        save_field_image, save_ndvi_image)
+from jobs import set_stage
+from metrics import timed
+from ndvistats import get_cloud_free_fraction, get_ndvi_stats, get_index_stats
 from loguru import logger
-import shutil
 import os
+import uuid
 
 
 URL = str
 
 
-async def delete_data_field(field_name: str) -> None:
-    """Deletes all information about the field."""
-    path_to_field_name = f'{PATH_FIELDS}{field_name}'
-    try:
-        shutil.rmtree(path_to_field_name)
-        logger.info(f'Field "{field_name}" removed')
-        return f'Field "{field_name}" removed'
-    except OSError as e:
-        logger.info(f'Error "Field "{field_name}" : {e.strerror}')
-
-
 def make_response_to_client(final_field: str, final_NDVI: str) ->str:
     """Makes a message to the client about the end of the image creation process."""
     message = f'{final_field}, {final_NDVI}.'
     return message
 
 
-def delete_base_files(field_name: str) ->None:
-    """Deletes used source files of large size."""
-    path_to_buffer = f'{PATH_BUFFER}sat_field_{field_name}'
+async def make_images_tiff(name_unzip_file: URL, field_name: str, job_id: str = None) ->str:
+    """Runs the image creation of the field."""
+    results = await make_fields_images_tiff(name_unzip_file, [field_name], job_id)
+    result = results[field_name]
+    if result['error']:
+        raise HTTPException(status_code=500, detail=result['error'])
+    return result['message']
+
+
+def get_ndvi_message(ndvi_stats: dict) -> str:
+    if ndvi_stats.get('accepted') is False:
+        return f"NDVI calculated, the scene is rejected: cloud-free fraction of the field {ndvi_stats['cloud_free_fraction']}"
+    return 'NDVI calculated'
+
+
+def get_field_images(field_name: str) -> dict[str, URL]:
+    """Paths to the images and NDVI file of the field."""
     path_to_field_name = f'{PATH_FIELDS}{field_name}/{field_name}'
-    try:
-        shutil.rmtree(path_to_buffer)
-        logger.info(f'Buffer "sat_field_{field_name}" removed')
-    except OSError as e:
-        logger.info(f'Error "sat_field_{field_name}" : {e.strerror}')
-
-    delete_list = [
-        f'{path_to_field_name}_NDVI_10.tiff',
-        f'{path_to_field_name}_NDVI_10_masked.tiff',
-        f'{path_to_field_name}_RGB_10_TCI.tiff',
-        f'{path_to_field_name}_RGB_10_TCI_masked.tiff'
-        ]
-    for file_path in delete_list:
+    return {
+        'field_image': f'{path_to_field_name}_RGB_10_TCI_field.png',
+        'field_image_jpeg': f'{path_to_field_name}_RGB_10_TCI_masked.jpeg',
+        'ndvi_image': f'{path_to_field_name}_NDVI_10_field.png',
+        'ndvi_image_jpeg': f'{path_to_field_name}_NDVI_10_masked.jpeg',
+        'ndvi_file': f'{path_to_field_name}_NDVI.json',
+        }
+
+
+async def make_fields_images_tiff(name_unzip_file: URL, field_names: list[str], job_id: str = None) -> dict[str, dict]:
+    """Creates images and NDVI of all the fields covered by one scene.
+    Every band is opened and decoded once, in a window covering all the fields."""
+    results = {field_name: {'error': None} for field_name in field_names}
+    run_id = uuid.uuid4().hex
+
+    set_stage(job_id, 'field-image')
+    with rio.open(await get_path_to_band_file(name_unzip_file, 'TCI_10m.jp2'), driver='JP2OpenJPEG') as TCI:
+        fields_data = {field_name: get_field_geometry(field_name, TCI.crs) for field_name in field_names}
+        windows = get_fields_windows(TCI, field_names, results)
+        rgb_arrays = read_fields_windows(TCI, windows)
+        rgb_profile = TCI.profile
+    for field_name, (rgb_array, rgb_transform) in rgb_arrays.items():
         try:
-            os.remove(file_path)
-            logger.info(f'Files from {delete_list}" removed')
-        except OSError as e:
-            logger.info(f'Error: {file_path} : {e.strerror}')
+            await make_field_masked_image_tiff(field_name, fields_data[field_name], rgb_array, rgb_profile, rgb_transform)
+        except ValueError as ex:
+            logger.info(f'{ex}')
+            results[field_name]['error'] = f'The field {field_name} is not covered by the received raster from the satellite. Change the request coordinates.'
 
+    set_stage(job_id, 'ndvi')
+    covered_fields = [field_name for field_name in field_names if not results[field_name]['error']]
+    with rio.open(await get_path_to_band_file(name_unzip_file, 'B04_10m.jp2'), driver='JP2OpenJPEG') as b4:
+        fields_data = {field_name: get_field_geometry(field_name, b4.crs) for field_name in covered_fields}
+        windows = get_fields_windows(b4, covered_fields, results)
+        bands_arrays = await read_fields_bands(name_unzip_file, b4, windows, get_index_bands(get_field_indices()))
+        scl_arrays = await read_fields_scl(name_unzip_file, b4, windows)
+        transforms = {field_name: b4.window_transform(window) for field_name, window in windows.items()}
+        meta = b4.meta
+    for field_name, bands in bands_arrays.items():
+        try:
+            ndvi_stats, indices_stats = await make_field_ndvi_image_tiff(field_name, fields_data[field_name], bands, meta,
+                                                                         transforms[field_name], run_id, scl_arrays.get(field_name))
+        except ValueError as ex:
+            logger.info(f'{ex}')
+            results[field_name]['error'] = f'The field {field_name} is not covered by the received raster from the satellite. Change the request coordinates.'
+            continue
+        results[field_name].update(
+                    message=make_response_to_client('Field image created', get_ndvi_message(ndvi_stats)),
+                    middle_ndvi=ndvi_stats['middle_ndvi'],
+                    ndvi=ndvi_stats,
+                    indices=indices_stats,
+                    images=get_field_images(field_name),
+                    run_id=run_id
+                    )
+        make_image_variants(field_name)
 
+    return results
+
+
+async def get_field_ndvi_stats(name_unzip_file: URL, field_name: str) -> dict:
+    """NDVI statistics of the field on one scene, without images. Used for the NDVI time series."""
+    results = {field_name: {'error': None}}
+    with rio.open(await get_path_to_band_file(name_unzip_file, 'B04_10m.jp2'), driver='JP2OpenJPEG') as b4:
+        field_data = get_field_geometry(field_name, b4.crs)
+        windows = get_fields_windows(b4, [field_name], results)
+        bands_arrays = await read_fields_bands(name_unzip_file, b4, windows, get_index_bands(('NDVI',)))
+        scl_arrays = await read_fields_scl(name_unzip_file, b4, windows)
+        ndvi_transform = b4.window_transform(windows[field_name]) if field_name in windows else None
+    if results[field_name]['error']:
+        raise HTTPException(status_code=500, detail=results[field_name]['error'])
+    ndvi = evaluate_index('NDVI', bands_arrays[field_name])
+    try:
+        ndvi, _, cloud_free_fraction = mask_field_index(ndvi, scl_arrays.get(field_name), ndvi_transform, field_data)
+    except ValueError as ex:
+        logger.info(f'{ex}')
+        raise HTTPException(status_code=500, detail=f'The field {field_name} is not covered by the received raster from the satellite. Change the request coordinates.')
+    return get_ndvi_stats(ndvi, cloud_free_fraction)
 
-async def make_images_tiff(name_unzip_file: URL, field_name: str) ->str:
-    """Runs the image creation and deletion functions of the source files."""
-    final_field = await make_field_masked_image_tiff(name_unzip_file, field_name)
-    final_NDVI = await make_field_ndvi_image_tiff(name_unzip_file, field_name)
-    message = make_response_to_client(final_field, final_NDVI)
-    delete_base_files(field_name)
-    return message
+
+def get_band_pattern(band: str) -> str:
+    """Pattern of the band file inside the SAFE directory, e.g. 'B04_10m.jp2' is in IMG_DATA/R10m."""
+    resolution = band.rsplit('.', maxsplit=1)[0].rsplit('_', maxsplit=1)[-1]
+    return f'GRANULE/*/IMG_DATA/R{resolution}/*{band}'
 
 
 async def get_path_to_band_file(name_unzip_file: URL, band: str) ->URL:
-    """Makes path to band"""
-    path = f'{name_unzip_file}/GRANULE/*/IMG_DATA/R10m/*{band}'
-    path_to_band = glob.glob(path)[0]
-    return path_to_band
+    """Makes path to band. For a zip file makes a GDAL /vsizip/ path to the band inside the archive.
+    Raises FileNotFoundError if the product has no such band."""
+    if name_unzip_file.endswith('.zip'):
+        with zipfile.ZipFile(name_unzip_file, 'r') as zip_file:
+            pattern = f'*.SAFE/{get_band_pattern(band)}'
+            member = next((name for name in zip_file.namelist() if fnmatch.fnmatch(name, pattern)), None)
+        if member is None:
+            raise FileNotFoundError(f"There is no band '{band}' in {os.path.basename(name_unzip_file)}")
+        return f'/vsizip/{os.path.abspath(name_unzip_file)}/{member}'
+    path = f'{name_unzip_file}/{get_band_pattern(band)}'
+    paths_to_band = glob.glob(path)
+    if not paths_to_band:
+        raise FileNotFoundError(f"There is no band '{band}' in {os.path.basename(name_unzip_file)}")
+    return paths_to_band[0]
+
+
+def get_read_window(band: rio.DatasetReader, field_name: str) -> Window:
+    """Window to decode from the band: the field window or the full tile if WINDOWED_READS is off."""
+    if not WINDOWED_READS:
+        return Window(0, 0, band.width, band.height)
+    return get_field_pixel_window(field_name, band)
+
+
+def get_fields_windows(band: rio.DatasetReader, field_names: list[str], results: dict[str, dict]) -> dict[str, Window]:
+    """Read windows of the fields. Fields outside the band get an error in results."""
+    windows = {}
+    for field_name in field_names:
+        try:
+            windows[field_name] = get_read_window(band, field_name)
+        except ValueError as ex:
+            logger.info(f'{field_name}: {ex}')
+            results[field_name]['error'] = f'The field {field_name} is not covered by the received raster from the satellite. Change the request coordinates.'
+    return windows
+
 
+def _get_area(window: Window) -> float:
+    return window.width * window.height
 
-def get_field_data_from_geojson(field_name: str) -> gpd.geodataframe.GeoDataFrame:
-    df = gpd.read_file(f'{PATH_FIELDS}/{field_name}/{field_name}.geojson')
-    field_data = df.to_crs({'init': 'epsg:32637'})
-    print(type(field_data))
-    return field_data
 
+def group_windows(windows: dict[str, Window]) -> list[tuple[Window, dict[str, Window]]]:
+    """Groups the windows of nearby fields. A group is decoded as one window, its union, while the union is
+    at most WINDOW_MERGE_MAX_RATIO times the area of the field windows, so fields far apart are read apart."""
+    groups = []
+    for field_name, window in sorted(windows.items(), key=lambda item: (item[1].row_off, item[1].col_off)):
+        for group in groups:
+            union_window = union(group[0], window)
+            if _get_area(union_window) <= WINDOW_MERGE_MAX_RATIO * (group[2] + _get_area(window)):
+                group[0] = union_window
+                group[1][field_name] = window
+                group[2] += _get_area(window)
+                break
+        else:
+            groups.append([window, {field_name: window}, _get_area(window)])
+    return [(union_window, members) for union_window, members, _ in groups]
 
-async def make_field_masked_image_tiff(name_unzip_file: URL, field_name: str) -> str:
-    """Creates a raster image of the field."""
+
+def _cut_windows(array: np.ndarray, union_window: Window, windows: dict[str, Window]) -> dict[str, np.ndarray]:
+    fields_arrays = {}
+    for field_name, window in windows.items():
+        row = int(window.row_off - union_window.row_off)
+        col = int(window.col_off - union_window.col_off)
+        fields_arrays[field_name] = array[:, row:row + int(window.height), col:col + int(window.width)]
+    return fields_arrays
+
+
+@timed('decode')
+def read_fields_windows(band: rio.DatasetReader, windows: dict[str, Window]) -> dict[str, tuple]:
+    """Decodes the windows of the groups of nearby fields and cuts the array and transform of every field from them."""
+    fields_arrays = {}
+    for union_window, group in group_windows(windows):
+        for field_name, field_array in _cut_windows(band.read(window=union_window), union_window, group).items():
+            fields_arrays[field_name] = (field_array, band.window_transform(group[field_name]))
+    return fields_arrays
+
+
+@timed('decode')
+def read_fields_resampled(src: rio.DatasetReader, band: rio.DatasetReader, windows: dict[str, Window]) -> dict[str, np.ndarray]:
+    """Reads the coarser band `src` resampled (nearest) to the windows of the fields on the grid of `band`."""
+    fields_arrays = {}
+    for union_window, group in group_windows(windows):
+        transform = band.window_transform(union_window)
+        height, width = int(union_window.height), int(union_window.width)
+        # src pixel of the centre of every pixel of the grid
+        cols, _ = ~src.transform * (transform * (np.arange(width) + 0.5, np.full(width, 0.5)))
+        _, rows = ~src.transform * (transform * (np.full(height, 0.5), np.arange(height) + 0.5))
+        cols = np.clip(np.floor(cols).astype(int), 0, src.width - 1)
+        rows = np.clip(np.floor(rows).astype(int), 0, src.height - 1)
+        src_window = Window(cols[0], rows[0], cols[-1] - cols[0] + 1, rows[-1] - rows[0] + 1)
+        array = src.read(1, window=src_window)[np.ix_(rows - rows[0], cols - cols[0])]
+        fields_arrays.update(_cut_windows(array[None], union_window, group))
+    return fields_arrays
+
+
+async def read_fields_scl(name_unzip_file: URL, band: rio.DatasetReader, windows: dict[str, Window]) -> dict[str, np.ndarray]:
+    """Reads the 20 m SCL scene classification resampled to the 10 m windows of the fields.
+    Returns no arrays if CLOUD_MASK is off or the product has no SCL band (Level-1C)."""
+    if not CLOUD_MASK or not windows:
+        return {}
     try:
-        logger.info('make_field_masked_image_tiff')
-        path_to_field_folder = f'{PATH_FIELDS}{field_name}/'
-        TCI = rio.open(await get_path_to_band_file(name_unzip_file, 'TCI_10m.jp2'), driver='JP2OpenJPEG')
-        field_data = get_field_data_from_geojson(field_name)
-        rgb_profile = TCI.profile
-        rgb_profile.update(
-                    driver="GTiff",
-                    count=3,
-                    photometric="RGB",
-                    compress="LZW",
-                    bigtiff="IF_NEEDED",
-                    tiled=True,
-                    blockxsize=256,
-                    blockysize=256,
-                    crs = 32637
-                    )
+        path_to_scl = await get_path_to_band_file(name_unzip_file, 'SCL_20m.jp2')
+    except FileNotFoundError:
+        logger.info('There is no SCL band, the clouds are not masked')
+        return {}
+    with rio.open(path_to_scl, driver='JP2OpenJPEG') as scl:
+        return read_fields_resampled(scl, band, windows)
 
-        with rio.open(f'{path_to_field_folder}{field_name}_RGB_10_TCI.tiff','w', **rgb_profile) as rgb:
-            rgb.write(TCI.read())
-            rgb.close()
-        
-        with rio.open(f'{path_to_field_folder}{field_name}_RGB_10_TCI.tiff') as src:
-            out_image, out_transform = mask(src, field_data.geometry, crop=True)
-            out_meta = src.meta.copy()
-            out_meta.update({"driver": "GTiff",
-                        "height": out_image.shape[1],
-                        "width": out_image.shape[2],
-                        "transform": out_transform})
-            logger.info(f'make_field_masked_image_tiff-out_meta: {out_meta}')
-        
-        with rio.open(f'{path_to_field_folder}{field_name}_RGB_10_TCI_masked.tiff', "w", **out_meta) as dest:
-            dest.write(out_image)
-
-        make_field_image(path_to_field_folder, field_name)
-
-        path_to_rgb_masked_tiff = f'{path_to_field_folder}{field_name}_RGB_10_TCI_masked.tiff'
-        convert_rgb_tiff_to_jpeg(path_to_field_folder, field_name, path_to_rgb_masked_tiff)
-        return 'Field image created'
-    except ValueError as ex:
-        logger.info(f'{ex}')
-        raise HTTPException(status_code=500, detail=f'The field {field_name} is not covered by the received raster from the satellite. Change the request coordinates.')
-    
-        
+
+async def read_fields_bands(name_unzip_file: URL, band: rio.DatasetReader, windows: dict[str, Window],
+                            band_names: tuple[str, ...]) -> dict[str, dict[str, np.ndarray]]:
+    """Reads the bands of the indices in the windows of the fields on the 10 m grid of `band`.
+    Returns the arrays of every field by band name, e.g. {'field': {'B04': red, 'B08': nir}}."""
+    fields_bands = {field_name: {} for field_name in windows}
+    if not windows:
+        return fields_bands
+    for band_name in band_names:
+        with rio.open(await get_path_to_band_file(name_unzip_file, BAND_FILES[band_name]), driver='JP2OpenJPEG') as src:
+            if src.transform == band.transform:
+                arrays = {field_name: array for field_name, (array, _) in read_fields_windows(src, windows).items()}
+            else:
+                arrays = read_fields_resampled(src, band, windows)
+        for field_name, array in arrays.items():
+            fields_bands[field_name][band_name] = array
+    return fields_bands
+
+
+def mask_field_index(index: np.ndarray, scl: np.ndarray | None, transform: Affine,
+                     field_data: gpd.geodataframe.GeoDataFrame) -> tuple:
+    """Index layers of the field with the pixels outside the field masked, and the cloudy pixels if there is an SCL array.
+    Returns the masked layers, their transform and the cloud-free fraction of the field (None without SCL)."""
+    layers, layers_transform = mask_field_array(index, transform, field_data)
+    if scl is None:
+        return layers, layers_transform, None
+    cloud, _ = mask_field_array(np.isin(scl, SCL_MASKED_CLASSES), transform, field_data)
+    cloud_free_fraction = get_cloud_free_fraction(layers[:1], cloud.data)
+    layers = np.ma.MaskedArray(layers.data, mask=np.ma.getmaskarray(layers) | cloud.data)
+    logger.info(f'Cloud-free fraction of the field: {cloud_free_fraction}')
+    return layers, layers_transform, cloud_free_fraction
 
 
-async def make_field_ndvi_image_tiff(name_unzip_file: str, field_name: str) -> str:
-    """Calculates NDVI and cretes an NDVI image."""
+@timed('mask')
+def mask_field_array(array: np.ndarray, transform: Affine, field_data: gpd.geodataframe.GeoDataFrame) -> tuple:
+    """Crops the array to the field bounds and masks the pixels outside the field geometry, in memory.
+    Returns the masked array and its transform."""
+    bounds_window = from_bounds(*field_data.total_bounds, transform=transform)
+    row_start = max(math.floor(bounds_window.row_off), 0)
+    col_start = max(math.floor(bounds_window.col_off), 0)
+    row_end = min(math.ceil(bounds_window.row_off + bounds_window.height), array.shape[1])
+    col_end = min(math.ceil(bounds_window.col_off + bounds_window.width), array.shape[2])
+    if row_end <= row_start or col_end <= col_start:
+        raise ValueError('Input shapes do not overlap raster.')
+    field_array = array[:, row_start:row_end, col_start:col_end]
+    field_transform = transform * Affine.translation(col_start, row_start)
+    outside = geometry_mask(field_data.geometry, out_shape=field_array.shape[1:], transform=field_transform)
+    if outside.all():
+        raise ValueError('Input shapes do not overlap raster.')
+    return np.ma.MaskedArray(field_array, mask=np.broadcast_to(outside, field_array.shape)), field_transform
+
+
+def get_field_indices() -> tuple[str, ...]:
+    """NDVI and the FIELD_INDICES of the fields."""
+    return tuple(dict.fromkeys(('NDVI', *FIELD_INDICES)))
+
+
+def save_masked_geotiff(path: URL, array: np.ma.MaskedArray, transform: Affine, crs, nodata: float) -> None:
+    """Saves the masked array of the field as a Cloud-Optimized GeoTIFF with averaged overviews for the map tiles."""
+    profile = dict(driver='COG', width=array.shape[2], height=array.shape[1], count=array.shape[0],
+                   dtype=array.dtype, crs=crs, transform=transform, nodata=nodata, compress='DEFLATE',
+                   blocksize=TILE_SIZE, overview_resampling='average')
+    with rio.open(path, 'w', **profile) as f:
+        f.write(array.filled(nodata))
+    logger.info(f'{path} saved')
+
+
+@timed('field_image')
+async def make_field_masked_image_tiff(field_name: str, field_data: gpd.geodataframe.GeoDataFrame,
+                                       rgb_array: np.ndarray, rgb_profile: dict, rgb_transform: Affine) -> str:
+    """Creates images of the field from the RGB window in memory."""
+    logger.info('make_field_masked_image_tiff')
+    path_to_field_folder = f'{PATH_FIELDS}{field_name}/'
+    out_image, out_transform = mask_field_array(rgb_array, rgb_transform, field_data)
+    logger.info(f'make_field_masked_image_tiff: {out_image.shape[2]}x{out_image.shape[1]} px')
+    if KEEP_MASKED_GEOTIFF:
+        remove_field_tiles(field_name)
+        save_masked_geotiff(f'{path_to_field_folder}{field_name}_RGB_10_TCI_masked.tiff',
+                            out_image, out_transform, rgb_profile['crs'], 0)
+
+    if RENDERER == 'matplotlib':
+        make_field_image(path_to_field_folder, field_name, out_image, out_transform)
+    else:
+        save_field_image(path_to_field_folder, field_name, out_image)
+
+    convert_rgb_array_to_jpeg(path_to_field_folder, field_name, out_image)
+    return 'Field image created'
+
+
+@timed('ndvi_image')
+async def make_field_ndvi_image_tiff(field_name: str, field_data: gpd.geodataframe.GeoDataFrame,
+                                     bands: dict[str, np.ndarray], meta: dict, ndvi_transform: Affine,
+                                     run_id: str = None, scl: np.ndarray = None) -> tuple[dict, dict]:
+    """Calculates NDVI and the FIELD_INDICES and cretes an NDVI image in memory.
+    Returns the NDVI statistics and the statistics of the other indices of the field."""
     logger.info('make_field_ndvi_image_tiff')
     path_to_field_folder = f'{PATH_FIELDS}{field_name}/'
-    name_unzip_file = name_unzip_file
-    
-    b8 = rio.open(await get_path_to_band_file(name_unzip_file, 'B08_10m.jp2'), driver='JP2OpenJPEG')
-    b4 = rio.open(await get_path_to_band_file(name_unzip_file, 'B04_10m.jp2'), driver='JP2OpenJPEG')
-    red = b4.read()
-    nir = b8.read()
-    ndvi = (nir.astype(float) - red.astype(float)) / (nir+red)
-    meta = b4.meta
-    meta.update(driver='GTiff')
-    meta.update(dtype=rio.float32)
-
-    with rio.open(f'{path_to_field_folder}{field_name}_NDVI_10.tiff', 'w', **meta) as f:
-        f.write(ndvi.astype(rio.float32))
-    field_data = get_field_data_from_geojson(field_name)
-    with rio.open(f'{path_to_field_folder}{field_name}_NDVI_10.tiff') as f:
-        out_image, out_transform = mask(f, field_data.geometry, crop=True)
-        out_meta = f.meta.copy()
-        out_meta.update({"driver": "GTiff",
-                    "height": out_image.shape[1],
-                    "width": out_image.shape[2],
-                    "transform": out_transform})
-        logger.info(f'make_field_ndvi_image_tiff-out_meta: {out_meta}')
-    with rio.open(f'{path_to_field_folder}{field_name}_NDVI_10_masked.tiff', "w", **out_meta) as f:
-        f.write(out_image)
-    
-    path_to_ndvi_masked_tiff = f'{path_to_field_folder}{field_name}_NDVI_10_masked.tiff'
-    middle_ndvi = convert_ndvi_tiff_to_jpeg(path_to_field_folder, field_name, path_to_ndvi_masked_tiff)
-
-    make_ndvi_image(path_to_field_folder, field_name, middle_ndvi)
+    names = get_field_indices()
+    shape = next(iter(bands.values())).shape[1:]
+    index = np.empty((len(names), *shape), dtype=np.float32)
+    for layer, name in enumerate(names):
+        evaluate_index(name, bands, out=index[layer:layer + 1])
+    out_indices, out_transform, cloud_free_fraction = mask_field_index(index, scl, ndvi_transform, field_data)
+    out_image = out_indices[:1]
+    indices_stats = {name: get_index_stats(out_indices[layer:layer + 1], cloud_free_fraction, get_index_range(name))
+                     for layer, name in enumerate(names) if layer}
+    logger.info(f'make_field_ndvi_image_tiff: {out_image.shape[2]}x{out_image.shape[1]} px')
+    if KEEP_MASKED_GEOTIFF:
+        save_masked_geotiff(f'{path_to_field_folder}{field_name}_NDVI_10_masked.tiff',
+                            out_image, out_transform, meta['crs'], np.nan)
 
-    return 'NDVI calculated'
+    ndvi_stats = convert_ndvi_array_to_jpeg(path_to_field_folder, field_name, out_image, run_id, cloud_free_fraction,
+                                            indices_stats)
+
+    if RENDERER == 'matplotlib':
+        make_ndvi_image(path_to_field_folder, field_name, out_image, out_transform, ndvi_stats['middle_ndvi'])
+    else:
+        save_ndvi_image(path_to_field_folder, field_name, out_image, ndvi_stats['middle_ndvi'])
+
+    return ndvi_stats, indices_stats
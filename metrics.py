@@ -0,0 +1,168 @@
+"""Stage timers, resource counters and request latency histograms in the Prometheus text format."""
+import functools
+import inspect
+import multiprocessing
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+HELP = {
+    'agroapi_stage_seconds': ('histogram', 'Time spent in a pipeline stage.'),
+    'agroapi_stage_bytes_read_total': ('counter', 'Bytes read from files and sockets during a pipeline stage.'),
+    'agroapi_peak_rss_bytes': ('gauge', 'Peak resident set size of the API process and the pool workers.'),
+    'agroapi_request_seconds': ('histogram', 'Request latency per endpoint.'),
+    'agroapi_tile_cache_total': ('counter', 'Map tiles served from the memory cache, the disk cache or rendered (miss).'),
+    'agroapi_image_variant_total': ('counter', 'Resized images served from the memory cache, the disk cache or encoded (miss).'),
+    }
+
+_lock = threading.Lock()
+_counters: dict[tuple, float] = {}
+_gauges: dict[tuple, float] = {}
+_histograms: dict[tuple, list] = {}
+
+
+def _key(name: str, labels: dict) -> tuple:
+    return (name, tuple(sorted(labels.items())))
+
+
+def inc(name: str, value: float = 1, **labels) -> None:
+    with _lock:
+        key = _key(name, labels)
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_max(name: str, value: float, **labels) -> None:
+    """Sets the gauge to the value if it is larger, e.g. for peak memory."""
+    with _lock:
+        key = _key(name, labels)
+        _gauges[key] = max(_gauges.get(key, 0), value)
+
+
+def observe(name: str, value: float, **labels) -> None:
+    """Adds the value to the histogram: bucket counts, sum and count."""
+    with _lock:
+        key = _key(name, labels)
+        histogram = _histograms.setdefault(key, [[0] * len(LATENCY_BUCKETS), 0.0, 0])
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                histogram[0][index] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+
+def get_peak_rss() -> int:
+    """Peak resident set size of the process in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def get_bytes_read() -> int:
+    """Bytes read by the process so far (Linux /proc/self/io), 0 where it is not available."""
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def get_process_label() -> str:
+    return 'worker' if multiprocessing.parent_process() is not None else 'api'
+
+
+@contextmanager
+def stage_timer(stage: str):
+    """Records the time, bytes read and peak memory of the stage."""
+    start = time.perf_counter()
+    bytes_read = get_bytes_read()
+    try:
+        yield
+    finally:
+        observe('agroapi_stage_seconds', time.perf_counter() - start, stage=stage)
+        inc('agroapi_stage_bytes_read_total', get_bytes_read() - bytes_read, stage=stage)
+        set_max('agroapi_peak_rss_bytes', get_peak_rss(), process=get_process_label())
+
+
+def timed(stage: str):
+    """Decorator of a sync or async function with stage_timer."""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with stage_timer(stage):
+                    return await func(*args, **kwargs)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with stage_timer(stage):
+                    return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def take_metrics() -> dict:
+    """Returns and clears the metrics of this process. Pool workers send them to the API process."""
+    with _lock:
+        snapshot = {'counters': dict(_counters), 'gauges': dict(_gauges),
+                    'histograms': {key: [list(value[0]), value[1], value[2]] for key, value in _histograms.items()}}
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
+    return snapshot
+
+
+def merge_metrics(snapshot: dict) -> None:
+    """Adds the metrics of a pool worker to the metrics of this process."""
+    with _lock:
+        for key, value in snapshot['counters'].items():
+            _counters[key] = _counters.get(key, 0) + value
+        for key, value in snapshot['gauges'].items():
+            _gauges[key] = max(_gauges.get(key, 0), value)
+        for key, (buckets, total, count) in snapshot['histograms'].items():
+            histogram = _histograms.setdefault(key, [[0] * len(LATENCY_BUCKETS), 0.0, 0])
+            histogram[0] = [a + b for a, b in zip(histogram[0], buckets)]
+            histogram[1] += total
+            histogram[2] += count
+
+
+def _format_labels(labels: tuple, **extra) -> str:
+    items = [*labels, *extra.items()]
+    if not items:
+        return ''
+    return '{' + ','.join(f'{name}="{str(value)}"' for name, value in items) + '}'
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def render_metrics() -> str:
+    """All the metrics in the Prometheus text exposition format."""
+    set_max('agroapi_peak_rss_bytes', get_peak_rss(), process='api')
+    with _lock:
+        series = {}
+        for store in (_counters, _gauges, _histograms):
+            for (name, labels), value in store.items():
+                series.setdefault(name, []).append((labels, value))
+    lines = []
+    for name in sorted(series):
+        kind, description = HELP.get(name, ('untyped', name))
+        lines += [f'# HELP {name} {description}', f'# TYPE {name} {kind}']
+        for labels, value in sorted(series[name], key=lambda item: item[0]):
+            if kind != 'histogram':
+                lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+                continue
+            buckets, total, count = value
+            for bound, bucket_count in zip(LATENCY_BUCKETS, buckets):
+                lines.append(f'{name}_bucket{_format_labels(labels, le=f"{bound:g}")} {bucket_count}')
+            lines.append(f'{name}_bucket{_format_labels(labels, le="+Inf")} {count}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(total)}')
+            lines.append(f'{name}_count{_format_labels(labels)} {count}')
+    return '\n'.join(lines) + '\n'
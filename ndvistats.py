@@ -0,0 +1,61 @@
+"""NDVI and vegetation index statistics of the field computed from the in-memory masked array."""
+import numpy as np
+from settings import MIN_CLOUD_FREE_FRACTION
+
+
+PERCENTILES = (10, 25, 75, 90)
+HISTOGRAM_BINS = 20
+
+
+def get_valid_values(ndvi: np.ma.MaskedArray) -> np.ndarray:
+    """NDVI values inside the field. NaN and inf from zero reflectance are not valid."""
+    return np.ma.masked_invalid(ndvi).compressed()
+
+
+def get_cloud_free_fraction(ndvi: np.ma.MaskedArray, cloud: np.ndarray) -> float:
+    """Fraction of the field pixels that are not masked as cloud, cloud shadow or no data."""
+    field = ~np.ma.getmaskarray(ndvi)
+    field_pixels = int(np.count_nonzero(field))
+    if field_pixels == 0:
+        return 0.0
+    return round(1 - int(np.count_nonzero(cloud & field)) / field_pixels, 4)
+
+
+def get_ndvi_stats(ndvi: np.ma.MaskedArray, cloud_free_fraction: float = None) -> dict:
+    """Statistics of the NDVI (see get_index_stats) with the middle NDVI of the field."""
+    values = get_valid_values(ndvi)
+    middle_ndvi = round(float(values.mean(dtype=np.float64)), 2) if values.size else None
+    return {'middle_ndvi': middle_ndvi, **_get_stats(values, cloud_free_fraction, (-1.0, 1.0))}
+
+
+def get_index_stats(index: np.ma.MaskedArray, cloud_free_fraction: float = None,
+                    value_range: tuple[float, float] = (-1.0, 1.0)) -> dict:
+    """Mean, median, standard deviation, percentiles, histogram and number of valid pixels.
+    Pixels masked out (outside the field or cloudy) are not counted, index = 0 pixels are. The histogram
+    covers `value_range`, values outside it are counted in the first or the last bin.
+    With the cloud-free fraction of the field, the scene is accepted if it is at least MIN_CLOUD_FREE_FRACTION."""
+    return _get_stats(get_valid_values(index), cloud_free_fraction, value_range)
+
+
+def _get_stats(values: np.ndarray, cloud_free_fraction: float | None, value_range: tuple[float, float]) -> dict:
+    counts, edges = np.histogram(np.clip(values, *value_range), bins=HISTOGRAM_BINS, range=value_range)
+    stats = {
+        'mean': None,
+        'median': None,
+        'std': None,
+        'percentiles': {f'p{q}': None for q in PERCENTILES},
+        'histogram': {'bins': [round(float(edge), 2) for edge in edges], 'counts': counts.tolist()},
+        'valid_pixels': int(values.size),
+        }
+    if cloud_free_fraction is not None:
+        stats.update(cloud_free_fraction=cloud_free_fraction, accepted=cloud_free_fraction >= MIN_CLOUD_FREE_FRACTION)
+    if values.size == 0:
+        return stats
+    median, *percentiles = np.percentile(values, (50, *PERCENTILES))
+    stats.update(
+        mean=round(float(values.mean(dtype=np.float64)), 4),
+        median=round(float(median), 4),
+        std=round(float(values.std(dtype=np.float64)), 4),
+        percentiles={f'p{q}': round(float(value), 4) for q, value in zip(PERCENTILES, percentiles)},
+        )
+    return stats
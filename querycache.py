@@ -0,0 +1,58 @@
+"""Cache of the catalogue search results keyed by the normalized footprint and the query parameters."""
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import time
+from loguru import logger
+from shapely import wkt
+from settings import PATH_QUERY_CACHE_DB, QUERY_CACHE_TTL, QUERY_CACHE_MAX_ENTRIES
+
+
+def _connect() -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(PATH_QUERY_CACHE_DB), exist_ok=True)
+    connection = sqlite3.connect(PATH_QUERY_CACHE_DB, timeout=30)
+    connection.row_factory = sqlite3.Row
+    connection.execute("""CREATE TABLE IF NOT EXISTS queries (
+                            key TEXT PRIMARY KEY,
+                            products BLOB NOT NULL,
+                            created_at REAL NOT NULL,
+                            last_used REAL NOT NULL)""")
+    return connection
+
+
+def normalize_footprint(footprint: str) -> str:
+    """WKT of the footprint that does not depend on the vertex order, the start point or the float noise."""
+    return wkt.dumps(wkt.loads(footprint).normalize(), rounding_precision=6)
+
+
+def make_query_key(footprint: str, **query) -> str:
+    params = json.dumps(query, sort_keys=True, default=str)
+    return hashlib.sha256(f'{normalize_footprint(footprint)}|{params}'.encode()).hexdigest()
+
+
+def get_cached_products(key: str) -> dict[str, dict] | None:
+    """Returns the cached search result, or None if there is none or it is older than QUERY_CACHE_TTL."""
+    with _connect() as connection:
+        row = connection.execute('SELECT products, created_at FROM queries WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        if time.time() - row['created_at'] > QUERY_CACHE_TTL:
+            connection.execute('DELETE FROM queries WHERE key = ?', (key,))
+            return None
+        connection.execute('UPDATE queries SET last_used = ? WHERE key = ?', (time.time(), key))
+    return pickle.loads(row['products'])
+
+
+def cache_products(key: str, products: dict[str, dict]) -> None:
+    """Stores the search result, then evicts expired and least recently used results over QUERY_CACHE_MAX_ENTRIES."""
+    now = time.time()
+    with _connect() as connection:
+        connection.execute('INSERT OR REPLACE INTO queries (key, products, created_at, last_used) VALUES (?, ?, ?, ?)',
+                           (key, pickle.dumps(products), now, now))
+        connection.execute('DELETE FROM queries WHERE created_at < ?', (now - QUERY_CACHE_TTL,))
+        evicted = connection.execute('DELETE FROM queries WHERE key IN (SELECT key FROM queries '
+                                     'ORDER BY last_used DESC LIMIT -1 OFFSET ?)', (QUERY_CACHE_MAX_ENTRIES,)).rowcount
+    if evicted:
+        logger.info(f'{evicted} search results evicted from cache')
@@ -0,0 +1,137 @@
+"""In-memory registry of the fields: artifacts, status, scene id and NDVI result."""
+import fnmatch
+import json
+import os
+import shutil
+from loguru import logger
+from settings import PATH_FIELDS
+
+
+URL = str
+
+_fields: dict[str, dict] = {}
+_fields_dir_mtime = None
+
+
+def is_field_name(field_name: str) -> bool:
+    """True if the name can be a field directory: not empty, not the buffer and no path separators."""
+    return bool(field_name) and field_name not in ('.', '..', 'buffer') and '/' not in field_name and '\\' not in field_name
+
+
+def _read_json(path: URL) -> dict:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _scan_field(field_name: str) -> dict | None:
+    """Reads the field directory once. Returns None if there is no such field."""
+    path_dir = f'{PATH_FIELDS}{field_name}'
+    try:
+        mtime = os.stat(path_dir).st_mtime_ns
+        entries = list(os.scandir(path_dir))
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    files = sorted(os.path.join(path_dir, entry.name) for entry in entries if entry.is_file())
+    names = {entry.name for entry in entries}
+    sat_images = sorted(name for name in names if fnmatch.fnmatch(name, 'S*.jpeg'))
+    scene_id = None
+    if f'sat_field_{field_name}.geojson' in names:
+        features = _read_json(f'{path_dir}/sat_field_{field_name}.geojson').get('features') or [{}]
+        scene_id = features[0].get('properties', {}).get('uuid')
+    ndvi = None
+    run_id = None
+    if f'{field_name}_NDVI.json' in names:
+        ndvi_file = _read_json(f'{path_dir}/{field_name}_NDVI.json')
+        ndvi = ndvi_file.get('ndvi_data', {}).get('middle_ndvi')
+        run_id = ndvi_file.get('run_id')
+    if f'{field_name}_NDVI.json' in names:
+        status = 'processed'
+    elif scene_id is not None:
+        status = 'downloaded'
+    else:
+        status = 'created'
+    return {
+        'field_name': field_name,
+        'status': status,
+        'scene_id': scene_id,
+        'middle_ndvi': ndvi,
+        'run_id': run_id,
+        'sat_image': f'{path_dir}/{sat_images[-1]}' if sat_images else None,
+        'files': files,
+        'mtime': mtime,
+        }
+
+
+def load_fields() -> None:
+    """Reads all the field directories, at server startup."""
+    global _fields_dir_mtime
+    _fields.clear()
+    os.makedirs(PATH_FIELDS, exist_ok=True)
+    _fields_dir_mtime = os.stat(PATH_FIELDS).st_mtime_ns
+    for name in os.listdir(PATH_FIELDS):
+        if is_field_name(name):
+            refresh_field(name)
+    logger.info(f'Field registry loaded: {len(_fields)} fields')
+
+
+def refresh_field(field_name: str) -> dict | None:
+    """Re-reads the field directory after the field was made, downloaded or processed."""
+    field = _scan_field(field_name) if is_field_name(field_name) else None
+    if field is None:
+        _fields.pop(field_name, None)
+    else:
+        _fields[field_name] = field
+    return field
+
+
+def remove_field(field_name: str) -> None:
+    """Removes the deleted field from the registry."""
+    _fields.pop(field_name, None)
+
+
+async def delete_data_field(field_name: str) -> str | None:
+    """Deletes all information about the field."""
+    path_to_field_name = f'{PATH_FIELDS}{field_name}'
+    try:
+        shutil.rmtree(path_to_field_name)
+        logger.info(f'Field "{field_name}" removed')
+        return f'Field "{field_name}" removed'
+    except OSError as e:
+        logger.info(f'Error "Field "{field_name}" : {e.strerror}')
+    finally:
+        remove_field(field_name)
+
+
+def get_field(field_name: str) -> dict | None:
+    """Returns the field or None. The directory is re-read only if it changed since the last
+    read, e.g. when another worker processed the field."""
+    if not is_field_name(field_name):
+        return None
+    field = _fields.get(field_name)
+    try:
+        mtime = os.stat(f'{PATH_FIELDS}{field_name}').st_mtime_ns
+    except FileNotFoundError:
+        remove_field(field_name)
+        return None
+    if field is None or field['mtime'] != mtime:
+        field = refresh_field(field_name)
+    return field
+
+
+def list_fields(offset: int = 0, limit: int = None) -> tuple[list[str], int]:
+    """Returns a page of sorted field names and the number of fields."""
+    global _fields_dir_mtime
+    mtime = os.stat(PATH_FIELDS).st_mtime_ns
+    if mtime != _fields_dir_mtime:
+        names = {name for name in os.listdir(PATH_FIELDS) if is_field_name(name)}
+        for name in set(_fields) - names:
+            remove_field(name)
+        for name in names - set(_fields):
+            refresh_field(name)
+        _fields_dir_mtime = mtime
+    names = sorted(_fields)
+    end = None if limit is None else offset + limit
+    return names[offset:end], len(names)
@@ -0,0 +1,124 @@
+"""Fast PNG/JPEG rendering of field and NDVI arrays with NumPy and Pillow, without matplotlib."""
+import io
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+from loguru import logger
+from settings import RENDER_WIDTH
+
+
+URL = str
+
+# Anchor colors of the matplotlib 'RdYlGn' colormap (ColorBrewer), evenly spaced from 0 to 1.
+RDYLGN_COLORS = np.array([
+    (165, 0, 38), (215, 48, 39), (244, 109, 67), (253, 174, 97), (254, 224, 139), (255, 255, 191),
+    (217, 239, 139), (166, 217, 106), (102, 189, 99), (26, 152, 80), (0, 104, 55),
+    ], dtype=np.float64)
+
+
+def make_lut(colors: np.ndarray, size: int = 256) -> np.ndarray:
+    """Lookup table of `size` RGB colors interpolated between the anchor colors."""
+    anchors = np.linspace(0, 1, len(colors))
+    positions = np.linspace(0, 1, size)
+    channels = [np.interp(positions, anchors, colors[:, channel]) for channel in range(3)]
+    return np.round(np.stack(channels, axis=1)).astype(np.uint8)
+
+
+RDYLGN_LUT = make_lut(RDYLGN_COLORS)
+
+LEGEND_HEIGHT = 36
+TITLE_HEIGHT = 16
+
+
+def _scale_to_width(image: Image.Image, width: int) -> Image.Image:
+    height = max(1, round(image.height * width / image.width))
+    return image.resize((width, height), Image.NEAREST)
+
+
+def colorize_ndvi(ndvi: np.ma.MaskedArray, vmin: float, vmax: float) -> Image.Image:
+    """RGBA image of the NDVI array through the RdYlGn lookup table. Masked and NaN pixels are transparent."""
+    ndvi = np.ma.masked_invalid(ndvi[0] if ndvi.ndim == 3 else ndvi)
+    scale = (len(RDYLGN_LUT) - 1) / ((vmax - vmin) or 1)
+    indexes = np.clip((ndvi.filled(vmin) - vmin) * scale, 0, len(RDYLGN_LUT) - 1).astype(np.uint8)
+    rgba = np.empty(indexes.shape + (4,), dtype=np.uint8)
+    rgba[..., :3] = RDYLGN_LUT[indexes]
+    rgba[..., 3] = np.where(np.ma.getmaskarray(ndvi), 0, 255)
+    return Image.fromarray(rgba, 'RGBA')
+
+
+def colorize_rgb(rgb: np.ma.MaskedArray) -> Image.Image:
+    """RGBA image of the RGB array. Pixels masked in all bands are transparent."""
+    rgb = np.ma.asarray(rgb)
+    rgba = np.empty(rgb.shape[1:] + (4,), dtype=np.uint8)
+    rgba[..., :3] = np.moveaxis(rgb.filled(0)[:3], 0, -1)
+    rgba[..., 3] = np.where(np.ma.getmaskarray(rgb).all(axis=0), 0, 255)
+    return Image.fromarray(rgba, 'RGBA')
+
+
+def _add_title(image: Image.Image, title: str) -> Image.Image:
+    canvas = Image.new('RGBA', (image.width, image.height + TITLE_HEIGHT), (255, 255, 255, 255))
+    ImageDraw.Draw(canvas).text((4, 2), title, fill=(0, 0, 0, 255), font=ImageFont.load_default())
+    canvas.alpha_composite(image, (0, TITLE_HEIGHT))
+    return canvas
+
+
+def _add_legend(image: Image.Image, vmin: float, vmax: float) -> Image.Image:
+    canvas = Image.new('RGBA', (image.width, image.height + LEGEND_HEIGHT), (255, 255, 255, 255))
+    canvas.alpha_composite(image)
+    bar_width = max(image.width - 8, 1)
+    bar = RDYLGN_LUT[np.linspace(0, len(RDYLGN_LUT) - 1, bar_width).astype(np.uint8)]
+    bar = np.repeat(bar[np.newaxis, :, :], 10, axis=0)
+    canvas.paste(Image.fromarray(bar, 'RGB'), (4, image.height + 4))
+    draw = ImageDraw.Draw(canvas)
+    font = ImageFont.load_default()
+    label_y = image.height + 18
+    draw.text((4, label_y), f'{vmin:.2f}', fill=(0, 0, 0, 255), font=font)
+    draw.text((image.width // 2 - 12, label_y), 'NDVI', fill=(0, 0, 0, 255), font=font)
+    draw.text((image.width - 36, label_y), f'{vmax:.2f}', fill=(0, 0, 0, 255), font=font)
+    return canvas
+
+
+def render_ndvi_image(ndvi: np.ma.MaskedArray, title: str, legend: bool = True, width: int = RENDER_WIDTH) -> Image.Image:
+    """NDVI image of the field scaled to `width` with a title and an optional colorbar strip.
+    Colors span the NDVI range of the field, as in the matplotlib image."""
+    values = np.ma.masked_invalid(ndvi).compressed()
+    vmin, vmax = (float(values.min()), float(values.max())) if values.size else (-1.0, 1.0)
+    image = _scale_to_width(colorize_ndvi(ndvi, vmin, vmax), width)
+    if legend:
+        image = _add_legend(image, vmin, vmax)
+    return _add_title(image, title)
+
+
+def render_rgb_image(rgb: np.ma.MaskedArray, title: str, width: int = RENDER_WIDTH) -> Image.Image:
+    """RGB image of the field scaled to `width` with a title. Pixels outside the field are transparent."""
+    image = _scale_to_width(colorize_rgb(rgb), width)
+    return _add_title(image, title)
+
+
+def _on_white(image: Image.Image) -> Image.Image:
+    """RGB image with the transparent pixels on a white background, for JPEG."""
+    if image.mode != 'RGBA':
+        return image.convert('RGB')
+    background = Image.new('RGB', image.size, (255, 255, 255))
+    background.paste(image, mask=image.getchannel('A'))
+    return background
+
+
+def save_image(image: Image.Image, path: URL) -> None:
+    """Saves PNG with transparency, or JPEG on a white background."""
+    if path.lower().endswith(('.jpeg', '.jpg')):
+        _on_white(image).save(path, quality=90)
+    else:
+        image.save(path, compress_level=1)
+    logger.info(f'{path} saved')
+
+
+def encode_image(image: Image.Image, image_format: str, quality: int = 85) -> bytes:
+    """PNG or WebP bytes with transparency, or JPEG bytes on a white background."""
+    buffer = io.BytesIO()
+    if image_format == 'jpeg':
+        _on_white(image).save(buffer, 'JPEG', quality=quality)
+    elif image_format == 'webp':
+        image.save(buffer, 'WEBP', quality=quality)
+    else:
+        image.save(buffer, 'PNG', compress_level=6)
+    return buffer.getvalue()
@@ -0,0 +1,151 @@
+"""Shared cache of downloaded satellite scenes keyed by product uuid."""
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid as uuid_module
+from contextlib import contextmanager
+from loguru import logger
+from jobs import get_node_id
+from settings import PATH_SCENE_CACHE, SCENE_CACHE_MAX_BYTES, JOB_LEASE, JOB_HEARTBEAT
+
+
+URL = str
+
+# references held by this process, renewed by the heartbeat thread
+_references: set[str] = set()
+_references_lock = threading.Lock()
+_heartbeat = None
+# a scene without live references: the expired ones of killed processes do not count
+_UNREFERENCED = 'NOT EXISTS (SELECT 1 FROM scene_references WHERE scene_references.uuid = scenes.uuid AND expires_at >= ?)'
+
+
+def _connect() -> sqlite3.Connection:
+    os.makedirs(PATH_SCENE_CACHE, exist_ok=True)
+    connection = sqlite3.connect(f'{PATH_SCENE_CACHE}scenes.sqlite3', timeout=30)
+    connection.row_factory = sqlite3.Row
+    connection.execute("""CREATE TABLE IF NOT EXISTS scenes (
+                            uuid TEXT PRIMARY KEY,
+                            title TEXT,
+                            size INTEGER NOT NULL DEFAULT 0,
+                            last_used REAL NOT NULL)""")
+    connection.execute("""CREATE TABLE IF NOT EXISTS scene_references (
+                            id TEXT PRIMARY KEY,
+                            uuid TEXT NOT NULL,
+                            node TEXT NOT NULL,
+                            expires_at REAL NOT NULL)""")
+    return connection
+
+
+def get_scene_dir(uuid: str) -> URL:
+    """Directory of the scene in the cache."""
+    return f'{PATH_SCENE_CACHE}{uuid}/'
+
+
+def _get_dir_size(path: URL) -> int:
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return size
+
+
+def is_scene_cached(uuid: str, title: str) -> bool:
+    """True if the product zip of the scene is in the cache."""
+    with _connect() as connection:
+        row = connection.execute('SELECT uuid FROM scenes WHERE uuid = ? AND title IS NOT NULL', (uuid,)).fetchone()
+    return row is not None and os.path.exists(f'{get_scene_dir(uuid)}{title}.zip')
+
+
+def register_scene(uuid: str, title: str) -> None:
+    """Records the downloaded scene and its size on disk, then evicts old scenes over budget."""
+    size = _get_dir_size(get_scene_dir(uuid))
+    with _connect() as connection:
+        connection.execute('INSERT INTO scenes (uuid, title, size, last_used) VALUES (?, ?, ?, ?) '
+                           'ON CONFLICT(uuid) DO UPDATE SET title = excluded.title, size = excluded.size, '
+                           'last_used = excluded.last_used', (uuid, title, size, time.time()))
+    logger.info(f'Scene {uuid} cached: {size} bytes')
+    evict_scenes()
+
+
+def update_scene_size(uuid: str) -> None:
+    """Updates the size of the scene after unpacking, then evicts old scenes over budget."""
+    size = _get_dir_size(get_scene_dir(uuid))
+    with _connect() as connection:
+        connection.execute('UPDATE scenes SET size = ? WHERE uuid = ?', (size, uuid))
+    evict_scenes()
+
+
+def _renew_references() -> None:
+    while True:
+        time.sleep(JOB_HEARTBEAT)
+        with _references_lock:
+            references = list(_references)
+        if references:
+            with _connect() as connection:
+                connection.execute(f'UPDATE scene_references SET expires_at = ? WHERE id IN ({", ".join("?" * len(references))})',
+                                   (time.time() + JOB_LEASE, *references))
+
+
+def _start_heartbeat() -> None:
+    global _heartbeat
+    with _references_lock:
+        if _heartbeat is None or not _heartbeat.is_alive():
+            _heartbeat = threading.Thread(target=_renew_references, name='scene-references', daemon=True)
+            _heartbeat.start()
+
+
+@contextmanager
+def use_scene(uuid: str):
+    """Holds a reference to the scene so it is not evicted while a job uses it. The reference of this process
+    expires after JOB_LEASE seconds unless this process renews it, so a killed process does not pin the scene."""
+    reference = uuid_module.uuid4().hex
+    _start_heartbeat()
+    with _connect() as connection:
+        connection.execute('INSERT INTO scenes (uuid, last_used) VALUES (?, ?) '
+                           'ON CONFLICT(uuid) DO UPDATE SET last_used = excluded.last_used', (uuid, time.time()))
+        connection.execute('INSERT INTO scene_references (id, uuid, node, expires_at) VALUES (?, ?, ?, ?)',
+                           (reference, uuid, get_node_id(), time.time() + JOB_LEASE))
+    with _references_lock:
+        _references.add(reference)
+    try:
+        yield get_scene_dir(uuid)
+    finally:
+        with _references_lock:
+            _references.discard(reference)
+        with _connect() as connection:
+            connection.execute('DELETE FROM scene_references WHERE id = ?', (reference,))
+            connection.execute('UPDATE scenes SET last_used = ? WHERE uuid = ?', (time.time(), uuid))
+
+
+def drop_expired_scene_references() -> None:
+    """Drops the references of processes that stopped renewing them, e.g. killed by a restart."""
+    with _connect() as connection:
+        dropped = connection.execute('DELETE FROM scene_references WHERE expires_at < ?', (time.time(),)).rowcount
+    if dropped:
+        logger.info(f'{dropped} expired scene references dropped')
+
+
+def evict_scenes(max_bytes: int = None) -> None:
+    """Deletes least recently used unreferenced scenes until the cache fits the budget."""
+    if max_bytes is None:
+        max_bytes = SCENE_CACHE_MAX_BYTES
+    with _connect() as connection:
+        total = connection.execute('SELECT COALESCE(SUM(size), 0) FROM scenes').fetchone()[0]
+        candidates = connection.execute(f'SELECT uuid, size FROM scenes WHERE {_UNREFERENCED} '
+                                        'ORDER BY last_used', (time.time(),)).fetchall()
+    for scene in candidates:
+        if total <= max_bytes:
+            break
+        with _connect() as connection:
+            deleted = connection.execute(f'DELETE FROM scenes WHERE uuid = ? AND {_UNREFERENCED}',
+                                         (scene['uuid'], time.time())).rowcount
+        if not deleted:
+            continue
+        shutil.rmtree(get_scene_dir(scene['uuid']), ignore_errors=True)
+        total -= scene['size']
+        logger.info(f'Scene {scene["uuid"]} evicted from cache: {scene["size"]} bytes')
@@ -1,20 +1,28 @@
 #FastAPI Server
-from fastapi import FastAPI, Form, UploadFile, File, HTTPException
-from fastapi.responses import Response, JSONResponse
+from fastapi import FastAPI, Form, UploadFile, File, HTTPException, Request, Query
+from fastapi.responses import Response, JSONResponse, PlainTextResponse
+from starlette.routing import Match
 from fastapi.encoders import jsonable_encoder
 from loguru import logger
-from getsatdata import get_data
-from fastapi.responses import FileResponse
 import os
-from makeimages import delete_data_field
-from unpacksatdata import make_data_field
-from settings import PATH_BUFFER, PATH_FIELDS
+from workerpool import shutdown_pool, check_pool_capacity
+from metrics import observe, render_metrics
+from downloads import shutdown_downloads
+from scenecache import drop_expired_scene_references
+from jobs import submit_job, find_active_job, get_job, requeue_expired_jobs, resume_expired_jobs, is_queued_kind
+from registry import get_field, list_fields, load_fields, refresh_field, delete_data_field, is_field_name
+from httpfiles import check_upload_size, save_upload, read_upload, file_response
+from settings import (PATH_FIELDS, PATH_LOGS, QUERY_DATE, QUERY_CLOUD_COVER, CACHE_CONTROL_IMAGES, CACHE_CONTROL_GEOJSON,
+                      CACHE_CONTROL_NDVI, JOB_EXECUTION)
 import json
-import fnmatch
+import time
 from pydantic import BaseModel
 
 
-logger.add("logger/debug.log", format="{time} {level} {message}", level="DEBUG", rotation="5:00")
+# The geospatial stack (geopandas, rasterio, matplotlib, sentinelsat) is imported inside the endpoints that
+# need it, so the API workers start without it. The raster work itself runs in the pool workers.
+
+logger.add(f"{PATH_LOGS}debug.log", format="{time} {level} {message}", level="DEBUG", rotation="5:00")
 
 class Field(BaseModel):
     field_name: str
@@ -26,28 +34,91 @@ class Field(BaseModel):
 app = FastAPI()
 
 
+@app.middleware("http")
+async def measure_latency(request: Request, call_next):
+    """Records the request latency per endpoint: the route path, not the path with parameters."""
+    start = time.perf_counter()
+    response = await call_next(request)
+    path = next((route.path for route in app.routes if route.matches(request.scope)[0] == Match.FULL), 'unmatched')
+    observe('agroapi_request_seconds', time.perf_counter() - start,
+            method=request.method, path=path, status=response.status_code)
+    return response
+
+
+@app.on_event("startup")
+async def load_registry():
+    load_fields()
+
+
+@app.on_event("startup")
+async def reset_scenes():
+    """Drops the scene references of jobs killed by a restart. References of running processes, also on
+    the other nodes sharing the scene cache, are renewed and kept."""
+    drop_expired_scene_references()
+
+
+@app.on_event("startup")
+async def resume_jobs():
+    """Recovers the jobs of stopped processes. Other API processes or worker nodes may be running jobs,
+    only the jobs with an expired lease are recovered. Download jobs need the credentials again and fail."""
+    if JOB_EXECUTION == 'queue':
+        requeue_expired_jobs()
+        return
+    resume_expired_jobs({'make-field-images': make_field_images})
+
+
+async def make_field_images(field_name: str, job_id: str = None) -> str:
+    """Resumed processing job, the geospatial stack is imported only when a job is resumed."""
+    from unpacksatdata import make_data_field
+    return await make_data_field(field_name, job_id=job_id)
+
+
+def make_job_response(job: dict) -> JSONResponse:
+    """Makes a response to the client about the queued job."""
+    content = {"job_id": job['id'], "state": job['state'], "status_url": f"/jobs/{job['id']}"}
+    return JSONResponse(content=content, status_code=202)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    shutdown_pool()
+    shutdown_downloads()
+
+
 @app.get("/")
 async def root():
     logger.info("get '/'")
     return JSONResponse(content={"message":"Hello from Agroapi"}, status_code=200)
 
 
+@app.get("/metrics")
+async def response_metrics():
+    """Returns stage timings, bytes read, peak memory and request latencies in the Prometheus text format."""
+    return PlainTextResponse(content=render_metrics(), media_type="text/plain; version=0.0.4")
+
+
 @app.post("/make-field")
 async def create_upload_file(
+    request: Request,
     file: UploadFile = File(description="name"),
 ):
     """Creating a new field directory. The client sends the file geojson. The server receives the file, creates a field with the file name and puts the starting geojson file in that directory."""
     
     directory_name = str(file.filename).rsplit('.', maxsplit=1)[0]
     logger.info(f"post/make-field'{directory_name}")
-    if directory_name in os.listdir(PATH_BUFFER):
+    if not is_field_name(directory_name):
+        raise HTTPException(status_code=400, detail=f"'{directory_name}' is not a valid field name. Give the file a name without / and \\.")
+    if get_field(directory_name) is not None:
         raise HTTPException(status_code=404, detail=f'This name {directory_name} already exists. Give the field a different name.')
+    check_upload_size(request)
     os.mkdir(f'{PATH_FIELDS}{directory_name}')
     path = f"{PATH_FIELDS}{directory_name}/{file.filename}"
-    with open(path, 'wb') as f:
-        content = await file.read()
-        f.write(content)
-        f.close()
+    try:
+        await save_upload(file, path)
+    except HTTPException:
+        os.rmdir(f'{PATH_FIELDS}{directory_name}')
+        raise
+    refresh_field(directory_name)
     message = f"The directory for the field is created, the directory and 'field_mame' is: {directory_name}"
     logger.info(f"'make-field'.{message}")
     return Response(content=message, media_type="application/json")
@@ -57,136 +128,245 @@ async def create_upload_file(
 async def load_data_field(field_name: str = Form(...), username: str = Form(...), password: str = Form(...)):
     """Loads data from the satellite to the server."""
     logger.info(f"'post/download-sat-field-data'{field_name}")
-    if field_name not in os.listdir(PATH_FIELDS):
+    if get_field(field_name) is None:
         raise HTTPException(status_code=404, detail=f"Field geojson file '{field_name}' not found. Start the 'make-field' process.")
     logger.info(f'path:{field_name}')
-    message = await get_data(field_name, username, password)
-    logger.info(f"'download-sat-field-data'.{message}")
-    return Response(content=message, media_type="application/json")
+    from getsatdata import get_data
+    job = await submit_job('download-sat-field-data', field_name, get_data, field_name, username, password)
+    logger.info(f"'download-sat-field-data'.job {job['id']}")
+    return make_job_response(job)
 
 
 @app.post("/run-make-field-images")
 async def response_field(field_name: str = Form(...)):
     """Runs the process of creating field and NDVI images."""
     logger.info(f"'post/run-make-field-images'{field_name}")
-    if field_name not in os.listdir(PATH_FIELDS):
+    if get_field(field_name) is None:
         raise HTTPException(status_code=404, detail=f"Field geojson file '{field_name}' not found. Start the 'make-field' process.")
-    message = await make_data_field(field_name)
-    logger.info(f"'run-make-field-images'{message}")
-    return Response(content=message, media_type="application/json")
+    if is_queued_kind('make-field-images'):
+        # the worker nodes process the field, the API node does not load the geospatial stack
+        job = await submit_job('make-field-images', field_name, None, field_name)
+    else:
+        if find_active_job('make-field-images', field_name) is None:
+            check_pool_capacity()
+        from unpacksatdata import make_data_field
+        job = await submit_job('make-field-images', field_name, make_data_field, field_name)
+    logger.info(f"'run-make-field-images'.job {job['id']}")
+    return make_job_response(job)
+
+
+@app.post("/run-make-fields-batch")
+async def response_fields_batch(request: Request, file: UploadFile = File(None), field_names: str = Form(''),
+                                username: str = Form(''), password: str = Form('')):
+    """Runs the process of creating images for many fields. The client sends a multi-feature geojson
+    file, or a comma-separated list of existing fields. Fields on one scene are processed together."""
+    names = [name.strip() for name in field_names.split(',') if name.strip()]
+    logger.info(f"'post/run-make-fields-batch'{names}")
+    missing_fields = [name for name in names if get_field(name) is None]
+    if missing_fields:
+        raise HTTPException(status_code=404, detail=f"Fields {missing_fields} not found. Start the 'make-field' process.")
+    from batch import make_fields_from_geojson, run_batch
+    batch_name = str(file.filename).rsplit('.', maxsplit=1)[0] if file is not None else ','.join(names)
+    if file is None and not names:
+        raise HTTPException(status_code=404, detail='No fields. Send a geojson file or field names.')
+    # before the fields are created, so the client can retry the same file after a 503
+    if find_active_job('make-fields-batch', batch_name) is None:
+        check_pool_capacity()
+    if file is not None:
+        check_upload_size(request)
+        names += await make_fields_from_geojson(batch_name, await read_upload(file))
+    if not names:
+        raise HTTPException(status_code=404, detail='No fields. Send a geojson file or field names.')
+    job = await submit_job('make-fields-batch', batch_name, run_batch, names, username, password)
+    logger.info(f"'run-make-fields-batch'.job {job['id']}")
+    return make_job_response(job)
+
+
+@app.post("/run-field-ndvi-series")
+async def response_field_ndvi_series(field_name: str = Form(...), username: str = Form(...), password: str = Form(...),
+                                     date_from: str = Form(QUERY_DATE[0]), date_to: str = Form(QUERY_DATE[1]),
+                                     max_cloud: float = Form(QUERY_CLOUD_COVER[1])):
+    """Runs the NDVI time series of the field: every acquisition in the date range with cloud cover
+    up to max_cloud. Dates already in the series are not processed again."""
+    logger.info(f"'post/run-field-ndvi-series'{field_name} {date_from}-{date_to}")
+    if get_field(field_name) is None:
+        raise HTTPException(status_code=404, detail=f"Field geojson file '{field_name}' not found. Start the 'make-field' process.")
+    from timeseries import run_ndvi_series, parse_series_date
+    try:
+        date_from, date_to = (parse_series_date(value).strftime('%Y%m%d') for value in (date_from, date_to))
+    except ValueError:
+        raise HTTPException(status_code=400, detail='Dates must be in the format YYYYMMDD or YYYY-MM-DD.')
+    if find_active_job('ndvi-series', field_name) is None:
+        check_pool_capacity()
+    job = await submit_job('ndvi-series', field_name, run_ndvi_series, field_name, date_from, date_to, max_cloud,
+                           username, password)
+    logger.info(f"'run-field-ndvi-series'.job {job['id']}")
+    return make_job_response(job)
+
+
+@app.get("/jobs/{job_id}")
+async def response_job(job_id: str):
+    """Returns the state, progress stage, timing and error of the job."""
+    logger.info(f"'get/jobs':{job_id}")
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job '{job_id}' not found")
+    return JSONResponse(content=job, status_code=200)
 
 
 @app.get("/fields-name-files")
-async def get_fields_registry(field_name: str = ''):
+async def get_fields_registry(field_name: str = '', offset: int = 0, limit: int = 1000):
     """Returns to the client the list of files in the field directory."""
     logger.info(f"'get/fields-name-files':{field_name}")
-    if field_name not in os.listdir(PATH_FIELDS):
+    field = get_field(field_name)
+    if field is None:
         raise HTTPException(status_code=404, detail=f"'{field_name}' not found")
-    path_dir = f'{PATH_FIELDS}{field_name}'
-    file_list = []
-    for name in os.listdir(path_dir):
-        path = os.path.join(path_dir, name)
-        if os.path.isfile(path):
-            file_list.append(path)
+    file_list = field['files'][offset:offset + limit]
     files_js = jsonable_encoder(file_list)
-    return JSONResponse(content={f"{field_name}":files_js}, status_code=200)
-
-
+    return JSONResponse(content={f"{field_name}":files_js, "total": len(field['files'])}, status_code=200)
 
 
 @app.get("/fields-names")
-async def get_fields_registry():
+async def get_fields_registry(offset: int = 0, limit: int = 1000):
     """Returns a list of saved field directories to the client."""
     logger.info('get/fields-name-files')
-    path_dir = PATH_FIELDS
-    file_list = []
-    file_list.clear
-    for name in os.listdir(path_dir):
-        if name != 'buffer':
-            path = os.path.join(path_dir, name)
-            file_list.append(path)
+    names, total = list_fields(offset, limit)
+    file_list = [os.path.join(PATH_FIELDS, name) for name in names]
     files_js = jsonable_encoder(file_list)
-    return JSONResponse(content={"fields":files_js}, status_code=200)
+    return JSONResponse(content={"fields":files_js, "total": total}, status_code=200)
+
+
+@app.get("/field-status")
+async def response_field_status(field_name: str = ''):
+    """Returns the status, scene id and middle NDVI of the field."""
+    logger.info(f"'get/field-status':{field_name}")
+    field = get_field(field_name)
+    if field is None:
+        raise HTTPException(status_code=404, detail=f"'{field_name}' not found")
+    content = {key: field[key] for key in ('field_name', 'status', 'scene_id', 'middle_ndvi')}
+    return JSONResponse(content=content, status_code=200)
+
+
+@app.get("/field-ndvi-series")
+async def response_ndvi_series(field_name: str = '', date_from: str = '', date_to: str = ''):
+    """Returns the NDVI statistics of every acquisition date of the field, optionally in a date range."""
+    logger.info(f"'get/field-ndvi-series':{field_name}")
+    if get_field(field_name) is None:
+        raise HTTPException(status_code=404, detail=f"'{field_name}' not found")
+    from timeseries import read_ndvi_series, ndvi_series_to_records
+    try:
+        series = ndvi_series_to_records(read_ndvi_series(field_name), date_from, date_to)
+    except ValueError:
+        raise HTTPException(status_code=400, detail='Dates must be in the format YYYYMMDD or YYYY-MM-DD.')
+    return JSONResponse(content={"field_name": field_name, "series": series}, status_code=200)
 
 
 @app.get("/sat-image")
-async def response_sat_image(field_name: str = ''):
+async def response_sat_image(request: Request, field_name: str = ''):
     """Returns JPEG image of the satellite image to the client."""
     logger.info(f"'get/sat-image':{field_name}")
-    if field_name not in os.listdir(PATH_FIELDS):
+    field = get_field(field_name)
+    if field is None or field['sat_image'] is None:
+        raise HTTPException(status_code=404, detail=f"'{field_name}' not found")
+    return file_response(request, field['sat_image'], CACHE_CONTROL_IMAGES)
+
+
+@app.get("/tiles/{field_name}/{layer}/{z}/{x}/{y}.png")
+async def response_tile(request: Request, field_name: str, layer: str, z: int, x: int, y: int):
+    """Returns a WebMercator XYZ map tile (PNG) of the field NDVI or RGB raster. Layers: 'ndvi', 'rgb'."""
+    field = get_field(field_name)
+    if field is None:
         raise HTTPException(status_code=404, detail=f"'{field_name}' not found")
-    path_list = os.listdir(f'{PATH_FIELDS}{field_name}/')
-    for file_name in path_list:
-        if fnmatch.fnmatch(file_name, 'S*.jpeg'):
-            path_file = f'{PATH_FIELDS}{field_name}/{file_name}'
-    return FileResponse(path_file)
+    from tiles import tile_response
+    return await tile_response(request, field_name, layer, z, x, y, field['run_id'])
 
 
 @app.get("/field-image")
-async def response_field_image(field_name: str = ''):
-    """Returns PNG image of the field to the client."""
+async def response_field_image(request: Request, field_name: str = '', width: int = None,
+                               image_format: str = Query(None, alias='format')):
+    """Returns PNG image of the field to the client. With width or format (png, jpeg, webp) the image
+    is scaled down to the width and encoded in the format."""
     logger.info(f"'get/field-image':{field_name}")
-    if field_name not in os.listdir(PATH_FIELDS):
+    field = get_field(field_name)
+    if field is None:
         raise HTTPException(status_code=404, detail=f"'{field_name}' not found")
+    if width is not None or image_format is not None:
+        from imagevariants import variant_response
+        return await variant_response(request, field_name, 'field', width, image_format, field['run_id'])
     path_file = f'{PATH_FIELDS}{field_name}/{field_name}_RGB_10_TCI_field.png'
-    return FileResponse(path_file)
+    return file_response(request, path_file, CACHE_CONTROL_IMAGES, field['run_id'])
 
 
 @app.get("/ndvi-image")
-async def response_ndvi_image(field_name: str = ''):
-    """Returns PNG image of the NDVI field to the client."""
+async def response_ndvi_image(request: Request, field_name: str = '', width: int = None,
+                              image_format: str = Query(None, alias='format')):
+    """Returns PNG image of the NDVI field to the client. With width or format (png, jpeg, webp) the image
+    is scaled down to the width and encoded in the format."""
     logger.info(f"'get/ndvi-image':{field_name}")
-    if field_name not in os.listdir(PATH_FIELDS):
+    field = get_field(field_name)
+    if field is None:
         raise HTTPException(status_code=404, detail=f"'{field_name}' not found")
+    if width is not None or image_format is not None:
+        from imagevariants import variant_response
+        return await variant_response(request, field_name, 'ndvi', width, image_format, field['run_id'])
     path_file = f'{PATH_FIELDS}{field_name}/{field_name}_NDVI_10_field.png'
-    return FileResponse(path_file)
+    return file_response(request, path_file, CACHE_CONTROL_IMAGES, field['run_id'])
 
 
 @app.get("/field-image_jpeg")
-async def response_ndvi_image(field_name: str = ''):
-    """Returns JPEG image of the field to the client."""
+async def response_ndvi_image(request: Request, field_name: str = '', width: int = None,
+                              image_format: str = Query(None, alias='format')):
+    """Returns JPEG image of the field to the client. With width or format (png, jpeg, webp) the image
+    is scaled down to the width and encoded in the format."""
     logger.info(f"'get/field-image_jpeg':{field_name}")
-    if field_name not in os.listdir(PATH_FIELDS):
+    field = get_field(field_name)
+    if field is None:
         raise HTTPException(status_code=404, detail=f"'{field_name}' not found")
+    if width is not None or image_format is not None:
+        from imagevariants import variant_response
+        return await variant_response(request, field_name, 'field_jpeg', width, image_format, field['run_id'])
     path_file = f'{PATH_FIELDS}{field_name}/{field_name}_RGB_10_TCI_masked.jpeg'
-    return FileResponse(path_file)
+    return file_response(request, path_file, CACHE_CONTROL_IMAGES, field['run_id'])
 
 
 @app.get("/field-geojson")
-async def response_field_geojson(field_name: str = ''):
+async def response_field_geojson(request: Request, field_name: str = ''):
     """Returns the initial geojson file to the client."""
     logger.info(f"'get/field-geojson':{field_name}")
-    if field_name not in os.listdir(PATH_FIELDS):
+    field = get_field(field_name)
+    if field is None:
         raise HTTPException(status_code=404, detail=f"'{field_name}' not found")
     path_file = f'{PATH_FIELDS}{field_name}/{field_name}.geojson'
-    return FileResponse(path_file)
+    return file_response(request, path_file, CACHE_CONTROL_GEOJSON)
 
 
 @app.get("/sat-geojson")
-async def response_sat_geojson(field_name: str = ''):
+async def response_sat_geojson(request: Request, field_name: str = ''):
     """Returns the geojson satellite product file to the client."""
     logger.info(f"'get/sat-geojson':{field_name}")
-    if field_name not in os.listdir(PATH_FIELDS):
+    field = get_field(field_name)
+    if field is None:
         raise HTTPException(status_code=404, detail=f"'{field_name}' not found")
     path_file = f'{PATH_FIELDS}{field_name}/sat_field_{field_name}.geojson'
-    return FileResponse(path_file)
+    return file_response(request, path_file, CACHE_CONTROL_GEOJSON)
 
 
 @app.get("/field-middle-ndvi")
-async def response_ndvi(field_name: str = ''):
+async def response_ndvi(request: Request, field_name: str = ''):
     "Returns the middle value of the NDVI field to the client."
     logger.info(f"'get/field-middle-ndvi':{field_name}")
-    if field_name not in os.listdir(PATH_FIELDS):
+    field = get_field(field_name)
+    if field is None:
         raise HTTPException(status_code=404, detail=f"'{field_name}' not found")
     path_file = f'{PATH_FIELDS}{field_name}/{field_name}_NDVI.json'
-    return FileResponse(path_file)
+    return file_response(request, path_file, CACHE_CONTROL_NDVI, field['run_id'])
 
 
 @app.delete("/delete_field")
 async def delete_car(field_name: str = ''):
     """Deletes all information about the field."""
     logger.info(f"'delete/delete_field':{field_name}")
-    if field_name not in os.listdir(PATH_FIELDS):
+    if get_field(field_name) is None:
         raise HTTPException(status_code=404, detail=f"Field '{field_name}' not found. Start the 'make-field' process.")
     message = await delete_data_field(field_name)
     logger.info(f"'delete_field''{message}")
@@ -1,7 +1,131 @@
+import os
 
 
-PATH_BUFFER = './fields/buffer/'
-PATH_FIELDS = './fields/'
+# Root of the fields/ and fields/buffer/ directories. API and worker nodes on several machines share the
+# fields through the same root, e.g. an NFS mount.
+STORAGE_ROOT = os.environ.get('AGROAPI_STORAGE_ROOT', '.')
+PATH_FIELDS = f'{STORAGE_ROOT}/fields/'
+PATH_BUFFER = f'{PATH_FIELDS}buffer/'
+# Log files of this node, not shared with the other nodes.
+PATH_LOGS = os.environ.get('AGROAPI_LOG_DIR', 'logger/')
+
+# Decode only the pixel window around the field instead of the whole 10980x10980 tile.
+WINDOWED_READS = True
+# Extra pixels read around the field bounds in windowed mode.
+WINDOW_MARGIN = 16
+# Windows of fields on one scene are decoded together while their union is at most this multiple of
+# their area, fields far apart are decoded in their own windows.
+WINDOW_MERGE_MAX_RATIO = 2
+# Parsed, reprojected geometries and pixel windows of the fields kept in memory by each process.
+FIELD_GEOMETRY_CACHE_SIZE = 256
+
+# Worker processes for unzip/raster/render jobs.
+PROCESS_POOL_SIZE = 2
+# Jobs allowed to wait for a free worker before requests get 503.
+PROCESS_POOL_MAX_QUEUE = 8
+# Modules with the geospatial stack imported by the pool workers before the first job. The API process
+# imports them only when an endpoint needs them.
+POOL_PRELOAD_MODULES = ('makeimages', 'unpacksatdata', 'timeseries')
+
+# SQLite store of download and processing jobs. It is also the queue of the worker nodes.
+PATH_JOBS_DB = os.environ.get('AGROAPI_JOBS_DB', f'{PATH_BUFFER}jobs.sqlite3')
+# 'local': the API process runs the jobs. 'queue': the API nodes only enqueue the jobs of QUEUE_JOB_KINDS and
+# the worker nodes (python worker.py) run them. Jobs with satellite credentials always run on the API node
+# that received them, the passwords are not written to the queue.
+JOB_EXECUTION = os.environ.get('AGROAPI_JOB_EXECUTION', 'local')
+QUEUE_JOB_KINDS = ('make-field-images',)
+# A running job holds a lease renewed every JOB_HEARTBEAT seconds. The job of a node that stopped renewing
+# it is queued again, at most JOB_MAX_ATTEMPTS times.
+JOB_LEASE = 60
+JOB_HEARTBEAT = 15
+JOB_MAX_ATTEMPTS = 3
+# Seconds a worker node waits before it polls the queue again, and the jobs it runs at once.
+WORKER_POLL_INTERVAL = 2
+WORKER_CONCURRENCY = PROCESS_POOL_SIZE
+
+# Downloaded scenes shared by all fields, keyed by product uuid.
+PATH_SCENE_CACHE = f'{PATH_BUFFER}scenes/'
+# Disk budget of the scene cache, least recently used scenes are evicted.
+SCENE_CACHE_MAX_BYTES = 20 * 1024 ** 3
+
+# Band files used by the pipeline, only these are taken from the product zip.
+PIPELINE_BANDS = ('TCI_10m.jp2', 'B04_10m.jp2', 'B08_10m.jp2', 'SCL_20m.jp2')
+# Vegetation indices computed for every field besides NDVI: 'EVI', 'NDWI', 'SAVI', 'NDRE' (indices.py).
+# Their statistics are in the field NDVI file under 'indices', their bands are added to PIPELINE_BANDS.
+FIELD_INDICES = ()
+# The index engine evaluates blocks of this many rows of the field window in INDEX_THREADS threads.
+INDEX_BLOCK_ROWS = 256
+INDEX_THREADS = 4
+# Read bands straight from the product zip through GDAL /vsizip/ instead of extracting them.
+READ_BANDS_FROM_ZIP = True
+
+# NDVI pixels of these Level-2A scene classes (SCL band) are masked before the statistics: no data,
+# defective, cloud shadow, cloud medium and high probability, thin cirrus.
+CLOUD_MASK = True
+SCL_MASKED_CLASSES = (0, 1, 3, 8, 9, 10)
+# A scene is accepted for the field if at least this fraction of the field is cloud free.
+MIN_CLOUD_FREE_FRACTION = 0.6
+
+# Field and NDVI PNG renderer: 'fast' (NumPy + Pillow) or 'matplotlib' (axes with coordinates, for reports).
+RENDERER = 'fast'
+# Width in pixels of the images made by the fast renderer.
+RENDER_WIDTH = 480
+
+# Also save the masked field and NDVI rasters as Cloud-Optimized GeoTIFFs (<field>_*_masked.tiff) with
+# overviews. The map tiles are made from them.
+KEEP_MASKED_GEOTIFF = True
+
+# XYZ WebMercator map tiles of the masked rasters: tile size, deepest zoom and the NDVI color range.
+TILE_SIZE = 256
+TILE_MAX_ZOOM = 22
+TILE_NDVI_RANGE = (0.0, 1.0)
+# Rendered PNG tiles kept in memory and on disk in the field tiles/ directory, the least recently used are
+# dropped above these sizes. The disk budget is per field.
+TILE_CACHE_MAX_BYTES = 64 * 1024 ** 2
+TILE_DISK_CACHE_MAX_BYTES = 256 * 1024 ** 2
+
+# Field and NDVI images are also served resized (?width=) and as PNG, JPEG or WebP (?format=). Variants of
+# these widths and formats are made at the end of the processing, the others on the first request.
+IMAGE_VARIANT_WIDTHS = (320, 640)
+IMAGE_VARIANT_FORMATS = ('webp', 'jpeg')
+IMAGE_MAX_WIDTH = 4096
+IMAGE_QUALITY = 85
+# Encoded variants kept in memory, least recently used are dropped. The preset variants are also kept on disk
+# in the field variants/ directory, up to IMAGE_DISK_CACHE_MAX_BYTES per field.
+IMAGE_CACHE_MAX_BYTES = 64 * 1024 ** 2
+IMAGE_DISK_CACHE_MAX_BYTES = 32 * 1024 ** 2
+
+# Largest accepted geojson upload and the chunk size it is written with.
+MAX_UPLOAD_BYTES = 10 * 1024 ** 2
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Parallel satellite downloads, at most DOWNLOAD_PER_HOST_LIMIT at once from one host. Failed
+# transfers are retried and continue from the partial file.
+DOWNLOAD_WORKERS = 4
+DOWNLOAD_PER_HOST_LIMIT = 2
+DOWNLOAD_CHUNK_SIZE = 1024 ** 2
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_TIMEOUT = 60
+# Authenticated SentinelAPI sessions are reused per user for this many seconds.
+DOWNLOAD_SESSION_TTL = 30 * 60
+
+# Catalogue search: the date range, cloud cover and processing level of the products.
+QUERY_DATE = ('20220415', '20220615')
+QUERY_PLATFORM = 'Sentinel-2'
+QUERY_PROCESSING_LEVEL = 'Level-2A'
+QUERY_CLOUD_COVER = (0, 10)
+QUERY_LIMIT = 1
+# Search results are reused for the same footprint and query for QUERY_CACHE_TTL seconds.
+PATH_QUERY_CACHE_DB = f'{PATH_BUFFER}queries.sqlite3'
+QUERY_CACHE_TTL = 6 * 60 * 60
+QUERY_CACHE_MAX_ENTRIES = 1000
+
+# Cache-Control of the served files. Images and NDVI change with every processing run and are
+# revalidated with the ETag; the field geojson only changes when the field is made again.
+CACHE_CONTROL_IMAGES = 'public, max-age=300, must-revalidate'
+CACHE_CONTROL_GEOJSON = 'public, max-age=3600, must-revalidate'
+CACHE_CONTROL_NDVI = 'no-cache'
+CACHE_CONTROL_TILES = 'public, max-age=300, must-revalidate'
 
 
 PATH_SCIHUB = ['https://scihub.copernicus.eu/dhus/',
@@ -0,0 +1,46 @@
+import asyncio
+import json
+import pytest
+from fastapi import HTTPException
+import batch
+
+
+def make_geojson(*names: str) -> bytes:
+    features = [{'type': 'Feature', 'properties': {'name': name},
+                 'geometry': {'type': 'Point', 'coordinates': [37.0, 55.0]}} for name in names]
+    return json.dumps({'type': 'FeatureCollection', 'features': features}).encode()
+
+
+@pytest.mark.parametrize('name', ['../x', 'buffer', 'a/b'])
+def test_path_like_names_are_rejected(tmp_path, monkeypatch, name):
+    monkeypatch.setattr(batch, 'PATH_FIELDS', f'{tmp_path}/fields/')
+    (tmp_path / 'fields').mkdir()
+    with pytest.raises(HTTPException) as ex:
+        asyncio.run(batch.make_fields_from_geojson('batch', make_geojson('ok', name)))
+    assert ex.value.status_code == 400
+    assert sorted(path.name for path in tmp_path.rglob('*')) == ['fields']
+
+
+def test_scenes_are_processed_within_the_pool_size(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch, 'PATH_FIELDS', f'{tmp_path}/')
+    field_names = [f'field{number}' for number in range(12)]
+    for field_name in field_names:
+        (tmp_path / field_name).mkdir()
+        (tmp_path / field_name / f'sat_field_{field_name}.geojson').touch()
+    running = []
+
+    async def get_product_of_field(field_name):
+        return f'scene-{field_name}', 'title'
+
+    async def make_data_fields(names, job_id=None):
+        running.append(names)
+        assert len(running) <= batch.PROCESS_POOL_SIZE
+        await asyncio.sleep(0.01)
+        running.remove(names)
+        return {name: {'error': None} for name in names}
+
+    monkeypatch.setattr(batch, 'get_product_of_field', get_product_of_field)
+    monkeypatch.setattr(batch, 'make_data_fields', make_data_fields)
+    result = asyncio.run(batch.run_batch(field_names))
+    assert all(field['error'] is None for field in result['fields'].values())
+    assert len(result['fields']) == 12
@@ -0,0 +1,86 @@
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import requests
+import downloads
+
+
+DATA = os.urandom(300_000)
+
+
+class ProductHandler(BaseHTTPRequestHandler):
+    """Stand-in for the product server: serves DATA with Range support and counts parallel requests."""
+    active = 0
+    max_active = 0
+    ranges = []
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with ProductHandler.lock:
+            ProductHandler.active += 1
+            ProductHandler.max_active = max(ProductHandler.max_active, ProductHandler.active)
+        try:
+            time.sleep(0.05)
+            range_header = self.headers.get('Range')
+            ProductHandler.ranges.append(range_header)
+            start = int(range_header.split('=')[1].rstrip('-')) if range_header else 0
+            self.send_response(206 if range_header else 200)
+            self.send_header('Content-Length', str(len(DATA) - start))
+            self.end_headers()
+            self.wfile.write(DATA[start:])
+        finally:
+            with ProductHandler.lock:
+                ProductHandler.active -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server_url():
+    ProductHandler.max_active = 0
+    ProductHandler.ranges = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ProductHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+
+
+def test_download_resumes_partial_file(server_url, tmp_path):
+    path = tmp_path / 'product.zip'
+    (tmp_path / 'product.zip.incomplete').write_bytes(DATA[:1000])
+    downloads.download_file(requests.Session(), f'{server_url}/product', str(path),
+                            hashlib.md5(DATA).hexdigest(), size=len(DATA))
+    assert ProductHandler.ranges == ['bytes=1000-']
+    assert path.read_bytes() == DATA
+    assert not (tmp_path / 'product.zip.incomplete').exists()
+
+
+def test_download_checksum_mismatch(server_url, tmp_path):
+    path = tmp_path / 'product.zip'
+    with pytest.raises(downloads.ChecksumError):
+        downloads.download_file(requests.Session(), f'{server_url}/product', str(path), '0' * 32)
+    assert not path.exists()
+    assert not (tmp_path / 'product.zip.incomplete').exists()
+
+
+def test_parallel_downloads_per_host_limit(server_url, tmp_path, monkeypatch):
+    monkeypatch.setattr(downloads, 'DOWNLOAD_PER_HOST_LIMIT', 2)
+    items = [{'url': f'{server_url}/{i}', 'path': str(tmp_path / f'{i}.zip')} for i in range(6)]
+    paths = asyncio.run(downloads.download_files(requests.Session(), items))
+    assert all(open(path, 'rb').read() == DATA for path in paths)
+    assert ProductHandler.max_active == 2
+
+
+def test_session_reused_until_ttl(monkeypatch):
+    monkeypatch.setattr(downloads, '_sessions', {})
+    session = downloads.get_session('user', 'password', requests.Session)
+    assert downloads.get_session('user', 'password', requests.Session) is session
+    assert downloads.get_session('user', 'other', requests.Session) is not session
+    monkeypatch.setattr(downloads, 'DOWNLOAD_SESSION_TTL', -1)
+    assert downloads.get_session('user', 'password', requests.Session) is not session
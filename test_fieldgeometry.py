@@ -0,0 +1,40 @@
+import os
+import geopandas as gpd
+from rasterio.crs import CRS
+from shapely.geometry import box
+import fieldgeometry
+
+
+def write_field(path_to_fields, field_name: str, left: float) -> None:
+    os.makedirs(f'{path_to_fields}/{field_name}', exist_ok=True)
+    field = gpd.GeoDataFrame(geometry=[box(left, 55.9, left + 0.01, 55.91)], crs='EPSG:4326')
+    field.to_file(f'{path_to_fields}/{field_name}/{field_name}.geojson', driver='GeoJSON')
+
+
+def test_geometry_is_reprojected_once_per_crs(tmp_path, monkeypatch):
+    monkeypatch.setattr(fieldgeometry, 'PATH_FIELDS', f'{tmp_path}/')
+    write_field(tmp_path, 'field', 37.5)
+    utm_37 = fieldgeometry.get_field_geometry('field', CRS.from_epsg(32637))
+    assert fieldgeometry.get_field_geometry('field', CRS.from_epsg(32637)) is utm_37
+    utm_36 = fieldgeometry.get_field_geometry('field', CRS.from_epsg(32636))
+    assert utm_36.crs.to_epsg() == 32636
+    assert tuple(utm_36.total_bounds) != tuple(utm_37.total_bounds)
+
+
+def test_uploaded_field_replaces_cached_geometry(tmp_path, monkeypatch):
+    monkeypatch.setattr(fieldgeometry, 'PATH_FIELDS', f'{tmp_path}/')
+    write_field(tmp_path, 'field', 37.5)
+    old = fieldgeometry.get_field_geometry('field', CRS.from_epsg(32637))
+    write_field(tmp_path, 'field', 37.6)
+    new = fieldgeometry.get_field_geometry('field', CRS.from_epsg(32637))
+    assert new.total_bounds[0] > old.total_bounds[0]
+
+
+def test_least_recently_used_geometries_are_dropped(tmp_path, monkeypatch):
+    monkeypatch.setattr(fieldgeometry, 'PATH_FIELDS', f'{tmp_path}/')
+    monkeypatch.setattr(fieldgeometry, 'FIELD_GEOMETRY_CACHE_SIZE', 2)
+    for number in range(3):
+        write_field(tmp_path, f'field_{number}', 37.5 + number / 100)
+        fieldgeometry.get_field_geometry(f'field_{number}', CRS.from_epsg(32637))
+    assert list(fieldgeometry._sources) == ['field_1', 'field_2']
+    assert [key[0] for key in fieldgeometry._geometries] == ['field_1', 'field_2']
@@ -0,0 +1,43 @@
+import pytest
+from fastapi import FastAPI, Request
+from httpx import AsyncClient
+from httpfiles import file_response, _parse_range
+
+
+def make_app(path):
+    app = FastAPI()
+
+    @app.get("/file")
+    async def response_file(request: Request):
+        return file_response(request, path, 'no-cache', 'run')
+
+    return app
+
+
+def test_parse_range():
+    assert _parse_range('bytes=0-9', 100) == (0, 9)
+    assert _parse_range('bytes=90-', 100) == (90, 99)
+    assert _parse_range('bytes=-10', 100) == (90, 99)
+    assert _parse_range('bytes=95-200', 100) == (95, 99)
+    assert _parse_range('bytes=100-', 100) is None
+    assert _parse_range('bytes=0-1,5-6', 100) is None
+
+
+@pytest.mark.anyio
+async def test_file_response_conditional_and_range(tmp_path):
+    path = tmp_path / 'image.png'
+    path.write_bytes(bytes(range(100)))
+    async with AsyncClient(app=make_app(str(path)), base_url="http://test") as ac:
+        response = await ac.get("/file")
+        etag = response.headers['etag']
+        assert response.status_code == 200
+        assert response.headers['cache-control'] == 'no-cache'
+        assert (await ac.get("/file", headers={'If-None-Match': etag})).status_code == 304
+        response = await ac.get("/file", headers={'Range': 'bytes=10-19'})
+        assert response.status_code == 206
+        assert response.content == bytes(range(10, 20))
+        assert response.headers['content-range'] == 'bytes 10-19/100'
+        response = await ac.get("/file", headers={'Range': 'bytes=200-'})
+        assert response.status_code == 416
+        response = await ac.get("/file", headers={'Range': 'bytes=10-19', 'If-Range': '"old"'})
+        assert response.status_code == 200
@@ -0,0 +1,30 @@
+import os
+from imagecache import ImageCache
+
+
+def test_memory_is_bounded_by_bytes():
+    cache = ImageCache('test_cache_total', 25, 100)
+    for key in ('a', 'b', 'c'):
+        cache.get((key,), lambda: b'x' * 10)
+    assert list(cache._images) == [('b',), ('c',)]
+    assert cache._memory_bytes == 20
+
+
+def test_disk_is_bounded_by_bytes_per_directory(tmp_path):
+    path_dir = f'{tmp_path}/tiles/'
+    os.makedirs(f'{path_dir}old')
+    with open(f'{path_dir}old/0.png', 'wb') as f:
+        f.write(b'o' * 10)
+    cache = ImageCache('test_cache_total', 0, 25)
+    for name in ('1.png', '2.png'):
+        cache.get((name,), lambda: b'x' * 10, path_dir, name)
+    assert sorted(os.listdir(path_dir)) == ['1.png', '2.png', 'old']
+    assert not os.listdir(f'{path_dir}old')
+    assert cache.get(('1.png',), lambda: None, path_dir, '1.png') == b'x' * 10
+
+
+def test_images_not_worth_a_file_stay_in_memory(tmp_path):
+    cache = ImageCache('test_cache_total', 100, 100, persist=lambda image: image != b'empty')
+    assert cache.get(('a',), lambda: b'empty', f'{tmp_path}/', 'a.png') == b'empty'
+    assert cache.get(('a',), lambda: None, f'{tmp_path}/', 'a.png') == b'empty'
+    assert not os.listdir(tmp_path)
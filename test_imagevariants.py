@@ -0,0 +1,41 @@
+import io
+import os
+from PIL import Image
+import imagevariants
+from imagecache import ImageCache
+
+
+def make_image(path_to_fields, field_name: str = 'field') -> str:
+    os.makedirs(f'{path_to_fields}/{field_name}', exist_ok=True)
+    path = f'{path_to_fields}/{field_name}/{field_name}_NDVI_10_field.png'
+    Image.new('RGBA', (480, 240), (20, 160, 60, 255)).save(path)
+    return path
+
+
+def test_variant_is_scaled_down_but_not_up(tmp_path):
+    path = make_image(tmp_path)
+    small = Image.open(io.BytesIO(imagevariants.render_variant(path, 120, 'webp')))
+    assert (small.format, small.size) == ('WEBP', (120, 60))
+    full = Image.open(io.BytesIO(imagevariants.render_variant(path, 1000, 'jpeg')))
+    assert (full.format, full.size) == ('JPEG', (480, 240))
+
+
+def test_variants_are_cached_in_memory_and_on_disk(tmp_path, monkeypatch):
+    monkeypatch.setattr(imagevariants, 'PATH_FIELDS', f'{tmp_path}/')
+    monkeypatch.setattr(imagevariants, 'IMAGE_VARIANT_WIDTHS', (100,))
+    monkeypatch.setattr(imagevariants, 'IMAGE_VARIANT_FORMATS', ('png',))
+    monkeypatch.setattr(imagevariants, '_cache', ImageCache('agroapi_image_variant_total', 1024 ** 2, 1024 ** 2))
+    path = make_image(tmp_path)
+    imagevariants.make_image_variants('field')
+    monkeypatch.setattr(imagevariants, 'render_variant', None)
+    variant = imagevariants.get_variant('field', 'ndvi', 100, 'png', os.stat(path), 'run')
+    assert Image.open(io.BytesIO(variant)).size == (100, 50)
+
+
+def test_only_preset_variants_are_stored_on_disk(tmp_path, monkeypatch):
+    monkeypatch.setattr(imagevariants, 'PATH_FIELDS', f'{tmp_path}/')
+    monkeypatch.setattr(imagevariants, '_cache', ImageCache('agroapi_image_variant_total', 1024 ** 2, 1024 ** 2))
+    path = make_image(tmp_path)
+    for width in range(101, 111):
+        imagevariants.get_variant('field', 'ndvi', width, 'png', os.stat(path))
+    assert not os.path.exists(imagevariants.get_variants_dir('field'))
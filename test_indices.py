@@ -0,0 +1,27 @@
+import numpy as np
+import indices
+
+
+def test_ndvi_does_not_overflow_uint16():
+    red = np.array([[[40000, 0, 1000]]], dtype=np.uint16)
+    nir = np.array([[[40000, 0, 3000]]], dtype=np.uint16)
+    ndvi = indices.evaluate_index('NDVI', {'B04': red, 'B08': nir})
+    assert ndvi.dtype == np.float32
+    assert ndvi[0, 0, 0] == 0 and np.isnan(ndvi[0, 0, 1]) and ndvi[0, 0, 2] == np.float32(0.5)
+
+
+def test_blocks_give_the_same_index(monkeypatch):
+    rng = np.random.default_rng(0)
+    bands = {band: rng.integers(1, 10000, (1, 50, 30), dtype=np.uint16) for band in ('B02', 'B04', 'B08')}
+    whole = indices.evaluate_index('EVI', bands)
+    monkeypatch.setattr(indices, 'INDEX_BLOCK_ROWS', 7)
+    out = np.zeros((2, 50, 30), dtype=np.float32)
+    indices.evaluate_index('EVI', bands, out=out[1:])
+    np.testing.assert_array_equal(out[1:], whole)
+    blue, red, nir = (bands[band].astype(np.float64) / 10000 for band in ('B02', 'B04', 'B08'))
+    np.testing.assert_allclose(whole, 2.5 * (nir - red) / (nir + 6 * red - 7.5 * blue + 1), rtol=1e-4)
+
+
+def test_only_the_bands_of_the_indices_are_read():
+    assert indices.get_index_bands(('NDVI', 'SAVI')) == ('B04', 'B08')
+    assert indices.get_index_bands(('NDVI', 'NDRE', 'EVI')) == ('B04', 'B08', 'B05', 'B02')
@@ -0,0 +1,37 @@
+from concurrent.futures import ThreadPoolExecutor
+import jobs
+
+
+def test_create_job_coalesces_active_jobs(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, 'PATH_JOBS_DB', str(tmp_path / 'jobs.sqlite3'))
+    job, created = jobs.create_job('make-field-images', 'map1')
+    duplicate, duplicate_created = jobs.create_job('make-field-images', 'map1')
+    assert created and not duplicate_created
+    assert duplicate['id'] == job['id']
+
+    jobs.mark_failed(job['id'], 'error')
+    new_job, new_created = jobs.create_job('make-field-images', 'map1')
+    assert new_created and new_job['id'] != job['id']
+
+
+def test_set_stage_and_unfinished_jobs(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, 'PATH_JOBS_DB', str(tmp_path / 'jobs.sqlite3'))
+    job, _ = jobs.create_job('download-sat-field-data', 'map1')
+    jobs.set_stage(job['id'], 'download')
+    jobs.set_stage(None, 'ignored')
+    assert jobs.get_job(job['id'])['stage'] == 'download'
+    assert [item['id'] for item in jobs.unfinished_jobs()] == [job['id']]
+    assert jobs.get_job('unknown') is None
+
+
+def test_concurrent_submissions_share_one_job(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, 'PATH_JOBS_DB', str(tmp_path / 'jobs.sqlite3'))
+    field_names = [f'field{number}' for number in range(50)]
+
+    def submit(_):
+        return [jobs.create_job('make-field-images', field_name)[0]['id'] for field_name in field_names]
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        submitted = list(executor.map(submit, range(4)))
+    assert all(job_ids == submitted[0] for job_ids in submitted)
+    assert len(jobs.unfinished_jobs()) == 50
@@ -0,0 +1,106 @@
+import asyncio
+import geopandas as gpd
+import numpy as np
+import pytest
+import rasterio as rio
+from rasterio.io import MemoryFile
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+from shapely.geometry import box
+import fieldgeometry
+import makeimages
+from benchmarks.synthetic import make_field as make_field_dir, make_safe_zip
+from fieldgeometry import get_field_window
+from makeimages import get_band_pattern
+
+
+def make_band(memfile: MemoryFile, width: int = 1000, height: int = 1000) -> rio.DatasetReader:
+    transform = from_origin(400000, 6200000, 10, 10)
+    with memfile.open(driver='GTiff', width=width, height=height, count=1, dtype='uint16',
+                      crs='EPSG:32637', transform=transform) as dst:
+        dst.write(np.ones((1, height, width), dtype='uint16'))
+    return memfile.open()
+
+
+def make_field(left: float, bottom: float, right: float, top: float) -> gpd.GeoDataFrame:
+    return gpd.GeoDataFrame(geometry=[box(left, bottom, right, top)], crs='EPSG:32637')
+
+
+def test_field_window_covers_field_with_margin():
+    with MemoryFile() as memfile, make_band(memfile) as band:
+        field = make_field(401000, 6198000, 402000, 6199000)
+        window = get_field_window(band, field)
+    assert (window.col_off, window.row_off) == (100 - 16, 100 - 16)
+    assert (window.width, window.height) == (100 + 32, 100 + 32)
+
+
+def test_field_window_is_clipped_to_raster():
+    with MemoryFile() as memfile, make_band(memfile) as band:
+        field = make_field(400000, 6199500, 400500, 6200000)
+        window = get_field_window(band, field)
+    assert (window.col_off, window.row_off) == (0, 0)
+    assert (window.width, window.height) == (50 + 16, 50 + 16)
+
+
+def test_field_window_outside_raster():
+    with MemoryFile() as memfile, make_band(memfile) as band:
+        field = make_field(300000, 6000000, 301000, 6001000)
+        with pytest.raises(ValueError):
+            get_field_window(band, field)
+
+
+def test_band_pattern_uses_band_resolution_dir():
+    assert get_band_pattern('B04_10m.jp2') == 'GRANULE/*/IMG_DATA/R10m/*B04_10m.jp2'
+    assert get_band_pattern('SCL_20m.jp2') == 'GRANULE/*/IMG_DATA/R20m/*SCL_20m.jp2'
+
+
+def test_product_without_scl_is_processed_without_cloud_mask(tmp_path, monkeypatch):
+    monkeypatch.setattr(fieldgeometry, 'PATH_FIELDS', f'{tmp_path}/')
+    path_to_zip = make_safe_zip(f'{tmp_path}/scene', size=200, bands=('TCI', 'B04', 'B08'))
+    make_field_dir(f'{tmp_path}/', 'field', 50, 50, 40, 30, size=200)
+    ndvi_stats = asyncio.run(makeimages.get_field_ndvi_stats(path_to_zip, 'field'))
+    assert ndvi_stats.get('cloud_free_fraction') is None
+    assert ndvi_stats['valid_pixels'] > 0
+    with pytest.raises(FileNotFoundError):
+        asyncio.run(makeimages.get_path_to_band_file(path_to_zip, 'SCL_20m.jp2'))
+
+
+def test_field_indices_are_read_from_the_20m_bands(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(makeimages, 'FIELD_INDICES', ('NDRE',))
+    path_to_zip = make_safe_zip(f'{tmp_path}/scene', size=200, bands=('TCI', 'B04', 'B05', 'B08'))
+    make_field_dir('./fields/', 'field', 50, 50, 40, 30, size=200)
+    results = asyncio.run(makeimages.make_fields_images_tiff(path_to_zip, ['field']))
+    ndvi, ndre = results['field']['ndvi'], results['field']['indices']['NDRE']
+    assert results['field']['error'] is None
+    assert 'middle_ndvi' not in ndre and ndre['valid_pixels'] == ndvi['valid_pixels'] > 0
+    assert -1 <= ndre['mean'] <= 1 and ndre['mean'] != ndvi['mean']
+
+
+class RecordingBand:
+    """Band that records the windows it decodes."""
+
+    def __init__(self, band: rio.DatasetReader):
+        self.band = band
+        self.reads = []
+        self.transform, self.width, self.height = band.transform, band.width, band.height
+
+    def read(self, *args, window=None):
+        self.reads.append(window)
+        return self.band.read(*args, window=window)
+
+    def window_transform(self, window):
+        return self.band.window_transform(window)
+
+
+def test_fields_far_apart_are_decoded_in_their_own_windows():
+    windows = {'north_west': Window(0, 0, 20, 20), 'south_east': Window(980, 980, 20, 20),
+               'neighbour': Window(22, 0, 20, 20)}
+    with MemoryFile() as memfile, make_band(memfile) as band:
+        recording = RecordingBand(band)
+        arrays = makeimages.read_fields_windows(recording, windows)
+        resampled = makeimages.read_fields_resampled(recording, band, windows)
+    assert all(array.shape == (1, 20, 20) for array, _ in arrays.values())
+    assert all(array.shape == (1, 20, 20) for array in resampled.values())
+    assert len(recording.reads) == 4
+    assert sum(window.width * window.height for window in recording.reads) <= 2 * 2 * 3 * 20 * 20
@@ -0,0 +1,23 @@
+import asyncio
+import metrics
+
+
+def test_timed_stages_are_merged_and_rendered(monkeypatch):
+    monkeypatch.setattr(metrics, '_counters', {})
+    monkeypatch.setattr(metrics, '_gauges', {})
+    monkeypatch.setattr(metrics, '_histograms', {})
+
+    @metrics.timed('decode')
+    async def decode():
+        return 1
+
+    assert asyncio.run(decode()) == 1
+    worker_metrics = metrics.take_metrics()
+    assert metrics.render_metrics().count('agroapi_stage_seconds') == 0
+    metrics.merge_metrics(worker_metrics)
+    metrics.merge_metrics(worker_metrics)
+    text = metrics.render_metrics()
+    assert '# TYPE agroapi_stage_seconds histogram' in text
+    assert 'agroapi_stage_seconds_count{stage="decode"} 2' in text
+    assert 'agroapi_stage_seconds_bucket{stage="decode",le="+Inf"} 2' in text
+    assert 'agroapi_peak_rss_bytes{process="api"}' in text
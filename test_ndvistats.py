@@ -0,0 +1,40 @@
+import numpy as np
+from ndvistats import get_cloud_free_fraction, get_index_stats, get_ndvi_stats
+
+
+def test_stats_keep_zero_and_skip_masked_and_nan():
+    data = np.array([[0.0, 0.5, np.nan], [1.0, -0.5, 0.9]], dtype='float32')
+    mask = np.array([[False, False, False], [False, False, True]])
+    stats = get_ndvi_stats(np.ma.MaskedArray(data, mask=mask))
+    assert stats['valid_pixels'] == 4
+    assert stats['mean'] == 0.25
+    assert stats['middle_ndvi'] == 0.25
+    assert stats['median'] == 0.25
+    assert sum(stats['histogram']['counts']) == 4
+    assert len(stats['histogram']['bins']) == len(stats['histogram']['counts']) + 1
+
+
+def test_stats_of_empty_field():
+    data = np.ma.MaskedArray(np.zeros((2, 2), dtype='float32'), mask=True)
+    stats = get_ndvi_stats(data)
+    assert stats['valid_pixels'] == 0
+    assert stats['middle_ndvi'] is None
+
+
+def test_cloud_free_fraction_counts_only_field_pixels():
+    ndvi = np.ma.MaskedArray(np.full((2, 4), 0.5, dtype='float32'), mask=[[False] * 4, [True] * 4])
+    cloud = np.array([[True, False, False, False], [True, True, True, True]])
+    cloud_free_fraction = get_cloud_free_fraction(ndvi, cloud)
+    assert cloud_free_fraction == 0.75
+    stats = get_ndvi_stats(ndvi, cloud_free_fraction)
+    assert stats['accepted'] is True
+    assert get_ndvi_stats(ndvi, 0.1)['accepted'] is False
+
+
+def test_index_stats_count_values_outside_the_range_in_the_edge_bins():
+    evi = np.ma.MaskedArray(np.array([-3.0, 0.5, 2.0, 4.0], dtype='float32'), mask=False)
+    stats = get_index_stats(evi, value_range=(-1.0, 2.5))
+    assert 'middle_ndvi' not in stats
+    assert stats['histogram']['bins'][0] == -1.0 and stats['histogram']['bins'][-1] == 2.5
+    assert sum(stats['histogram']['counts']) == 4
+    assert stats['histogram']['counts'][0] == 1 and stats['histogram']['counts'][-1] == 1
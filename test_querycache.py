@@ -0,0 +1,23 @@
+from collections import OrderedDict
+import querycache
+
+
+SQUARE = 'POLYGON((37 55, 38 55, 38 56, 37 56, 37 55))'
+SQUARE_REORDERED = 'POLYGON((38 56, 37 56, 37 55, 38 55.0000000001, 38 56))'
+
+
+def test_key_does_not_depend_on_vertex_order():
+    assert querycache.make_query_key(SQUARE, limit=1) == querycache.make_query_key(SQUARE_REORDERED, limit=1)
+    assert querycache.make_query_key(SQUARE, limit=1) != querycache.make_query_key(SQUARE, limit=2)
+
+
+def test_cached_products_expire_and_are_evicted(tmp_path, monkeypatch):
+    monkeypatch.setattr(querycache, 'PATH_QUERY_CACHE_DB', f'{tmp_path}/queries.sqlite3')
+    monkeypatch.setattr(querycache, 'QUERY_CACHE_MAX_ENTRIES', 2)
+    products = OrderedDict(uuid={'title': 'S2A'})
+    for key in ('a', 'b', 'c'):
+        querycache.cache_products(key, products)
+    assert querycache.get_cached_products('a') is None
+    assert querycache.get_cached_products('c') == products
+    monkeypatch.setattr(querycache, 'QUERY_CACHE_TTL', -1)
+    assert querycache.get_cached_products('c') is None
@@ -0,0 +1,26 @@
+import os
+import registry
+
+
+def test_registry_follows_field_directories(tmp_path, monkeypatch):
+    monkeypatch.setattr(registry, 'PATH_FIELDS', f'{tmp_path}/')
+    for name in ('map1', 'map2', 'buffer'):
+        os.mkdir(tmp_path / name)
+    (tmp_path / 'map1' / 'map1.geojson').write_text('{}')
+    registry.load_fields()
+    assert registry.list_fields() == (['map1', 'map2'], 2)
+    assert registry.list_fields(offset=1, limit=1) == (['map2'], 2)
+    assert registry.get_field('map1')['status'] == 'created'
+    assert registry.get_field('buffer') is None
+    assert registry.get_field('..') is None
+
+    (tmp_path / 'map1' / 'sat_field_map1.geojson').write_text('{"features": [{"properties": {"uuid": "id1"}}]}')
+    (tmp_path / 'map1' / 'map1_NDVI.json').write_text('{"ndvi_data": {"middle_ndvi": 0.55}}')
+    os.utime(tmp_path / 'map1', ns=(1, 1))
+    field = registry.get_field('map1')
+    assert (field['status'], field['scene_id'], field['middle_ndvi']) == ('processed', 'id1', 0.55)
+
+    os.mkdir(tmp_path / 'map3')
+    os.rmdir(tmp_path / 'map2')
+    assert registry.list_fields() == (['map1', 'map3'], 2)
+    assert registry.get_field('map2') is None
@@ -0,0 +1,24 @@
+import os
+import scenecache
+
+
+def make_scene(uuid: str, size: int) -> None:
+    os.makedirs(scenecache.get_scene_dir(uuid), exist_ok=True)
+    with open(f'{scenecache.get_scene_dir(uuid)}{uuid}.zip', 'wb') as f:
+        f.write(b'0' * size)
+    scenecache.register_scene(uuid, uuid)
+
+
+def test_lru_eviction_skips_scenes_in_use(tmp_path, monkeypatch):
+    monkeypatch.setattr(scenecache, 'PATH_SCENE_CACHE', f'{tmp_path}/')
+    monkeypatch.setattr(scenecache, 'SCENE_CACHE_MAX_BYTES', 250)
+    make_scene('a', 100)
+    make_scene('b', 100)
+    with scenecache.use_scene('a'):
+        make_scene('c', 100)
+        assert scenecache.is_scene_cached('a', 'a')
+        assert not scenecache.is_scene_cached('b', 'b')
+        assert scenecache.is_scene_cached('c', 'c')
+    scenecache.evict_scenes(max_bytes=100)
+    assert scenecache.is_scene_cached('a', 'a')
+    assert not scenecache.is_scene_cached('c', 'c')
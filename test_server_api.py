@@ -1,3 +1,6 @@
+import os
+import subprocess
+import sys
 import pytest
 from httpx import AsyncClient
 from server_api import app
@@ -18,3 +21,38 @@ async def test_response_ndvi():
     assert response.status_code == 200
     assert response.json() == {"ndvi_data": {"middle_ndvi": 0.55}}
 
+
+
+@pytest.mark.anyio
+async def test_response_job_not_found():
+    async with AsyncClient(app=app, base_url="http://test") as ac:
+        response = await ac.get("/jobs/unknown")
+    assert response.status_code == 404
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('filename', ['../escaped.geojson', 'buffer.geojson', '..\\escaped.geojson'])
+async def test_make_field_rejects_path_like_names(filename):
+    async with AsyncClient(app=app, base_url="http://test") as ac:
+        response = await ac.post("/make-field", files={"file": (filename, b'{}')})
+    assert response.status_code == 400
+
+
+def test_import_does_not_load_geospatial_stack():
+    code = 'import sys, server_api; print([m for m in ("geopandas", "rasterio", "matplotlib", "sentinelsat") if m in sys.modules])'
+    env = {**os.environ, 'PYTHONPATH': os.path.dirname(os.path.abspath(__file__))}
+    result = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == '[]'
+
+
+def test_delete_field_does_not_load_geospatial_stack(tmp_path):
+    os.makedirs(tmp_path / 'fields' / 'map1')
+    code = ('import asyncio, sys, httpx, server_api\n'
+            'async def delete():\n'
+            '    async with httpx.AsyncClient(app=server_api.app, base_url="http://test") as ac:\n'
+            '        return await ac.delete("/delete_field", params={"field_name": "map1"})\n'
+            'print(asyncio.run(delete()).status_code, [m for m in ("geopandas", "rasterio") if m in sys.modules])')
+    env = {**os.environ, 'PYTHONPATH': os.path.dirname(os.path.abspath(__file__)), 'AGROAPI_STORAGE_ROOT': str(tmp_path)}
+    result = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == '200 []'
+    assert not os.path.exists(tmp_path / 'fields' / 'map1')
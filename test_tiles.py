@@ -0,0 +1,63 @@
+import os
+import numpy as np
+import pytest
+import rasterio as rio
+from rasterio.transform import from_origin
+from fastapi import HTTPException
+import tiles
+from imagecache import ImageCache
+from makeimages import save_masked_geotiff
+
+
+def make_ndvi_raster(path_to_fields, field_name: str = 'field', size: int = 2000, masked: bool = False) -> str:
+    os.makedirs(f'{path_to_fields}/{field_name}', exist_ok=True)
+    path = f'{path_to_fields}/{field_name}/{field_name}_NDVI_10_masked.tiff'
+    ndvi = np.ma.MaskedArray(np.full((1, size, size), 0.5, dtype=np.float32), mask=masked)
+    save_masked_geotiff(path, ndvi, from_origin(400000, 6200000, 10, 10), 'EPSG:32637', np.nan)
+    return path
+
+
+def make_cache(max_disk_bytes: int = 1024 ** 2) -> ImageCache:
+    return ImageCache('agroapi_tile_cache_total', 1024 ** 2, max_disk_bytes, persist=lambda tile: tile is not tiles.EMPTY_TILE)
+
+
+def test_tile_bounds():
+    assert tiles.get_tile_bounds(0, 0, 0) == pytest.approx((-tiles.WORLD_HALF_SIZE, -tiles.WORLD_HALF_SIZE,
+                                                            tiles.WORLD_HALF_SIZE, tiles.WORLD_HALF_SIZE))
+    left, bottom, right, top = tiles.get_tile_bounds(1, 1, 0)
+    assert (left, bottom) == (0, 0) and right == top == pytest.approx(tiles.WORLD_HALF_SIZE)
+
+
+def test_overview_matches_zoom(tmp_path):
+    with rio.open(make_ndvi_raster(tmp_path)) as src:
+        assert src.overviews(1)
+        assert tiles._get_overview_level(src, 10) is None
+        assert tiles._get_overview_level(src, 10 * src.overviews(1)[-1]) == len(src.overviews(1)) - 1
+
+
+def test_tiles_are_cached_in_memory_and_on_disk(tmp_path, monkeypatch):
+    monkeypatch.setattr(tiles, 'PATH_FIELDS', f'{tmp_path}/')
+    monkeypatch.setattr(tiles, '_cache', make_cache())
+    path = make_ndvi_raster(tmp_path)
+    rendered = []
+    render_tile = tiles.render_tile
+    monkeypatch.setattr(tiles, 'render_tile', lambda *args: rendered.append(args) or render_tile(*args))
+    # z12 tile over the middle of the raster
+    tile = tiles.get_tile('field', 'ndvi', 12, 2475, 1278, os.stat(path))
+    assert tile.startswith(b'\x89PNG') and tile != tiles.EMPTY_TILE
+    assert tiles.get_tile('field', 'ndvi', 12, 2475, 1278, os.stat(path)) == tile
+    monkeypatch.setattr(tiles, '_cache', make_cache())
+    assert tiles.get_tile('field', 'ndvi', 12, 2475, 1278, os.stat(path)) == tile
+    assert len(rendered) == 1
+    assert tiles.render_tile(path, 'ndvi', 12, 0, 0) == tiles.EMPTY_TILE
+
+
+def test_only_tiles_with_field_pixels_are_stored(tmp_path, monkeypatch):
+    monkeypatch.setattr(tiles, 'PATH_FIELDS', f'{tmp_path}/')
+    monkeypatch.setattr(tiles, '_cache', make_cache())
+    path = make_ndvi_raster(tmp_path, masked=True)
+    with pytest.raises(HTTPException) as ex:
+        tiles.get_tile('field', 'ndvi', 12, 0, 0, os.stat(path))
+    assert ex.value.status_code == 404
+    assert tiles.get_tile('field', 'ndvi', 12, 2475, 1278, os.stat(path)) == tiles.EMPTY_TILE
+    assert not os.path.exists(tiles.get_tiles_dir('field'))
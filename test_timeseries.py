@@ -0,0 +1,74 @@
+import datetime
+from contextlib import contextmanager
+import pytest
+import timeseries
+
+
+def make_row(uuid: str, day: int, middle_ndvi: float) -> dict:
+    stats = {'middle_ndvi': middle_ndvi, 'mean': middle_ndvi, 'median': middle_ndvi, 'std': 0.1,
+             'percentiles': {'p10': None, 'p25': 0.2, 'p75': 0.6, 'p90': 0.7}, 'valid_pixels': 100}
+    product = {'beginposition': datetime.datetime(2022, 6, day, 8, 45), 'cloudcoverpercentage': 5.0}
+    return timeseries.make_series_row(uuid, product, stats)
+
+
+def test_series_is_sorted_by_date_and_round_trips(tmp_path, monkeypatch):
+    monkeypatch.setattr(timeseries, 'PATH_FIELDS', f'{tmp_path}/')
+    (tmp_path / 'field').mkdir()
+    series = timeseries.add_series_rows(timeseries.read_ndvi_series('field'), [make_row('b', 20, 0.5)])
+    timeseries.write_ndvi_series('field', series)
+    series = timeseries.add_series_rows(timeseries.read_ndvi_series('field'), [make_row('a', 10, 0.4)])
+    timeseries.write_ndvi_series('field', series)
+
+    records = timeseries.ndvi_series_to_records(timeseries.read_ndvi_series('field'))
+    assert [record['uuid'] for record in records] == ['a', 'b']
+    assert records[0]['date'] == '2022-06-10T08:45:00'
+    assert records[0]['middle_ndvi'] == 0.4
+    assert records[0]['p10'] is None
+    assert records[0]['valid_pixels'] == 100
+    records = timeseries.ndvi_series_to_records(timeseries.read_ndvi_series('field'), '2022-06-11', '2022-06-20')
+    assert [record['uuid'] for record in records] == ['b']
+    records = timeseries.ndvi_series_to_records(timeseries.read_ndvi_series('field'), '20220611', '20220620')
+    assert [record['uuid'] for record in records] == ['b']
+
+
+def test_acquisitions_are_processed_within_the_pool_size(tmp_path, monkeypatch):
+    monkeypatch.setattr(timeseries, 'PATH_FIELDS', f'{tmp_path}/')
+    (tmp_path / 'field').mkdir()
+    products = {f'uuid{day}': {'title': f'scene{day}', 'beginposition': datetime.datetime(2022, 6, day)}
+                for day in range(1, 13)}
+    running = []
+    references = []
+
+    async def get_series_products(*args):
+        return None, products
+
+    async def download_scene(api, id_product, products_from_sat, job_id=None):
+        pass
+
+    async def run_in_pool(func, field_name, id_product, title):
+        running.append(id_product)
+        assert len(running) <= timeseries.PROCESS_POOL_SIZE
+        assert id_product in references
+        await timeseries.asyncio.sleep(0.01)
+        running.remove(id_product)
+        return {'middle_ndvi': 0.5, 'mean': 0.5, 'median': 0.5, 'std': 0.1, 'valid_pixels': 100,
+                'percentiles': {'p10': 0.1, 'p25': 0.2, 'p75': 0.6, 'p90': 0.7}}
+
+    @contextmanager
+    def use_scene(uuid):
+        references.append(uuid)
+        yield
+        references.remove(uuid)
+
+    monkeypatch.setattr(timeseries, 'get_series_products', get_series_products)
+    monkeypatch.setattr(timeseries, 'download_scene', download_scene)
+    monkeypatch.setattr(timeseries, 'run_in_pool', run_in_pool)
+    monkeypatch.setattr(timeseries, 'use_scene', use_scene)
+    result = timeseries.asyncio.run(timeseries.run_ndvi_series('field', '20220601', '20220630', 30, 'user', 'password'))
+    assert result == {'dates': 12, 'added': 12, 'errors': {}}
+
+
+def test_series_dates_in_both_formats():
+    assert timeseries.parse_series_date('20220611') == timeseries.parse_series_date('2022-06-11')
+    with pytest.raises(ValueError):
+        timeseries.parse_series_date('11.06.2022')
@@ -0,0 +1,102 @@
+import asyncio
+import pytest
+import jobs
+import worker
+
+
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, 'PATH_JOBS_DB', str(tmp_path / 'jobs.sqlite3'))
+    monkeypatch.setattr(jobs, 'JOB_EXECUTION', 'queue')
+    monkeypatch.setattr(worker, 'WORKER_POLL_INTERVAL', 0.01)
+
+
+def test_worker_runs_the_queued_job(queue, monkeypatch):
+    calls = []
+
+    async def make_data_field(field_name, job_id=None):
+        calls.append((field_name, job_id))
+        return 'done'
+
+    async def scenario():
+        job = await jobs.submit_job('make-field-images', 'map1', None, 'map1')
+        assert jobs.get_job(job['id'])['state'] == 'queued'
+        monkeypatch.setattr(worker, 'get_job_runners', lambda: {'make-field-images': make_data_field})
+        await worker.run_worker(until_empty=True)
+        return job
+
+    job = asyncio.run(scenario())
+    assert calls == [('map1', job['id'])]
+    done = jobs.get_job(job['id'])
+    assert (done['state'], done['message'], done['attempts'], done['args']) == ('done', 'done', 1, ['map1'])
+
+
+def test_expired_lease_is_queued_again_then_fails(queue, monkeypatch):
+    monkeypatch.setattr(jobs, 'JOB_MAX_ATTEMPTS', 2)
+    job, _ = jobs.create_job('make-field-images', 'map1', ('map1',))
+    for attempt in (1, 2):
+        assert jobs.claim_job(['make-field-images'])['attempts'] == attempt
+        monkeypatch.setattr(jobs, 'JOB_LEASE', -1)
+        assert jobs.renew_lease(job['id'])
+        jobs.requeue_expired_jobs()
+    assert jobs.get_job(job['id'])['state'] == 'failed'
+    assert jobs.claim_job(['make-field-images']) is None
+
+
+def test_result_of_a_lost_lease_is_dropped(queue, monkeypatch):
+    job, _ = jobs.create_job('make-field-images', 'map1', ('map1',))
+    jobs.claim_job(['make-field-images'])
+    monkeypatch.setattr(jobs, 'get_node_id', lambda: 'other:1')
+
+    async def run(field_name, job_id=None):
+        return 'late'
+
+    asyncio.run(jobs.execute_job(job['id'], run, 'map1'))
+    assert jobs.get_job(job['id'])['state'] == 'running'
+    assert not jobs.renew_lease(job['id'])
+
+
+def test_jobs_with_credentials_are_not_queued(queue):
+    job, _ = jobs.create_job('download-sat-field-data', 'map1')
+    assert not jobs.is_queued_kind('download-sat-field-data')
+    assert jobs.claim_job(['download-sat-field-data', 'make-field-images']) is None
+    assert jobs.get_job(job['id'])['state'] == 'queued'
+
+
+def test_api_start_keeps_live_scene_references_and_drops_expired_ones(tmp_path, monkeypatch):
+    import scenecache
+    import server_api
+    monkeypatch.setattr(scenecache, 'PATH_SCENE_CACHE', f'{tmp_path}/scenes/')
+    with scenecache.use_scene('live'):
+        monkeypatch.setattr(scenecache, 'JOB_LEASE', -1)
+        with scenecache.use_scene('killed'):
+            asyncio.run(server_api.reset_scenes())
+            scenecache.evict_scenes(max_bytes=-1)
+            with scenecache._connect() as connection:
+                assert [row['uuid'] for row in connection.execute('SELECT uuid FROM scenes')] == ['live']
+                assert [row['uuid'] for row in connection.execute('SELECT uuid FROM scene_references')] == ['live']
+
+
+def test_local_start_resumes_only_jobs_with_an_expired_lease(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, 'PATH_JOBS_DB', str(tmp_path / 'jobs.sqlite3'))
+    calls = []
+
+    async def make_data_field(field_name, job_id=None):
+        calls.append(field_name)
+        return 'done'
+
+    async def scenario():
+        live, _ = jobs.create_job('make-field-images', 'live', ('live',))
+        killed, _ = jobs.create_job('make-field-images', 'killed', ('killed',))
+        jobs.claim_job(['make-field-images'])
+        monkeypatch.setattr(jobs, 'JOB_LEASE', -1)
+        jobs.claim_job(['make-field-images'])
+        monkeypatch.setattr(jobs, 'JOB_LEASE', 60)
+        jobs.resume_expired_jobs({'make-field-images': make_data_field})
+        await asyncio.gather(*jobs._tasks)
+        return live, killed
+
+    live, killed = asyncio.run(scenario())
+    assert calls == ['killed']
+    assert jobs.get_job(live['id'])['state'] == 'running'
+    assert (jobs.get_job(killed['id'])['state'], jobs.get_job(killed['id'])['attempts']) == ('done', 2)
@@ -0,0 +1,151 @@
+"""XYZ WebMercator map tiles of the masked field rasters. Tiles are read from the COG overview that matches
+the zoom, warped to EPSG:3857 and kept as PNG in an LRU cache in memory and on disk."""
+import functools
+import io
+import os
+import shutil
+from email.utils import formatdate
+import anyio.to_thread
+import numpy as np
+import rasterio as rio
+from fastapi import HTTPException, Request
+from fastapi.responses import Response
+from PIL import Image
+from rasterio.enums import Resampling
+from rasterio.transform import from_bounds
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_bounds
+from httpfiles import make_etag, is_not_modified
+from imagecache import ImageCache
+from metrics import timed
+from rendering import colorize_ndvi, colorize_rgb
+from settings import (PATH_FIELDS, TILE_SIZE, TILE_MAX_ZOOM, TILE_NDVI_RANGE, TILE_CACHE_MAX_BYTES, TILE_DISK_CACHE_MAX_BYTES,
+                      CACHE_CONTROL_TILES)
+
+
+URL = str
+
+WEB_MERCATOR = 'EPSG:3857'
+# Half the length of the WebMercator world square in meters.
+WORLD_HALF_SIZE = 20037508.342789244
+
+TILE_LAYERS = {
+    'ndvi': '_NDVI_10_masked.tiff',
+    'rgb': '_RGB_10_TCI_masked.tiff',
+    }
+
+
+def get_tile_bounds(z: int, x: int, y: int) -> tuple[float, float, float, float]:
+    """Left, bottom, right, top of the XYZ tile in WebMercator meters."""
+    size = 2 * WORLD_HALF_SIZE / 2 ** z
+    left = -WORLD_HALF_SIZE + x * size
+    top = WORLD_HALF_SIZE - y * size
+    return left, top - size, left + size, top
+
+
+def get_raster_path(field_name: str, layer: str) -> URL:
+    return f'{PATH_FIELDS}{field_name}/{field_name}{TILE_LAYERS[layer]}'
+
+
+def get_tiles_dir(field_name: str) -> URL:
+    return f'{PATH_FIELDS}{field_name}/tiles/'
+
+
+def remove_field_tiles(field_name: str) -> None:
+    """Deletes the tiles of the field on disk, the rasters are made again."""
+    shutil.rmtree(get_tiles_dir(field_name), ignore_errors=True)
+    _cache.forget_dir(get_tiles_dir(field_name))
+
+
+@functools.lru_cache(maxsize=256)
+def get_raster_bounds(path: URL, version: int) -> tuple[float, float, float, float]:
+    """WebMercator bounds of the raster of this version (mtime)."""
+    with rio.open(path) as src:
+        return transform_bounds(src.crs, WEB_MERCATOR, *src.bounds)
+
+
+def is_tile_in_raster(path: URL, version: int, z: int, x: int, y: int) -> bool:
+    left, bottom, right, top = get_tile_bounds(z, x, y)
+    raster_left, raster_bottom, raster_right, raster_top = get_raster_bounds(path, version)
+    return left < raster_right and right > raster_left and bottom < raster_top and top > raster_bottom
+
+
+def _get_overview_level(src: rio.DatasetReader, resolution: float) -> int | None:
+    """The coarsest overview that is still finer than the tile pixels, None for full resolution."""
+    level = None
+    for index, factor in enumerate(src.overviews(1)):
+        if src.res[0] * factor <= resolution:
+            level = index
+    return level
+
+
+def read_tile(path: URL, z: int, x: int, y: int) -> np.ma.MaskedArray | None:
+    """Tile of the raster warped to WebMercator, None if the tile is outside the raster."""
+    bounds = get_tile_bounds(z, x, y)
+    with rio.open(path) as src:
+        left, bottom, right, top = transform_bounds(WEB_MERCATOR, src.crs, *bounds)
+        if right <= src.bounds.left or left >= src.bounds.right or top <= src.bounds.bottom or bottom >= src.bounds.top:
+            return None
+        level = _get_overview_level(src, (right - left) / TILE_SIZE)
+    with rio.open(path, overview_level=level) as src, \
+            WarpedVRT(src, crs=WEB_MERCATOR, transform=from_bounds(*bounds, TILE_SIZE, TILE_SIZE),
+                      width=TILE_SIZE, height=TILE_SIZE, resampling=Resampling.nearest) as vrt:
+        return vrt.read(masked=True)
+
+
+def encode_png(image: Image.Image) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, 'PNG', compress_level=1)
+    return buffer.getvalue()
+
+
+EMPTY_TILE = encode_png(Image.new('RGBA', (TILE_SIZE, TILE_SIZE), (0, 0, 0, 0)))
+
+# empty tiles (inside the raster bounds, outside the field) are only kept in memory
+_cache = ImageCache('agroapi_tile_cache_total', TILE_CACHE_MAX_BYTES, TILE_DISK_CACHE_MAX_BYTES,
+                    persist=lambda tile: tile is not EMPTY_TILE)
+
+
+@timed('render_tile')
+def render_tile(path: URL, layer: str, z: int, x: int, y: int) -> bytes:
+    """PNG tile of the NDVI (colored with the fixed TILE_NDVI_RANGE) or RGB raster. Transparent outside the field."""
+    array = read_tile(path, z, x, y)
+    if array is None or np.ma.getmaskarray(array).all():
+        return EMPTY_TILE
+    if layer == 'ndvi':
+        return encode_png(colorize_ndvi(array, *TILE_NDVI_RANGE))
+    return encode_png(colorize_rgb(array))
+
+
+def get_tile(field_name: str, layer: str, z: int, x: int, y: int, stat_result: os.stat_result) -> bytes:
+    """PNG tile from the memory cache, the disk cache or rendered from the raster. Tiles outside the
+    raster bounds are not found. Cached tiles are keyed by the raster version, so tiles of an older
+    processing run are never served."""
+    version = stat_result.st_mtime_ns
+    path = get_raster_path(field_name, layer)
+    if not is_tile_in_raster(path, version, z, x, y):
+        raise HTTPException(status_code=404, detail=f'Tile {z}/{x}/{y} is outside the {layer} raster of {field_name}')
+    return _cache.get((field_name, layer, version, z, x, y), lambda: render_tile(path, layer, z, x, y),
+                      get_tiles_dir(field_name), f'{layer}/{version}/{z}/{x}/{y}.png')
+
+
+async def tile_response(request: Request, field_name: str, layer: str, z: int, x: int, y: int,
+                        run_id: str = None) -> Response:
+    """Serves the tile with the ETag of the raster version. Answers 304 to conditional requests."""
+    if layer not in TILE_LAYERS:
+        raise HTTPException(status_code=404, detail=f"Layer '{layer}' not found. Layers: {', '.join(TILE_LAYERS)}")
+    if not 0 <= z <= TILE_MAX_ZOOM or not 0 <= x < 2 ** z or not 0 <= y < 2 ** z:
+        raise HTTPException(status_code=404, detail=f'Tile {z}/{x}/{y} not found')
+    try:
+        stat_result = os.stat(get_raster_path(field_name, layer))
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail=f"No {layer} raster of '{field_name}'. Start the 'run-make-field-images' process.")
+    headers = {
+        'ETag': make_etag(stat_result, run_id),
+        'Last-Modified': formatdate(stat_result.st_mtime, usegmt=True),
+        'Cache-Control': CACHE_CONTROL_TILES,
+        }
+    if is_not_modified(request, headers['ETag'], stat_result):
+        return Response(status_code=304, headers=headers)
+    tile = await anyio.to_thread.run_sync(get_tile, field_name, layer, z, x, y, stat_result)
+    return Response(content=tile, media_type='image/png', headers=headers)
@@ -0,0 +1,159 @@
+"""NDVI time series of the field: NDVI statistics of every acquisition date in a columnar file."""
+import asyncio
+import os
+from datetime import date, datetime
+import numpy as np
+from fastapi import HTTPException
+from loguru import logger
+from sentinelsat import SentinelAPI
+from getsatdata import download_scene, get_series_products
+from jobs import set_stage
+from makeimages import get_field_ndvi_stats
+from ndvistats import PERCENTILES
+from scenecache import use_scene
+from settings import PATH_FIELDS, MIN_CLOUD_FREE_FRACTION, PROCESS_POOL_SIZE
+from unpacksatdata import unzip_scene
+from workerpool import run_in_pool
+
+
+URL = str
+
+DATE_FORMATS = ('%Y%m%d', '%Y-%m-%d')
+STATS_COLUMNS = ('middle_ndvi', 'mean', 'median', 'std', *(f'p{q}' for q in PERCENTILES))
+SERIES_COLUMNS = {
+    'uuid': 'U36',
+    'date': 'datetime64[s]',
+    'cloud_cover': np.float32,
+    'cloud_free_fraction': np.float32,
+    **{column: np.float32 for column in STATS_COLUMNS},
+    'valid_pixels': np.int64,
+    }
+
+
+def get_series_path(field_name: str) -> URL:
+    return f'{PATH_FIELDS}{field_name}/{field_name}_NDVI_series.npz'
+
+
+def read_ndvi_series(field_name: str) -> dict[str, np.ndarray]:
+    """Columns of the NDVI series of the field, sorted by date. Empty columns if there is no series."""
+    try:
+        with np.load(get_series_path(field_name)) as series:
+            size = series['date'].size
+            return {column: series[column] if column in series.files else np.full(size, np.nan, dtype=dtype)
+                    for column, dtype in SERIES_COLUMNS.items()}
+    except FileNotFoundError:
+        return {column: np.array([], dtype=dtype) for column, dtype in SERIES_COLUMNS.items()}
+
+
+def write_ndvi_series(field_name: str, series: dict[str, np.ndarray]) -> None:
+    """Writes the series to a temporary file and renames it, so readers never see a partly written file."""
+    path = get_series_path(field_name)
+    path_to_tmp_file = f'{path}.{os.getpid()}.tmp.npz'
+    np.savez_compressed(path_to_tmp_file, **series)
+    os.replace(path_to_tmp_file, path)
+
+
+def add_series_rows(series: dict[str, np.ndarray], rows: list[dict]) -> dict[str, np.ndarray]:
+    """Appends the rows of the new dates and sorts the series by date."""
+    columns = {column: np.concatenate([values, np.array([row[column] for row in rows], dtype=SERIES_COLUMNS[column])])
+               for column, values in series.items()}
+    order = np.argsort(columns['date'], kind='stable')
+    return {column: values[order] for column, values in columns.items()}
+
+
+def parse_series_date(value: str) -> date:
+    """Date of the series endpoints, YYYYMMDD or YYYY-MM-DD. ValueError for other formats."""
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).date()
+        except ValueError:
+            pass
+    raise ValueError(f"Date '{value}' must be in the format YYYYMMDD or YYYY-MM-DD.")
+
+
+def ndvi_series_to_records(series: dict[str, np.ndarray], date_from: str = '', date_to: str = '') -> list[dict]:
+    """Rows of the series as JSON-ready dicts, optionally only the dates in [date_from, date_to].
+    Rows with a cloud-free fraction say if the scene is accepted."""
+    selected = np.ones(series['date'].size, dtype=bool)
+    if date_from:
+        selected &= series['date'] >= np.datetime64(parse_series_date(date_from))
+    if date_to:
+        selected &= series['date'] < np.datetime64(parse_series_date(date_to)) + np.timedelta64(1, 'D')
+    records = []
+    for index in np.flatnonzero(selected):
+        record = {}
+        for column in SERIES_COLUMNS:
+            value = series[column][index].item()
+            if column == 'date':
+                value = str(series['date'][index])
+            elif isinstance(value, float):
+                value = None if np.isnan(value) else round(value, 4)
+            record[column] = value
+        if record['cloud_free_fraction'] is not None:
+            record['accepted'] = record['cloud_free_fraction'] >= MIN_CLOUD_FREE_FRACTION
+        records.append(record)
+    return records
+
+
+def make_series_row(id_product: str, product: dict, ndvi_stats: dict) -> dict:
+    row = {
+        'uuid': id_product,
+        'date': np.datetime64(product['beginposition'].replace(tzinfo=None), 's'),
+        'cloud_cover': product.get('cloudcoverpercentage', np.nan),
+        'cloud_free_fraction': np.nan if ndvi_stats.get('cloud_free_fraction') is None else ndvi_stats['cloud_free_fraction'],
+        'valid_pixels': ndvi_stats['valid_pixels'],
+        }
+    stats = {**ndvi_stats, **ndvi_stats['percentiles']}
+    row.update({column: np.nan if stats[column] is None else stats[column] for column in STATS_COLUMNS})
+    return row
+
+
+def process_scene_ndvi(field_name: str, id_product: str, title_file: str) -> dict:
+    """Computes the NDVI statistics of the field on one scene inside a pool worker."""
+    return asyncio.run(_process_scene_ndvi(field_name, id_product, title_file))
+
+
+async def _process_scene_ndvi(field_name: str, id_product: str, title_file: str) -> dict:
+    with use_scene(id_product):
+        name_unzip_file = await unzip_scene(id_product, title_file)
+        return await get_field_ndvi_stats(name_unzip_file, field_name)
+
+
+async def _add_acquisition(api: SentinelAPI, field_name: str, id_product: str, products: dict[str, dict],
+                           pool_slots: asyncio.Semaphore, job_id: str = None) -> dict:
+    """Downloads the scene if it is not cached and computes the NDVI statistics of the field on it.
+    The scene is referenced from the download to the end of the processing, so it cannot be evicted in between."""
+    with use_scene(id_product):
+        await download_scene(api, id_product, products, job_id)
+        async with pool_slots:
+            ndvi_stats = await run_in_pool(process_scene_ndvi, field_name, id_product, products[id_product]['title'])
+    return make_series_row(id_product, products[id_product], ndvi_stats)
+
+
+async def run_ndvi_series(field_name: str, date_from: str, date_to: str, max_cloud: float,
+                          username: str, password: str, job_id: str = None) -> dict:
+    """Adds the acquisitions of the date range that are not in the NDVI series of the field yet.
+    The new dates are downloaded in parallel and processed at most PROCESS_POOL_SIZE at once, so a long
+    series does not overflow the pool queue that admits the requests."""
+    set_stage(job_id, 'search')
+    api, products = await get_series_products(field_name, username, password, date_from, date_to, max_cloud)
+    series = read_ndvi_series(field_name)
+    processed_products = set(series['uuid'].tolist())
+    new_products = [id_product for id_product in products if id_product not in processed_products]
+    logger.info(f'{field_name}: {len(new_products)} new acquisitions, {series["uuid"].size} in the series')
+
+    set_stage(job_id, 'processing')
+    pool_slots = asyncio.Semaphore(PROCESS_POOL_SIZE)
+    results = await asyncio.gather(*(_add_acquisition(api, field_name, id_product, products, pool_slots, job_id)
+                                     for id_product in new_products), return_exceptions=True)
+    rows = [result for result in results if not isinstance(result, Exception)]
+    errors = {products[id_product]['title']: str(getattr(result, 'detail', result))
+              for id_product, result in zip(new_products, results) if isinstance(result, Exception)}
+    for title, error in errors.items():
+        logger.info(f'{field_name}: {title}: {error}')
+    if rows:
+        series = add_series_rows(read_ndvi_series(field_name), rows)
+        write_ndvi_series(field_name, series)
+    if errors and not series['date'].size:
+        raise HTTPException(status_code=500, detail=f'No acquisition was processed: {errors}')
+    return {'dates': int(series['date'].size), 'added': len(rows), 'errors': errors}
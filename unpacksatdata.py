@@ -1,40 +1,111 @@
 """Unzip the zip file from the satellite."""
+import asyncio
+import fnmatch
 import geojson
+import os
+import shutil
 import zipfile
 from fastapi import HTTPException
-from settings import PATH_BUFFER, PATH_FIELDS
-from makeimages import make_images_tiff
+from settings import PATH_FIELDS, PIPELINE_BANDS, READ_BANDS_FROM_ZIP, FIELD_INDICES
+from indices import BAND_FILES, get_index_bands
+from makeimages import get_band_pattern, make_images_tiff, make_fields_images_tiff
+from workerpool import run_in_pool
+from jobs import set_stage
+from metrics import timed
+from scenecache import get_scene_dir, update_scene_size, use_scene
 from loguru import logger
 
 
-async def make_data_field(field_name: str) -> str:
+# Band files of the pipeline and of the vegetation indices of the fields.
+BANDS = tuple(dict.fromkeys(PIPELINE_BANDS + tuple(BAND_FILES[band] for band in get_index_bands(FIELD_INDICES))))
+
+
+async def make_data_field(field_name: str, job_id: str = None) -> str:
+    """Starts unpacking and creating raster images of the field in the process pool."""
+    return await run_in_pool(process_data_field, field_name, job_id)
+
+
+def process_data_field(field_name: str, job_id: str = None) -> str:
+    """Runs unpacking and image creation inside a pool worker."""
+    return asyncio.run(_make_data_field(field_name, job_id))
+
+
+async def _make_data_field(field_name: str, job_id: str = None) -> str:
     """Starts the function of unpacking and creating raster images of the field and NDVI field."""
-    name_unzip_file = await unzip_file(field_name)
-    await make_images_tiff(name_unzip_file, field_name)
+    id_product, _ = await get_product_of_field(field_name)
+    with use_scene(id_product):
+        set_stage(job_id, 'unzip')
+        name_unzip_file = await unzip_file(field_name)
+        await make_images_tiff(name_unzip_file, field_name, job_id)
     message = 'The satellite images have been processed and uploaded to the server.'
     return message
- 
 
-async def get_path_to_title_file(field_name: str) -> str:
-    """Specifies the name of the downloaded file."""
+
+async def make_data_fields(field_names: list[str], job_id: str = None) -> dict[str, dict]:
+    """Starts processing of the fields covered by one scene in the process pool."""
+    return await run_in_pool(process_data_fields, field_names, job_id)
+
+
+def process_data_fields(field_names: list[str], job_id: str = None) -> dict[str, dict]:
+    """Runs unpacking and image creation of several fields inside a pool worker."""
+    return asyncio.run(_make_data_fields(field_names, job_id))
+
+
+async def _make_data_fields(field_names: list[str], job_id: str = None) -> dict[str, dict]:
+    """Unpacks the scene once and creates images of all the fields from it."""
+    id_product, _ = await get_product_of_field(field_names[0])
+    with use_scene(id_product):
+        set_stage(job_id, 'unzip')
+        name_unzip_file = await unzip_file(field_names[0])
+        return await make_fields_images_tiff(name_unzip_file, field_names, job_id)
+
+
+async def get_product_of_field(field_name: str) -> tuple[str, str]:
+    """Returns uuid and title of the satellite product downloaded for the field."""
     with open(f'{PATH_FIELDS}{field_name}/sat_field_{field_name}.geojson') as f:
         string_geojson = geojson.load(f)
-        title_file =string_geojson.get('features')[0].get('properties').get('title')
-    path_to_title_file =f'{PATH_BUFFER}sat_field_{field_name}/{title_file}'
-    return path_to_title_file
+        properties = string_geojson.get('features')[0].get('properties')
+    return properties.get('uuid'), properties.get('title')
+
 
+async def unzip_file(field_name: str, bands: tuple[str, ...] = BANDS) -> str:
+    """Unpacks the band files needed by the pipeline from the zip file of the field scene."""
+    id_product, title_file = await get_product_of_field(field_name)
+    return await unzip_scene(id_product, title_file, bands)
 
-async def unzip_file(field_name: str) -> str:
-    """Unpacks a zip file with image data. Returns the path to the unpacked file."""
-    path_to_title_file = await get_path_to_title_file(field_name)
+
+@timed('unzip')
+async def unzip_scene(id_product: str, title_file: str, bands: tuple[str, ...] = BANDS) -> str:
+    """Unpacks the band files needed by the pipeline from the zip file once per scene.
+    Returns the path to the unpacked file, or to the zip file when bands are read from the zip."""
+    path_to_title_file =f'{get_scene_dir(id_product)}{title_file}'
     name_zip_file =f'{path_to_title_file}.zip' 
+    name_unzip_file = f'{path_to_title_file}.SAFE'
     try:
+        if READ_BANDS_FROM_ZIP:
+            if not os.path.isfile(name_zip_file):
+                raise FileNotFoundError(name_zip_file)
+            return name_zip_file
         with zipfile.ZipFile(name_zip_file, 'r') as zip_file:
-            zip_file.extractall(f'{PATH_BUFFER}sat_field_{field_name}/')
-        name_unzip_file = f'{path_to_title_file}.SAFE'
-        logger.info('File zip unpacked')
+            _extract_bands(zip_file, get_scene_dir(id_product), bands)
+        update_scene_size(id_product)
+        logger.info(f'Bands {bands} unpacked')
         return name_unzip_file
     except FileNotFoundError as ex:
         logger.info(f'{ex}.No such file or directory.')
         raise HTTPException(status_code=500, detail='There is no satellite data file. Download satellite data "/download-sat-field-data".')
 
+
+def _extract_bands(zip_file: zipfile.ZipFile, path_to_scene_dir: str, bands: tuple[str, ...]) -> None:
+    """Extracts the band files missing on disk. Each file is extracted to a temporary name
+    and renamed, so jobs sharing the scene never see a partly written band."""
+    patterns = [f'*.SAFE/{get_band_pattern(band)}' for band in bands]
+    for member in zip_file.namelist():
+        path_to_member = f'{path_to_scene_dir}{member}'
+        if os.path.exists(path_to_member) or not any(fnmatch.fnmatch(member, pattern) for pattern in patterns):
+            continue
+        os.makedirs(os.path.dirname(path_to_member), exist_ok=True)
+        path_to_tmp_file = f'{path_to_member}.{os.getpid()}.tmp'
+        with zip_file.open(member) as source, open(path_to_tmp_file, 'wb') as target:
+            shutil.copyfileobj(source, target)
+        os.replace(path_to_tmp_file, path_to_member)
@@ -0,0 +1,64 @@
+"""Worker node: runs the field processing jobs from the shared queue, `python worker.py`.
+The API nodes only queue the jobs (AGROAPI_JOB_EXECUTION=queue), the workers write the artifacts
+into the shared storage root (AGROAPI_STORAGE_ROOT) and the API nodes serve them from there."""
+import asyncio
+import signal
+from loguru import logger
+from jobs import claim_job, execute_job, requeue_expired_jobs, get_node_id
+from scenecache import drop_expired_scene_references
+from workerpool import shutdown_pool
+from settings import WORKER_CONCURRENCY, WORKER_POLL_INTERVAL, PATH_LOGS
+
+
+def get_job_runners() -> dict:
+    """Job functions of the queued kinds. They get the stored args of the job."""
+    from unpacksatdata import make_data_field
+    return {
+        'make-field-images': make_data_field,
+        }
+
+
+async def run_worker(stop: asyncio.Event = None, until_empty: bool = False) -> None:
+    """Claims queued jobs and runs up to WORKER_CONCURRENCY of them at once until `stop` is set,
+    or until the queue is empty and the jobs are done with `until_empty`."""
+    stop = stop or asyncio.Event()
+    runners = get_job_runners()
+    tasks = set()
+    logger.info(f'Worker {get_node_id()} started: {", ".join(runners)}')
+    while not stop.is_set():
+        requeue_expired_jobs()
+        drop_expired_scene_references()
+        job = claim_job(list(runners)) if len(tasks) < WORKER_CONCURRENCY else None
+        if job is not None:
+            task = asyncio.create_task(execute_job(job['id'], runners[job['kind']], *job['args']))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            continue
+        if until_empty and not tasks:
+            break
+        try:
+            await asyncio.wait_for(stop.wait(), WORKER_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+    if tasks:
+        # the leases of unfinished jobs expire and other workers take the jobs again
+        logger.info(f'Worker {get_node_id()} stopped with {len(tasks)} running jobs')
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def main() -> None:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await run_worker(stop)
+    finally:
+        shutdown_pool()
+
+
+if __name__ == '__main__':
+    logger.add(f"{PATH_LOGS}worker.log", format="{time} {level} {message}", level="DEBUG", rotation="5:00")
+    asyncio.run(main())
@@ -0,0 +1,79 @@
+"""Process pool for the blocking unzip, raster and render work."""
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from fastapi import HTTPException
+from loguru import logger
+from metrics import merge_metrics, take_metrics
+from settings import PROCESS_POOL_SIZE, PROCESS_POOL_MAX_QUEUE, POOL_PRELOAD_MODULES
+
+
+_executor = None
+_tasks_in_pool = 0
+
+
+class PoolTaskError(Exception):
+    """Picklable carrier for an HTTPException raised inside a pool worker, with the worker metrics."""
+
+    def __init__(self, status_code: int, detail: str, metrics: dict = None):
+        super().__init__(status_code, detail, metrics)
+        self.status_code = status_code
+        self.detail = detail
+        self.metrics = metrics
+
+
+def _call_in_worker(func, *args):
+    """Runs the function in the worker. Returns the result and the metrics recorded by the task."""
+    take_metrics()
+    try:
+        return func(*args), take_metrics()
+    except HTTPException as ex:
+        raise PoolTaskError(ex.status_code, ex.detail, take_metrics())
+
+
+def get_executor() -> ProcessPoolExecutor:
+    """Creates the process pool on first use. The workers are started by a fork server, not forked
+    from the server process, so they do not inherit SQLite connections open in its threads.
+    The fork server imports POOL_PRELOAD_MODULES once and every worker starts with them loaded."""
+    global _executor
+    if _executor is None:
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(list(POOL_PRELOAD_MODULES))
+        _executor = ProcessPoolExecutor(max_workers=PROCESS_POOL_SIZE, mp_context=context)
+        logger.info(f'Process pool started: {PROCESS_POOL_SIZE} workers')
+    return _executor
+
+
+def check_pool_capacity() -> None:
+    """Rejects the request when all workers are busy and the queue is full."""
+    if _tasks_in_pool >= PROCESS_POOL_SIZE + PROCESS_POOL_MAX_QUEUE:
+        logger.info(f'Process pool is full: {_tasks_in_pool} tasks')
+        raise HTTPException(status_code=503, detail='The server is busy processing other fields. Try again later.',
+                            headers={'Retry-After': '60'})
+
+
+async def run_in_pool(func, *args):
+    """Runs a blocking function in the process pool without blocking the event loop."""
+    global _tasks_in_pool
+    check_pool_capacity()
+    _tasks_in_pool += 1
+    try:
+        loop = asyncio.get_running_loop()
+        result, metrics = await loop.run_in_executor(get_executor(), _call_in_worker, func, *args)
+        merge_metrics(metrics)
+        return result
+    except PoolTaskError as ex:
+        if ex.metrics:
+            merge_metrics(ex.metrics)
+        raise HTTPException(status_code=ex.status_code, detail=ex.detail)
+    finally:
+        _tasks_in_pool -= 1
+
+
+def shutdown_pool() -> None:
+    """Stops the pool workers."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+        logger.info('Process pool stopped')